@@ -14,10 +14,16 @@ Script for list/status/attach/detach tasks. Default variables Profile=default, R
 list  : can take Topology as argument and display all ALB for the topology
 Status : Accepts Topology or one or more ALB as argument and shows status
 At/Detach : Accepts 1 or more ALB and Hostsor instance ID as argument. For each alb same set of actions performed with hosts
-            All ALB must be in same region.
+            Hosts may span regions, each region is handled concurrently against ALB of same name in that region.
+            CMDB selectors can be used instead of hosts, eg
+            attach -e alb1 --topology vettomhotfix63 --role Dispatcher
+Rolling : Same hosts/ALB as attach, hosts detached in batches, drained, hook run and attached back once healthy.
+            rolling -e alb1 --topology vettomhotfix63 --role Dispatcher --batch 25% --floor 75 --hook ./patch.sh
+Switch : Moves listeners of one ALB from a target group to another, or splits by weight. --rollback restores.
+            switch -e alb1 --to alb1-green --prewarm ; switch -e alb1 --to alb1-green -w 10 ; switch -e alb1 --rollback
 """
 
-import boto3,argparse,sys,time,re,os
+import boto3,argparse,sys,time,re,os,math,json,subprocess
 import dvclass
 
 SCR_HOME = os.path.dirname(os.path.realpath(__file__))
@@ -45,19 +51,59 @@ Status.add_argument('-p', '--profile', default="default", help='If no profile pr
 
 Attach = Sub.add_parser("attach",help="Attach instance/s to ALB, apply to all TG unless specified.")
 Attach.add_argument('-e', '--alb', nargs='+', help='Name/s of Aws ALB', required=True)
-Attach.add_argument('-t', '--target_group', default=None, help='Optional specify Target group')
-Attach.add_argument('-i', '--instances', nargs='+', help='Dispatcher Hostnames or Instance ID/s', required=True)
+Attach.add_argument('-t', '--target_group', nargs='+', default=None, help='Optional specify Target group/s')
+Attach.add_argument('-i', '--instances', nargs='+', help='Dispatcher Hostnames or Instance ID/s, or use CMDB selectors')
 Attach.add_argument('-p', '--profile', default="default", help='If no profile provided, assumes default')
+dvclass.AMSCMDB.AddSelectorArgs(Attach)
 # Attach.add_argument('-r', '--region', default="eu-west-1", help='Default is eu-west-1, or provide as argument')
 
 
 Detach = Sub.add_parser("detach",help="Detach instance/s to ALB, apply to all TG unless specified.")
 Detach.add_argument('-e','--alb', nargs='+', help='Name/s of Aws ALB', required=True)
-Detach.add_argument('-t', '--target_group', default=None, help='Optional specify Target group')
-Detach.add_argument('-i', '--instances', nargs='+', help='Dispatcher Hostnames or Instance ID/s', required=True)
+Detach.add_argument('-t', '--target_group', nargs='+', default=None, help='Optional specify Target group/s')
+Detach.add_argument('-i', '--instances', nargs='+', help='Dispatcher Hostnames or Instance ID/s, or use CMDB selectors')
 Detach.add_argument('-p', '--profile', default="default", help='If no profile provided, assumes default')
+dvclass.AMSCMDB.AddSelectorArgs(Detach)
 # Detach.add_argument('-r', '--region', default="eu-west-1", help='Default is eu-west-1, or provide as argument')
 
+Rolling = Sub.add_parser("rolling",help="Detach hosts in batches, run hook, attach back once drained, keeping healthy capacity above floor.")
+Rolling.add_argument('-e','--alb', nargs='+', help='Name/s of Aws ALB', required=True)
+Rolling.add_argument('-t', '--target_group', nargs='+', default=None, help='Optional specify Target group/s')
+Rolling.add_argument('-i', '--instances', nargs='+', help='Dispatcher Hostnames or Instance ID/s, or use CMDB selectors')
+Rolling.add_argument('-p', '--profile', default="default", help='If no profile provided, assumes default')
+Rolling.add_argument('-b', '--batch', default="1", help='Hosts per batch as count or percentage of hosts, eg 2 or 25%%. Default 1')
+Rolling.add_argument('--floor', type=int, default=50, help='Percent of targets of each TG that must stay healthy while batch is out, batch shrunk to fit. Default 50')
+Rolling.add_argument('--hook', help='Command run once batch is drained, before attach. Batch in DV_BATCH, DV_HOSTS, DV_INSTANCES, DV_REGIONS. Non zero exit stops rolling')
+Rolling.add_argument('--record', help='Append per batch timings to file as JSON lines')
+dvclass.AMSCMDB.AddSelectorArgs(Rolling)
+
+Switch = Sub.add_parser("switch",help="Blue/green, point ALB listeners from one target group to another, or weighted. --rollback restores.")
+Switch.add_argument('-e','--alb', help='Name of Aws ALB', required=True)
+Switch.add_argument('--to', help='Target group to send traffic to')
+Switch.add_argument('--from', dest='source', help='Target group traffic moves from, default whatever listener forwards to')
+Switch.add_argument('-w', '--weight', type=int, help='Percent of traffic to --to as weighted forward, rest stays on --from. Default all')
+Switch.add_argument('--port', type=int, nargs='+', help='Only listeners on these ports, default all')
+Switch.add_argument('--rules', action='store_true', help='Also switch listener rules forwarding to --from, not only default action')
+Switch.add_argument('--prewarm', action='store_true', help='Wait until every target of --to is healthy before switching')
+Switch.add_argument('--force', action='store_true', help='Switch even if --to has no healthy targets')
+Switch.add_argument('--rollback', action='store_true', help='Restore listener/rule actions saved by last switch of ALB')
+Switch.add_argument('-r', '--region', default="eu-west-1", help='Default is eu-west-1, or provide as argument')
+Switch.add_argument('-p', '--profile', default="default", help='If no profile provided, assumes default')
+
+# --trace on every task, prints AWS API call summary at exit
+for X in (List, Status, Attach, Detach, Rolling, Switch):
+    dvclass.APITrace.AddArgs(X)
+# --workers/--region-workers bound concurrent status calls, --wait bounds wait for targets to settle
+for X in (Status, Attach, Detach, Rolling, Switch):
+    dvclass.FanOut.AddArgs(X)
+for X in (Attach, Detach, Rolling, Switch):
+    dvclass.Converge.AddArgs(X)
+# --async runs status health calls on asyncio (aiobotocore)
+dvclass.AsyncLB.AddArgs(Status)
+# --refresh/--cache-ttl for cached ALB -> TG -> listener topology
+for X in (List, Status, Attach, Detach, Rolling, Switch):
+    dvclass.ALBTopology.AddArgs(X)
+
 # Parse Arguments
 args = P.parse_args()
 # Eit programme if no arguments provided. Print help
@@ -72,181 +118,451 @@ Profile = args.profile
 # Start of Functions. -----********------
 
 def ListallALB(VPC, Region):
-    # List and display all ELB in provided region. If VPC argument provided, will only show ELB attached to those VPC
-    ec2client = DVboto3.SetALBClient(Profile, Region)
-    try: Result = ec2client.describe_load_balancers()
-    except exception as ERR: print (" ERROR : Failed to get ALB list ", ERR)
-    # Process the output and print the list
+    # List and display all ALB of VPC in provided region from topology cache
     try:
-        print ("\n  ALB's in {} in {} region using profile {}. " .format(VPC,Region,Profile))
-        COUNT = False
-        for X in Result['LoadBalancers']:
-            VPCID = X.get('VpcId', 'NULL')
-            if VPC == VPCID:
-                ALB = X.get('LoadBalancerName', 'NULL')
-                DNS = X.get('DNSName', 'NULL')
-                print ("\t{} \t {} " .format(ALB, DNS))
-                COUNT = True           
-
-        if COUNT is False:
-            print ("    WARNING : No ALB found, please verify Profile, Region and VPC are valid")
-        # print ("\n")
-    except Exception as ERR: print("Failed to process Result to list ELB. \n {}" .format(ERR))
+        Result = Topo.ByVPC(VPC, Region)
+    except Exception as ERR:
+        print (" ERROR : Failed to get ALB list ", ERR)
+        return
+    print ("\n  ALB's in {} in {} region using profile {}. " .format(VPC,Region,Profile))
+    for ALB, X in Result:
+        print ("\t{} \t {} " .format(ALB, X['DNSName']))
+    if not Result:
+        print ("    WARNING : No ALB found, please verify Profile, Region and VPC are valid")
 
 def GetAlbList(VPC, Region):
-    # Return list of ALB
-    ec2client = DVboto3.SetALBClient(Profile, Region)
-    try: Result = ec2client.describe_load_balancers()
-    except exception as ERR: print (" ERROR : Failed to get ALB list ", ERR)
-    # Process the output and print the list
-    LIST = []
+    # Return list of [ALB, ARN] of VPC from topology cache
     try:
-        # print ("\n  ALB's in {} in {} region using profile {}. " .format(VPC,Region,Profile))
-        for X in Result['LoadBalancers']:
-            VPCID = X.get('VpcId', 'NULL')
-            if VPC == VPCID:
-                # ALB = X.get('LoadBalancerName', 'NULL')
-                # ARN = X.get('LoadBalancerArn', 'NULL')
-                VAL = [X.get('LoadBalancerName', 'NULL'), X.get('LoadBalancerArn', 'NULL')]
-                LIST.append(VAL) 
-        return LIST          
-
-    except Exception as ERR: print("Failed to process Result to list ELB. \n {}" .format(ERR))
+        Result = Topo.ByVPC(VPC, Region)
+    except Exception as ERR:
+        print (" ERROR : Failed to get ALB list ", ERR)
+        return []
+    return [[ALB, X['Arn']] for ALB, X in Result]
+
+def GetTargetGroups(ARN, Region):
+    # Target groups of ALB as list of [TGName, TGARN] from topology cache
+    return Topo.TargetGroups(ARN, Region)
+
+def GetTargetHealth(TGARN, Region):
+    ec2client = DVboto3.SetALBClient(Profile, Region)
+    return ec2client.describe_target_health(TargetGroupArn=TGARN)['TargetHealthDescriptions']
+
+def AlbStatusAll(ALBList):
+    # ALBList = [(ALB, ARN, Region)]. Target groups of all ALB fetched concurrently, then health of all TG.
+    # Output follows ALBList and TG order, each TG printed as soon as it and all before it are done.
+    Pool = dvclass.FanOut.FromArgs(args)
+    TGList = []
+    for (ALB, ARN, Region), (Result, ERR) in zip(ALBList, Pool.Map((Region, GetTargetGroups, ARN, Region) for ALB, ARN, Region in ALBList)):
+        if ERR:
+            print(" ERROR: failed to get TG Details for {}" .format(ALB))
+            print(ERR)
+            continue
+        for TG, TGARN in Result:
+            TGList.append((ALB, Region, TG, TGARN))
+
+    # Target health on asyncio with --async, results printed once all are in
+    Engine = dvclass.AsyncLB.FromArgs(Profile, args)
+    if Engine:
+        Health = Engine.Map((Region, Engine.TargetHealth, Region, TGARN) for ALB, Region, TG, TGARN in TGList)
+    else:
+        Health = Pool.Map((Region, GetTargetHealth, TGARN, Region) for ALB, Region, TG, TGARN in TGList)
+    for (ALB, Region, TG, TGARN), (Result, ERR) in zip(TGList, Health):
+        print("\n      ALB = {} Region = {} TGroup = {}\n" .format(ALB,Region,TG))
+        if ERR:
+            print(" ERROR: Failed to process TG {} . \n \t{}" .format(TG, ERR))
+            continue
+        for A in Result:
+            InstID = A['Target'].get('Id')
+            HostName = ams.GetHostname(InstID)
+            State = A['TargetHealth'].get('State')
+            print("\t  {}\t{}" .format(HostName, State))
 
 def Albstatus(ALB, Var,Region):
     # Accepts ARN as Var
-    try:
-        # ALB may have multiple TG, so get tG and loop for status
-        ec2client = DVboto3.SetALBClient(Profile, Region)
-        Result = ec2client.describe_target_groups(
-        LoadBalancerArn= Var, 
-        )
-        
-    except Exception as ERR:
-        print(" ERROR: failed to get TG Details for {}" .format(ALB))
-        print(ERR)
-    try:
-        for X in Result['TargetGroups']:
-            # TG Name and its ARN available, print Status
-            TG = X.get('TargetGroupName', 'NULL')
-            TGARN = X.get('TargetGroupArn', 'NULL')
-            print("\n      ALB = {} Region = {} TGroup = {}\n" .format(ALB,Region,TG))
-            # Now get the status of Target Group
-            STATUS = ec2client.describe_target_health(TargetGroupArn=TGARN,)
-            for A in STATUS['TargetHealthDescriptions']:
-                B = A['Target']
-                InstID = B.get('Id')
-                HostName = ams.GetHostname(InstID)
-                C = A['TargetHealth']
-                State = C.get('State')
-                print("\t  {}\t{}" .format(HostName, State))
-    except Exception as ERR:
-        print(" ERROR: Failed to process TG {} . \n \t{}" .format(TG, ERR))
-
+    AlbStatusAll([(ALB, Var, Region)])
 
-def AttachinstancetoALB(ALBName, Instances):
-    # Check all the TG and take action on all TG availalable
-    # First figure out the Region from Instance information and process each Instance
-    for I in Instances:
-        try:
-            AWSinfo = ams.GetInstAWS(I)
-            InstID = AWSinfo[0]
-            Host = AWSinfo[1]
-            Region = AWSinfo[2]
-            if InstID is None:
-                print (" \nERROR : Failed to get Instance ID for {}. Please chek Instance ID/Hostname provided. " .format(I))
-                exit()
-        except Exception as ERR:
-            print (" ERROR : Failed to get Instance ID for {} \n {} " .format(I,ERR))
 
-        print (InstID, Host, Region, Profile)
-        
 def FindELBRegion(Instances):
-    # Get Region Information and ensure all in single region
-    try:
-        REG = []
-        for I in Instances:
-            INFO = ams.GetInstAWS(I)
-            REG.append(INFO[2])
-
-        # If more than 1 region, exit programme
-        if len(set(REG)) != 1:
-            print ("  ERROR: Found more than 1 Region, all Hosts must be in same region")
-            print("    Regions info found", set(REG))
-            exit()
-        else:
-            return (REG[0])
-    except Exception as ERR:
-        print("    ERROR: Failed to get region info for {} \n {}" .format(I, ERR))
+    # Resolve all hosts in one pass and split by region
+    # Returns {Region: list of targets for register/deregister}
+    Groups, Unknown = ams.ResolveHosts(Instances)
+    if Unknown:
+        print ("  ERROR: Hosts not found in CMDB or not AWS hosts : {}" .format(" ".join(Unknown)))
         exit()
 
-def GetALBARN(ALBName, Region):
-    # Find ARN for ALB provided and return
-    ec2client = DVboto3.SetALBClient(Profile, Region)
-    try:
-        Result = ec2client.describe_load_balancers(Names=[
-        ALBName,
-    ],)
-        X = Result['LoadBalancers']
-        Y = X[0]
-        ARN = Y.get('LoadBalancerArn')
-        return ARN
-    except Exception as ERR:
-        print ("\n ERROR : Failed to get ALB ARN, check Profile and ALB name\n\n Exception :   ", ERR)
+    ByRegion = {}
+    for (Region, VPC), Records in Groups.items():
+        for Var in Records:
+            ByRegion.setdefault(Region, []).append({'Id': Var.InstID})
+    return ByRegion
+
+def TargetHosts():
+    # Hosts from -i, or instance IDs of all CMDB hosts matching selectors --topology/--role/--size/--az/--region/--cloud
+    if args.instances:
+        return args.instances
+    Where = ams.SelectorArgs(args)
+    if not Where:
+        print ("\n ERROR : Please provide \'-i Hosts\' or CMDB selector like \'--topology X --role Dispatcher\'\n")
+        exit()
+    Records = ams.Query(**Where)
+    if not Records:
+        print ("\n ERROR : No hosts in CMDB match {}\n" .format(Where))
         exit()
+    return [Var.InstID for Var in Records]
 
-def GetTGNameARN(ALBARN, Region):
-    # With ALB ARN, find all TG attached and return result as a list TGNAme, TGARN
+def ResolveALBs(Names, Region, Log):
+    # Resolve all ALB names in one batch, names not found reported and rest processed
     try:
-        ec2client = DVboto3.SetALBClient(Profile, Region)
-        Result = ec2client.describe_target_groups(
-            LoadBalancerArn= ALBARN, 
-            )
+        Found, Failed = Topo.Resolve(Names, Region)
     except Exception as ERR:
-        print("  ERROR: Failed to get TG details for {} \n  Exception=" .format(ALB, ERR))
-
-    # Loop through TargetGroup List
-    LIST = []
-    for X in Result['TargetGroups']:
-        TG = [X.get('TargetGroupName'), X.get('TargetGroupArn')]
-        LIST.append(TG)
-    return LIST
-
-def GetTGARN(ALB, ALBARN, Region, TGName):
-    # I TG Neame known, get TG ARN and return it.
+        Log.append("\n ERROR : Failed to get ALB ARN in {}, check Profile and ALB name\n\n Exception :   {}" .format(Region, ERR))
+        return []
+    for Name, ERR in Failed.items():
+        Log.append(" ERROR : ALB {} not found in {} with Profile={}. {}" .format(Name, Region, Profile, ERR))
+    return [(Name, Found[Name]) for Name in dict.fromkeys(Names) if Name in Found]
+
+def ResolveTGs(ALBs, Region, Log):
+    # Target groups per ALB as {ALB: [[TGName, TGARN]]}. All TG of ALB unless -t given, then named TG
+    # resolved in one batch for all ALB. TG not found or not attached to ALB reported per name.
+    if args.target_group is None:
+        return dict((ALB, Entry['TG']) for ALB, Entry in ALBs)
     try:
-        ec2client = DVboto3.SetALBClient(Profile, Region)
-        Result = ec2client.describe_target_groups(
-            Names=[TGName,],
-            )
-
-        for X in Result['TargetGroups']:
-            return X.get('TargetGroupArn')
+        Found, Failed = Topo.ResolveTargetGroups(args.target_group, Region)
     except Exception as ERR:
-        print("  ERROR: Failed to get TG ARN for {} \n  Exception={}" .format(ALB, ERR))
-
-def RegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList):
+        Log.append("  ERROR: Failed to get TG ARN for {} in {} \n  Exception={}" .format(" ".join(args.target_group), Region, ERR))
+        return {}
+    for TG, ERR in Failed.items():
+        Log.append("  ERROR: Target group {} not found in {}. {}" .format(TG, Region, ERR))
+    Result = {}
+    for ALB, Entry in ALBs:
+        Result[ALB] = []
+        for TG in args.target_group:
+            if TG not in Found:
+                continue
+            if Entry['Arn'] in Found[TG]['ALBs']:
+                Result[ALB].append([TG, Found[TG]['Arn']])
+            else:
+                Log.append("  ERROR: Target group {} is not attached to ALB {}" .format(TG, ALB))
+    return Result
+
+def RegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList, Log):
     ec2client = DVboto3.SetALBClient(Profile, Region)
     try:
         # Register targets to provide TG ARN
-        print(" INFO: Adding instance to ALB={}, TG={}" .format(ALB,TGNAME))
+        Log.append(" INFO: Adding instance to ALB={}, TG={}, Region={}" .format(ALB,TGNAME,Region))
         Result = ec2client.register_targets( TargetGroupArn=TGARN,Targets=InstanceList,)
-        if Result['ResponseMetadata']['HTTPStatusCode'] is 200:
-            print (f' SUCCESS : Targets registered ')
+        if Result['ResponseMetadata']['HTTPStatusCode'] == 200:
+            Log.append(' SUCCESS : Targets registered ')
+            return True
     except Exception as ERR:
-        print("\n  ERROR: Failed to register target to ALB={} TG={} \n  Exception={}" .format(ALB,TGNAME,ERR))
+        Log.append("\n  ERROR: Failed to register target to ALB={} TG={} \n  Exception={}" .format(ALB,TGNAME,ERR))
+    return False
 
 
-def DeRegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList):
+def DeRegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList, Log):
     ec2client = DVboto3.SetALBClient(Profile, Region)
     try:
         # Register targets to provide TG ARN
-        print(" INFO: Removing instance from ALB={}, TG={}" .format(ALB,TGNAME))
+        Log.append(" INFO: Removing instance from ALB={}, TG={}, Region={}" .format(ALB,TGNAME,Region))
         Result = ec2client.deregister_targets( TargetGroupArn=TGARN,Targets=InstanceList,)
-        if Result['ResponseMetadata']['HTTPStatusCode'] is 200:
-            print (f' SUCCESS : Targets Deregistered ')
+        if Result['ResponseMetadata']['HTTPStatusCode'] == 200:
+            Log.append(' SUCCESS : Targets Deregistered ')
+            return True
     except Exception as ERR:
-        print("\n  ERROR: Failed to Deregister target from ALB={} TG={} \n  Exception={}" .format(ALB,TGNAME,ERR))
+        Log.append("\n  ERROR: Failed to Deregister target from ALB={} TG={} \n  Exception={}" .format(ALB,TGNAME,ERR))
+    return False
+
+def RegionTGs(Region, Log):
+    # [(ALB, TGName, TGARN)] of ALB from -e and TG from -t resolved in region
+    ALBs = ResolveALBs(args.alb, Region, Log)
+    TGs = ResolveTGs(ALBs, Region, Log)
+    return [(ALB, TGNAME, TGARN) for ALB, Entry in ALBs for TGNAME, TGARN in TGs.get(ALB, [])]
+
+def RegionChange(Region, TGList, InstanceList, Attach, Log):
+    # Register/deregister InstanceList on every TG of TGList, returns [(ALB, TGName, TGARN)] changed
+    Changed = []
+    for ALB, TGNAME, TGARN in TGList:
+        if Attach:
+            OK = RegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList, Log)
+        else:
+            OK = DeRegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList, Log)
+        if OK:
+            Changed.append((ALB, TGNAME, TGARN))
+    return Changed
+
+def RegionTask(Region, InstanceList, Attach):
+    # All register/deregister work of one region. Output collected in Log so regions running
+    # concurrently print in region order. Returns Log, [(ALB, TGName, TGARN)] changed and True only if
+    # every ALB (and -t TG) was found and every TG changed.
+    Log = []
+    TGList = RegionTGs(Region, Log)
+    Changed = RegionChange(Region, TGList, InstanceList, Attach, Log)
+    Found = set(ALB for ALB, TGNAME, TGARN in TGList) == set(args.alb)
+    if args.target_group:
+        Found = Found and len(TGList) == len(set(args.alb)) * len(set(args.target_group))
+    return Log, Changed, Found and len(Changed) == len(TGList)
+
+def RollingHosts():
+    # CMDB records of target hosts ordered by region and hostname
+    Groups, Unknown = ams.ResolveHosts(TargetHosts())
+    if Unknown:
+        print ("  ERROR: Hosts not found in CMDB or not AWS hosts : {}" .format(" ".join(Unknown)))
+        exit()
+    Records = dict((Var.InstID, Var) for Records in Groups.values() for Var in Records)
+    return sorted(Records.values(), key=lambda Var: (Var.Region, Var.Hostname))
+
+def BatchSize(Total):
+    # --batch as host count or percentage of all hosts, at least 1
+    try:
+        if args.batch.endswith('%'):
+            Size = math.ceil(Total * float(args.batch[:-1]) / 100)
+        else:
+            Size = int(args.batch)
+    except ValueError:
+        print ("\n ERROR : Invalid batch size {}, use count or percentage eg 2 or 25%\n" .format(args.batch))
+        exit()
+    return max(1, min(Size, Total))
+
+def Capacity(Pool, TGMap):
+    # {(Region, TGARN): (Healthy Ids, Total targets)} of every TG rolled, fetched concurrently
+    Jobs = [(Region, TGARN) for Region in sorted(TGMap) for ALB, TGNAME, TGARN in TGMap[Region]]
+    Health = {}
+    for (Region, TGARN), (Result, ERR) in zip(Jobs, Pool.Map((Region, GetTargetHealth, TGARN, Region) for Region, TGARN in Jobs)):
+        if ERR:
+            print ("\n ERROR : Failed to get target health of {} in {}. {}" .format(TGARN, Region, ERR))
+            exit()
+        Healthy = set(X['Target']['Id'] for X in Result if X['TargetHealth'].get('State') == 'healthy')
+        Health[(Region, TGARN)] = (Healthy, len(Result))
+    return Health
+
+def FitBatch(Pending, Size, Health):
+    # Up to Size hosts of Pending in order, a host is taken only if every TG it is healthy in keeps --floor
+    # percent of its targets healthy with the batch so far out. Hosts skipped stay pending for later batches.
+    Batch = []
+    Out = dict((Key, 0) for Key in Health)
+    for Var in Pending:
+        if len(Batch) == Size:
+            break
+        Keys = [(Region, TGARN) for Region, TGARN in Health if Region == Var.Region and Var.InstID in Health[(Region, TGARN)][0]]
+        if all(len(Health[Key][0]) - Out[Key] - 1 >= math.ceil(Health[Key][1] * args.floor / 100) for Key in Keys):
+            Batch.append(Var)
+            for Key in Keys:
+                Out[Key] += 1
+    return Batch
+
+def RollingStep(Pool, TGMap, Batch, Attach):
+    # Deregister or register batch on all TG of its regions concurrently, then wait to drain or be healthy
+    ByRegion = {}
+    for Var in Batch:
+        ByRegion.setdefault(Var.Region, []).append({'Id': Var.InstID})
+    Watch = dvclass.Converge.FromArgs(Profile, args, Pool)
+    Regions = sorted(ByRegion)
+    Logs = dict((Region, []) for Region in Regions)
+    OK = True
+    for Region, (Changed, ERR) in zip(Regions, Pool.Map((Region, RegionChange, Region, TGMap.get(Region, []), ByRegion[Region], Attach, Logs[Region]) for Region in Regions)):
+        for Line in Logs[Region]:
+            print(Line)
+        if ERR:
+            print("\n  ERROR: Failed to {} targets in {} \n  Exception={}" .format("register" if Attach else "deregister", Region, ERR))
+            OK = False
+            continue
+        if len(Changed) != len(TGMap.get(Region, [])):
+            OK = False
+        for ALB, TGNAME, TGARN in Changed:
+            Watch.AddTG(ALB, TGNAME, TGARN, Region, [X['Id'] for X in ByRegion[Region]], Attach)
+    return Watch.Report(ams) and OK
+
+def RollingHook(Number, Batch):
+    # Run operator hook with batch hosts in environment, returns exit code
+    Env = dict(os.environ)
+    Env['DV_BATCH'] = str(Number)
+    Env['DV_HOSTS'] = " ".join(Var.Hostname for Var in Batch)
+    Env['DV_INSTANCES'] = " ".join(Var.InstID for Var in Batch)
+    Env['DV_REGIONS'] = " ".join(sorted(set(Var.Region for Var in Batch)))
+    print ("\n INFO : Running hook \'{}\' for {}" .format(args.hook, Env['DV_HOSTS']))
+    sys.stdout.flush()
+    return subprocess.run(args.hook, shell=True, env=Env).returncode
+
+def TGName(TGARN):
+    # Name part of arn:aws:elasticloadbalancing:REGION:ACCOUNT:targetgroup/NAME/ID
+    return TGARN.split('/')[1] if '/' in TGARN else TGARN
+
+def Forwards(Actions):
+    # TG ARNs a list of listener/rule actions forwards to
+    Result = []
+    for A in Actions:
+        if A.get('Type') != 'forward':
+            continue
+        if 'ForwardConfig' in A:
+            Result += [X['TargetGroupArn'] for X in A['ForwardConfig']['TargetGroups']]
+        elif 'TargetGroupArn' in A:
+            Result.append(A['TargetGroupArn'])
+    return list(dict.fromkeys(Result))
+
+def ForwardWeights(A):
+    # {TGARN: Weight} of forward action in listener order, plain TargetGroupArn is weight 1
+    Groups = A.get('ForwardConfig', {}).get('TargetGroups', [])
+    if Groups:
+        return dict((X['TargetGroupArn'], X.get('Weight', 1)) for X in Groups)
+    return {A['TargetGroupArn']: 1} if 'TargetGroupArn' in A else {}
+
+def DescribeForward(Actions):
+    # TG:weight of every forward in Actions, for messages
+    return " ".join("{}:{}" .format(TGName(ARN), W) for A in Actions if A.get('Type') == 'forward' for ARN, W in ForwardWeights(A).items())
+
+def SwitchActions(Actions, From, To, Weight):
+    # Actions forwarding to From get the From (and To if already there) share moved to To, all of it or Weight
+    # percent of it. Other target groups of the forward keep their weight, other action types kept as they are.
+    Result = []
+    for A in Actions:
+        if A.get('Type') != 'forward' or From not in Forwards([A]):
+            Result.append(A)
+            continue
+        Weights = ForwardWeights(A)
+        Others = [ARN for ARN in Weights if ARN not in (From, To)]
+        New = dict((K, V) for K, V in A.items() if K not in ('TargetGroupArn', 'ForwardConfig'))
+        Full = Weight is None or Weight >= 100
+        if Full and not Others:
+            New['TargetGroupArn'] = To
+            Result.append(New)
+            continue
+        if Others:
+            Share = Weights[From] + Weights.get(To, 0)
+            if 0 < Share < 100:
+                # Scale all weights, ratios kept, so percent split of share is not lost to rounding (max weight 999)
+                Scale = math.ceil(100 / Share)
+                Weights = dict((ARN, min(999, W * Scale)) for ARN, W in Weights.items())
+                Share = Weights[From] + Weights.get(To, 0)
+            ToWeight = Share if Full else round(Share * Weight / 100)
+        else:
+            Share, ToWeight = 100, Weight
+        Groups = []
+        for ARN, W in Weights.items():
+            if ARN == From:
+                if To not in Weights:
+                    Groups.append({'TargetGroupArn': To, 'Weight': ToWeight})
+                if not Full:
+                    Groups.append({'TargetGroupArn': From, 'Weight': Share - ToWeight})
+            elif ARN == To:
+                Groups.append({'TargetGroupArn': To, 'Weight': ToWeight})
+            else:
+                Groups.append({'TargetGroupArn': ARN, 'Weight': W})
+        Config = {'TargetGroups': Groups}
+        if 'TargetGroupStickinessConfig' in A.get('ForwardConfig', {}):
+            Config['TargetGroupStickinessConfig'] = A['ForwardConfig']['TargetGroupStickinessConfig']
+        New['ForwardConfig'] = Config
+        Result.append(New)
+    return Result
+
+def SwitchState(Region, ALB):
+    # Actions before first switch of ALB not yet rolled back, kept with topology cache for --rollback
+    return os.path.join(Topo.Dir, "albswitch-{}-{}-{}.json" .format(re.sub(r'[^\w.-]', '_', Profile), Region, ALB))
+
+def SavedSwitch(Region, ALB):
+    # Saved state {'Time', 'Changes'}, None if nothing saved
+    try:
+        with open(SwitchState(Region, ALB)) as F:
+            return json.load(F)
+    except (OSError, ValueError):
+        return None
+
+def ModifyAction(Region, Kind, ARN, Actions):
+    ec2client = DVboto3.SetALBClient(Profile, Region)
+    if Kind == 'listener':
+        return ec2client.modify_listener(ListenerArn=ARN, DefaultActions=Actions)
+    return ec2client.modify_rule(RuleArn=ARN, Actions=Actions)
+
+def ApplyActions(Pool, Region, Changes):
+    # Changes = [(Kind, ARN, Label, Actions)], all modify calls in flight together. Returns True if all done.
+    OK = True
+    Start = time.perf_counter()
+    for (Kind, ARN, Label, Actions), (Result, ERR) in zip(Changes, Pool.Map((Region, ModifyAction, Region, Kind, ARN, Actions) for Kind, ARN, Label, Actions in Changes)):
+        if ERR:
+            print ("  ERROR: Failed to modify {} {} \n  Exception={}" .format(Kind, Label, ERR))
+            OK = False
+        else:
+            print (" SUCCESS : {} {} now forwards to {}" .format(Kind, Label, DescribeForward(Actions)))
+    print ("\n INFO : {} modify calls in {:.2f}s" .format(len(Changes), time.perf_counter() - Start))
+    return OK
+
+def SwitchRollback(Pool, Region, ALB):
+    # Saved state is removed once every listener/rule is restored, kept for another --rollback on failure
+    State = SavedSwitch(Region, ALB)
+    if State is None:
+        print ("\n ERROR : No saved switch for ALB {} in {}\n" .format(ALB, Region))
+        exit()
+    print ("\n INFO : Restoring ALB {} listeners to state saved {}" .format(ALB, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(State['Time']))))
+    Topo.Invalidate(Region, ALB)
+    OK = ApplyActions(Pool, Region, [tuple(X) for X in State['Changes']])
+    if OK:
+        os.remove(SwitchState(Region, ALB))
+    return OK
+
+def SwitchTarget(Pool, Region, ALB):
+    # Listener default actions (and with --rules, rules) of ALB forwarding to --from moved to --to
+    Found, Failed = Topo.ResolveTargetGroups([X for X in (args.to, args.source) if X], Region)
+    for TG, ERR in Failed.items():
+        print ("  ERROR: Target group {} not found in {}. {}" .format(TG, Region, ERR))
+    if Failed:
+        exit()
+    To = Found[args.to]['Arn']
+    From = Found[args.source]['Arn'] if args.source else None
+
+    # Current listener state, never from cache
+    Topo.Invalidate(Region, ALB)
+    Listeners = [X for X in Topo.Listeners(ALB, Region) if args.port is None or X['Port'] in args.port]
+    if not Listeners:
+        print ("\n ERROR : No listeners on ALB {} in {}{}\n" .format(ALB, Region, " port " + " ".join(map(str, args.port)) if args.port else ""))
+        exit()
+    Candidates = [('listener', X['ListenerArn'], "{}:{}" .format(X['Protocol'], X['Port']), X['DefaultActions']) for X in Listeners]
+    if args.rules:
+        ec2client = DVboto3.SetALBClient(Profile, Region)
+        for X in Listeners:
+            for Rule in [R for Page in ec2client.get_paginator('describe_rules').paginate(ListenerArn=X['ListenerArn']) for R in Page['Rules']]:
+                if not Rule.get('IsDefault'):
+                    Candidates.append(('rule', Rule['RuleArn'], "{}:{} priority {}" .format(X['Protocol'], X['Port'], Rule['Priority']), Rule['Actions']))
+
+    Old, New = [], []
+    for Kind, ARN, Label, Actions in Candidates:
+        Current = [X for X in Forwards(Actions) if X != To]
+        Source = From or (Current[0] if len(Current) == 1 else None)
+        if From is None and len(Current) > 1:
+            print ("  WARNING : {} {} forwards to {}, use --from to pick one. Skipped" .format(Kind, Label, " ".join(TGName(X) for X in Current)))
+            continue
+        if Source is None or Source not in Current:
+            continue
+        Changed = SwitchActions(Actions, Source, To, args.weight)
+        if Changed != Actions:
+            Old.append((Kind, ARN, Label, Actions))
+            New.append((Kind, ARN, Label, Changed))
+            print (" INFO : {} {} : {} -> {}" .format(Kind, Label, DescribeForward(Actions), DescribeForward(Changed)))
+    if not New:
+        print ("\n INFO : Nothing to switch on ALB {}, no listener forwards to {}\n" .format(ALB, args.source or "another target group"))
+        return True
+
+    # New target group must be able to take traffic, --prewarm waits for all its targets
+    Targets = GetTargetHealth(To, Region)
+    # --wait 0 skips the wait, then --to is checked for a healthy target as without --prewarm
+    if args.prewarm and Targets and args.wait != 0:
+        Watch = dvclass.Converge.FromArgs(Profile, args, Pool)
+        Watch.AddTG(ALB, args.to, To, Region, [X['Target']['Id'] for X in Targets], True)
+        if not Watch.Report(ams):
+            print ("\n ERROR : Target group {} not fully healthy, not switching\n" .format(args.to))
+            exit(1)
+    elif not args.force and not any(X['TargetHealth'].get('State') == 'healthy' for X in Targets):
+        print ("\n ERROR : Target group {} has no healthy targets, use --prewarm or --force\n" .format(args.to))
+        exit(1)
+
+    # Switch again before rollback keeps the first saved actions of each listener/rule, so --rollback
+    # always goes back to the state before the first switch.
+    State = SavedSwitch(Region, ALB) or {'Time': time.time(), 'Changes': []}
+    Saved = set(X[1] for X in State['Changes'])
+    State['Changes'] += [X for X in Old if X[1] not in Saved]
+    os.makedirs(Topo.Dir, exist_ok=True)
+    dvclass.CMDBBuilder.Write(SwitchState(Region, ALB), json.dumps(State))
+    OK = ApplyActions(Pool, Region, New)
+    Topo.Invalidate(Region, ALB)
+    return OK
 
 # -----********------  End of Functions -----********------
 
@@ -257,8 +573,12 @@ def main():
     global Profile
     global DVboto3
     global ams
+    global Topo
+    dvclass.AsyncLB.Check(args)
     DVboto3 = dvclass.AWSBoto3()
     ams = dvclass.AMSCMDB()
+    Topo = dvclass.ALBTopology.FromArgs(Profile, args)
+    dvclass.APITrace.FromArgs(args)
 
 
     if args.Task == "list":
@@ -274,8 +594,9 @@ def main():
                 exit()
 
             # At this stage we have Result with VPC and Region information
-            # Result can have multiple entries for multiple regions
-            for X in Result:
+            # Result can have multiple entries for multiple regions, load each region once concurrently
+            Topo.Prefetch(X.split()[1] for X in Result)
+            for X in sorted(Result):
                 Y = X.split()
                 VPC = Y[0]
                 REGION = Y[1]
@@ -302,129 +623,143 @@ def main():
                 print ("\n ERROR : Topology not found in CMDB or it is not AWS Topology \n")
                 exit()
 
-            for X in Result:
+            # Collect ALB of every VPC first, then status of all ALB in one concurrent pass
+            Topo.Prefetch((X.split()[1] for X in Result), dvclass.FanOut.FromArgs(args))
+            ALBList = []
+            for X in sorted(Result):
                 Y = X.split()
                 VPC = Y[0]
                 REGION = Y[1]
-                # Now for each VPC get list of ALB and status
                 Result = GetAlbList(VPC,REGION)
-                if len(Result) is not 0:
-                # Now have ALB and ARN. now identify TG associated with ARN and status
+                if len(Result) != 0:
                     for ALB,ARN in Result:
-                        # print("\tStatus of ALB {} in {} " .format(ALB, VPC))
-                        Albstatus(ALB, ARN, REGION)
+                        ALBList.append((ALB, ARN, REGION))
                 else:
                     print ("\t No ALB found in {} with Profile={}" .format(VPC, Profile, REGION))
 
+            AlbStatusAll(ALBList)
             exit()
 
 
-    elif args.Task == "attach":
-        # If TG is specified, action only for that TG.
+    elif args.Task in ("attach", "detach"):
+        # If TG is specified, action only for those TG.
         # ALB and Instances from arguments.  
-        # Get region and VPC info based on Hostname
-        # Get ALB ARN, then list of TG with its ARN, then action.
+        # Hosts split by region using CMDB, ALB and TG names resolved in each region.
+        # Every region runs on its own worker, output merged in region order.
         
-        # Find and ensure all hosts are in same region
-        Region = FindELBRegion(args.instances)
-        
-        # Save all instance ID to list for function.
-        InstanceList = []
-        for I in args.instances:
-            InstID = ams.GetInstID(I)
-            X = {}
-            X = {'Id': InstID}
-            InstanceList.append(X)
-        if args.target_group is None:
-            for ALB in args.alb:
-                # first get ALB ARN, Target Grups and Its ARN
-                ALBARN = GetALBARN(ALB, Region)
-                # With ALBARN Loop through Target Group
-                Result = GetTGNameARN(ALBARN, Region)
-                # print(f' INFO: Processing {ALB}')
-                # Result will have list of TG and TG ARN get status
-                try:
-                    for TGNAME,TGARN in Result:
-                        # Perfor attach action on all Target Groups
-                        RegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList)
-                except Exception as ERR:
-                    print(f'\n ERROR: Failed call Register Target function \n Exception: {ERR}')
-
-                # Sleep 10 sec before status print
-                print (f' INFO: Sleeping 10sec before checking status of {ALB}')
-                time.sleep(10)
-                Albstatus(ALB, ALBARN, Region)
-        else:
-            # Process task for single TG specified
-            print("Action for TG")
-            for ALB in args.alb:
-                # first get ALB ARN, Target Grups and Its ARN
-                ALBARN = GetALBARN(ALB, Region)
-                # With ALBARN Loop through Target Group
-                TGARN = GetTGARN(ALB, ALBARN, Region, args.target_group)
-                try:
-                    RegisterTargets(TGARN, args.target_group, ALB, Region, InstanceList)
-                except Exception as ERR:
-                    print(f'\n ERROR: Failed call Register Target function \n Exception: {ERR}')
-
-                # At nd sleep for few min and display status
-                print (f' INFO: Sleeping 10sec before checking status of {ALB}')
-                time.sleep(10)
-                Albstatus(ALB, ALBARN, Region)
+        ByRegion = FindELBRegion(TargetHosts())
+        Pool = dvclass.FanOut.FromArgs(args)
+        Watch = dvclass.Converge.FromArgs(Profile, args, Pool)
+        Attach = args.Task == "attach"
+        Regions = sorted(ByRegion)
+        OK = True
+        for Region, (Result, ERR) in zip(Regions, Pool.Map((Region, RegionTask, Region, ByRegion[Region], Attach) for Region in Regions)):
+            if ERR:
+                print("\n  ERROR: Failed to {} targets in {} \n  Exception={}" .format(args.Task, Region, ERR))
+                OK = False
+                continue
+            Log, Changed, Done = Result
+            OK = OK and Done
+            print("\n  Region {} : {} hosts" .format(Region, len(ByRegion[Region])))
+            for Line in Log:
+                print(Line)
+            for ALB, TGNAME, TGARN in Changed:
+                Watch.AddTG(ALB, TGNAME, TGARN, Region, [X['Id'] for X in ByRegion[Region]], Attach)
+
+        # Poll all changed TG of all regions together until targets are healthy (attach) or drained (detach), print time taken
+        OK = Watch.Report(ams) and OK
+        exit(0 if OK else 1)
+
+    elif args.Task == "rolling":
+        # Hosts taken in batches of --batch. Each batch is deregistered from all TG and drained, hook run,
+        # registered back and waited on until healthy before next batch. Hosts whose removal would leave any of
+        # their TG below --floor percent healthy are skipped to a later batch. Stops at first batch that fails.
+        Records = RollingHosts()
+        Pool = dvclass.FanOut.FromArgs(args)
+        Regions = sorted(set(Var.Region for Var in Records))
+        Logs = dict((Region, []) for Region in Regions)
+        TGMap = {}
+        for Region, (Result, ERR) in zip(Regions, Pool.Map((Region, RegionTGs, Region, Logs[Region]) for Region in Regions)):
+            for Line in Logs[Region]:
+                print(Line)
+            TGMap[Region] = Result or []
+            if ERR or not TGMap[Region]:
+                print ("\n ERROR : No target groups to roll in {}, check ALB / TG names\n" .format(Region))
+                exit()
 
+        Size = BatchSize(len(Records))
+        print ("\n INFO : Rolling {} hosts in batches of {}, keeping {}% of targets healthy" .format(len(Records), Size, args.floor))
+        Timings = []
+        N = 0
+        Failed = None
+        Pending = list(Records)
+        while Pending:
+            Batch = FitBatch(Pending, Size, Capacity(Pool, TGMap))
+            if not Batch:
+                Failed = "taking any of {} out would leave a target group below {}% healthy" .format(" ".join(Var.Hostname for Var in Pending), args.floor)
+                break
+            Number = len(Timings) + 1
+            Entry = {'Batch': Number, 'Hosts': [Var.Hostname for Var in Batch]}
+            Timings.append(Entry)
+            print ("\n ===== Batch {} : {} =====" .format(Number, " ".join(Entry['Hosts'])))
+
+            Start = time.perf_counter()
+            OK = RollingStep(Pool, TGMap, Batch, False)
+            Entry['Drain'] = time.perf_counter() - Start
+            if not OK:
+                Failed = "batch {} did not drain" .format(Number)
+                break
+            if args.hook:
+                Code = RollingHook(Number, Batch)
+                Entry['Hook'] = time.perf_counter() - Start - Entry['Drain']
+                if Code != 0:
+                    Failed = "hook exited {} on batch {}, hosts left detached" .format(Code, Number)
+                    break
+            Mark = time.perf_counter()
+            OK = RollingStep(Pool, TGMap, Batch, True)
+            Entry['Healthy'] = time.perf_counter() - Mark
+            Entry['Total'] = time.perf_counter() - Start
+            if not OK:
+                Failed = "batch {} not healthy after attach" .format(Number)
+                break
+            N += len(Batch)
+            Pending = [Var for Var in Pending if Var not in Batch]
+
+        print ("\n  Batch\tDrain\tHook\tHealthy\tTotal\tHosts")
+        for Entry in Timings:
+            print ("  {}\t{}\t{}\t{}\t{}\t{}" .format(Entry['Batch'], *["{:.1f}s" .format(Entry[K]) if K in Entry else "-" for K in ('Drain', 'Hook', 'Healthy', 'Total')], " ".join(Entry['Hosts'])))
+        if args.record:
+            # One JSON line per batch, failure reason on last batch
+            with open(args.record, 'a') as F:
+                for Entry in Timings:
+                    Line = dict((K, round(V, 3) if isinstance(V, float) else V) for K, V in Entry.items())
+                    Line['Time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                    Line['Failed'] = Failed if Entry is Timings[-1] else None
+                    F.write(json.dumps(Line) + "\n")
+        if Failed:
+            print ("\n ERROR : Rolling stopped, {}. {} of {} hosts done\n" .format(Failed, N, len(Records)))
+            exit(1)
+        print ("\n SUCCESS : Rolled {} hosts in {} batches" .format(len(Records), len(Timings)))
         exit()
 
-
-    elif args.Task == "detach":
-
-        # Find and ensure all hosts are in same region
-        Region = FindELBRegion(args.instances)
-        
-        # Save all instance ID to list for function.
-        InstanceList = []
-        for I in args.instances:
-            InstID = ams.GetInstID(I)
-            X = {}
-            X = {'Id': InstID}
-            InstanceList.append(X)
-        if args.target_group is None:
-            for ALB in args.alb:
-                # first get ALB ARN, Target Grups and Its ARN
-                ALBARN = GetALBARN(ALB, Region)
-                # With ALBARN Loop through Target Group
-                Result = GetTGNameARN(ALBARN, Region)
-                # print(f' INFO: Processing {ALB}')
-                # Result will have list of TG and TG ARN get status
-                try:
-                    for TGNAME,TGARN in Result:
-                        # Perfor attach action on all Target Groups
-                        DeRegisterTargets(TGARN, TGNAME, ALB, Region, InstanceList)
-                except Exception as ERR:
-                    print(f'\n ERROR: Failed call Deregister Target function \n Exception: {ERR}')
-
-                # Sleep 10 sec before status print
-                print (f' INFO: Sleeping 10sec before checking status of {ALB}')
-                time.sleep(10)
-                Albstatus(ALB, ALBARN, Region)
+    elif args.Task == "switch":
+        # Blue/green cutover in one modify call per listener (and rule with --rules) instead of per host
+        # register/deregister. Actions before switch saved, --rollback puts them back without describe calls.
+        Pool = dvclass.FanOut.FromArgs(args)
+        if args.rollback:
+            OK = SwitchRollback(Pool, args.region, args.alb)
+        elif args.to is None:
+            print ("\n ERROR : Please provide \'--to TargetGroup\' or \'--rollback\'\n")
+            exit()
         else:
-            # Process task for single TG specified
-            print("Action for TG")
-            for ALB in args.alb:
-                # first get ALB ARN, Target Grups and Its ARN
-                ALBARN = GetALBARN(ALB, Region)
-                # With ALBARN Loop through Target Group
-                TGARN = GetTGARN(ALB, ALBARN, Region, args.target_group)
-                try:
-                    DeRegisterTargets(TGARN, args.target_group, ALB, Region, InstanceList)
-                except Exception as ERR:
-                    print(f'\n ERROR: Failed call De-register Target function \n Exception: {ERR}')
-
-                # At nd sleep for few min and display status
-                print (f' INFO: Sleeping 10sec before checking status of {ALB}')
-                time.sleep(10)
-                Albstatus(ALB, ALBARN, Region)
-
-        exit()
+            if args.weight is not None and not 0 <= args.weight <= 100:
+                print ("\n ERROR : --weight is percent, 0 to 100\n")
+                exit()
+            if Topo.ALB(args.alb, args.region) is None:
+                print ("\n ERROR : ALB {} not found in {} with Profile={}\n" .format(args.alb, args.region, Profile))
+                exit()
+            OK = SwitchTarget(Pool, args.region, args.alb)
+        exit(0 if OK else 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------------
+# Purpose : Benchmark CMDB load/lookup time for text and compiled CMDB formats.
+# Dependencies: PYTHON -3, dvclass
+# ----------------------------------------------------------------------------
+"""
+Generates synthetic CMDB files and measures cold start of AMSCMDB in a fresh interpreter.
+Cold start = construct AMSCMDB and resolve one host, import of dvclass is excluded.
+text     : CMDB parsed into memory indexes (Cache=False)
+compiled : Memory mapped compiled CMDB, already built. Build time reported separately.
+--memory : Report memory per million rows for list of lines, split lines and CMDBRecord.
+"""
+
+import argparse,os,sys,time,random,tempfile,subprocess,shutil,tracemalloc
+
+SCR_HOME = os.path.dirname(os.path.realpath(__file__))
+
+P = argparse.ArgumentParser(description='Benchmark text vs compiled CMDB cold start')
+P.add_argument('-r', '--rows', nargs='+', type=int, default=[1000, 100000, 1000000], help='Row counts to benchmark, default 1k 100k 1M')
+P.add_argument('-n', '--repeat', type=int, default=3, help='Runs per format, best time reported. Default 3')
+P.add_argument('-m', '--memory', action='store_true', help='Report memory per million rows instead of cold start')
+args = P.parse_args()
+
+REGIONS = [("eu-west-1", "euwest1"), ("eu-central-1", "eucentral1")]
+ROLES = ["Publisher", "Author", "Dispatcher"]
+SIZES = ["m4.large", "m4.xlarge", "m5.large", "m5.xlarge"]
+
+# Child process, time taken by AMSCMDB() and one lookup printed in ms.
+CHILD = """
+import sys,time
+sys.path.insert(0, {home!r})
+import dvclass
+T = time.perf_counter()
+ams = dvclass.AMSCMDB(Path={path!r}, Cache={cache})
+assert ams.GetInstAWS({host!r})
+print((time.perf_counter() - T) * 1000)
+"""
+
+
+def GenerateCMDB(Path, Rows):
+    # Write synthetic CMDB with Rows lines, 3 hosts per topology. Returns a host from middle of file.
+    Random = random.Random(Rows)
+    with open(Path, "w") as FILE:
+        FILE.write("#  Topology  ExtIP INT_IP Hostname Region VPC InstID Insttype Size AZ TopoID Cloud\n")
+        for N in range(Rows):
+            Topo = "dvtopo{}".format(N // 3)
+            Region, Short = REGIONS[(N // 3) % len(REGIONS)]
+            Role = ROLES[N % 3]
+            Host = "{}-{}1{}".format(Topo, Role.lower(), Short)
+            FILE.write("{} 34.{}.{}.{} 10.{}.{}.{} {} {} vpc-{:06x} i-{:017x} {} {} {}a {:x} AWS\n" .format(
+                Topo, Random.randint(0, 255), Random.randint(0, 255), Random.randint(1, 254),
+                Random.randint(0, 255), Random.randint(0, 255), Random.randint(1, 254),
+                Host, Region, N // 3, Random.getrandbits(68), Role, Random.choice(SIZES), Region, Random.getrandbits(80)))
+            if N == Rows // 2:
+                Middle = Host
+    return Middle
+
+
+def ColdStart(Path, Cache, Host):
+    # Best of args.repeat runs in fresh interpreter
+    Code = CHILD.format(home=SCR_HOME, path=Path, cache=Cache, host=Host)
+    Best = None
+    for _ in range(args.repeat):
+        Out = subprocess.run([sys.executable, "-c", Code], check=True, capture_output=True, text=True).stdout
+        MS = float(Out.split()[-1])
+        Best = MS if Best is None else min(Best, MS)
+    return Best
+
+
+def Measure(Func):
+    # Return bytes still allocated by object returned from Func
+    tracemalloc.start()
+    Obj = Func()
+    Size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del Obj
+    return Size
+
+
+def MemoryReport(Path, Rows, dvclass):
+    # Memory per million rows for each in memory representation of CMDB
+    def Lines():
+        with open(Path) as FILE:
+            return FILE.readlines()
+    Per = 1000000 / Rows
+    Base = Measure(Lines)
+    print("  {:>9}  {:>12.0f}  {:>12.0f}  {:>12.0f}" .format(Rows, Base * Per / 2**20,
+        Measure(lambda: [Line.split() for Line in Lines()]) * Per / 2**20,
+        Measure(lambda: dvclass.AMSCMDB(Path=Path, Cache=False).Records) * Per / 2**20))
+
+
+def main():
+    sys.path.insert(0, SCR_HOME)
+    import dvclass
+    TMP = tempfile.mkdtemp(prefix="cmdbbench")
+    try:
+        if args.memory:
+            print("\n  MB per million rows")
+            print("  {:>9}  {:>12}  {:>12}  {:>12}" .format("Rows", "Lines", "Split", "CMDBRecord"))
+            for Rows in args.rows:
+                Path = os.path.join(TMP, "cmdb{}.txt" .format(Rows))
+                GenerateCMDB(Path, Rows)
+                MemoryReport(Path, Rows, dvclass)
+            print("")
+            return
+        print("\n  {:>9}  {:>12}  {:>12}  {:>12}  {:>9}" .format("Rows", "Text(ms)", "Compiled(ms)", "Build(ms)", "Speedup"))
+        for Rows in args.rows:
+            Path = os.path.join(TMP, "cmdb{}.txt" .format(Rows))
+            Host = GenerateCMDB(Path, Rows)
+            T = time.perf_counter()
+            dvclass.CMDBCache(Path).Load()
+            Build = (time.perf_counter() - T) * 1000
+            Text = ColdStart(Path, False, Host)
+            Compiled = ColdStart(Path, True, Host)
+            print("  {:>9}  {:>12.1f}  {:>12.1f}  {:>12.1f}  {:>8.0f}x" .format(Rows, Text, Compiled, Build, Text / Compiled))
+        print("")
+    finally:
+        shutil.rmtree(TMP)
+
+
+if __name__ == "__main__":
+    main()
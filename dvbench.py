@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------------
+# Purpose : Benchmark albctl/elbctl/ec2ctl/dvsnaps/lb-whitelistcheck against local moto server.
+# Dependencies: PYTHON -3, Boto3, moto[server]
+# ----------------------------------------------------------------------------
+"""
+For each fleet size a synthetic CMDB is generated and a local moto server seeded with matching instances,
+ALBs with target groups, classic ELBs and snapshots. Every command is then run end to end
+against the server and wall time plus AWS API call count reported.
+API calls are counted with botocore client side monitoring (AWS_CSM_*), so scripts need no change.
+Benchmark topology 'dvbench0' spans eu-west-1 and eu-central-1 and owns all load balancers.
+dnsctl is not benchmarked, it needs Route53 zone IDs filled in (XXXXX defaults) before it runs at all.
+"""
+
+import argparse,os,sys,time,json,socket,threading,tempfile,subprocess,shutil,logging,importlib.util
+
+try:
+    import boto3
+except Exception as ERR:
+    print(f' ERROR: Failed to import module. {ERR}' )
+    exit()
+
+SCR_HOME = os.path.dirname(os.path.realpath(__file__))
+
+P = argparse.ArgumentParser(description='Benchmark CLIs against local AWS stand-in (moto server)')
+P.add_argument('--hosts', nargs='+', type=int, default=[1000, 10000, 100000], help='CMDB/fleet sizes, default 1000 10000 100000')
+P.add_argument('--topo-hosts', type=int, default=20, help='Hosts in benchmark topology, default 20')
+P.add_argument('--albs', type=int, default=20, help='ALBs per region for benchmark topology, 2 target groups each. Default 20')
+P.add_argument('--elbs', type=int, default=20, help='Classic ELBs per region for benchmark topology. Default 20')
+P.add_argument('--snaps', type=int, default=200, help='Snapshots of benchmarked volume, default 200')
+P.add_argument('--endpoint', help='Use running moto server instead of starting one, eg http://localhost:5000')
+P.add_argument('--timeout', type=int, default=900, help='Timeout per command in seconds, default 900')
+P.add_argument('--json', help='Append results as JSON lines to file')
+args = P.parse_args()
+
+REGIONS = ["eu-west-1", "eu-central-1"]
+ROLES = ["Dispatcher", "Publisher", "Author"]
+TOPO = "dvbench0"
+
+
+class CSMCounter:
+    # Receives botocore client side monitoring datagrams and counts ApiCall events per Service.Api
+    def __init__(self):
+        self.Sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.Sock.bind(("127.0.0.1", 0))
+        self.Port = self.Sock.getsockname()[1]
+        self.Lock = threading.Lock()
+        self.Calls = {}
+        threading.Thread(target=self.Listen, daemon=True).start()
+
+    def Listen(self):
+        while True:
+            Data = json.loads(self.Sock.recv(65536))
+            if Data.get('Type') == 'ApiCall':
+                Key = "{}.{}" .format(Data.get('Service'), Data.get('Api'))
+                with self.Lock:
+                    self.Calls[Key] = self.Calls.get(Key, 0) + 1
+
+    def Take(self):
+        # Return and reset counts. Short pause lets last datagrams arrive.
+        time.sleep(0.2)
+        with self.Lock:
+            Calls, self.Calls = self.Calls, {}
+        return Calls
+
+
+def Seed(Endpoint, Hosts, TMP):
+    # Seed moto and write matching CMDB. Returns CMDB path and dict of names used by commands
+    PostURL(Endpoint + "/moto-api/reset")
+    Rows = []
+    Names = {}
+    N = 0
+    for Region in REGIONS:
+        ec2 = boto3.client('ec2', region_name=Region, endpoint_url=Endpoint)
+        VPC = ec2.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+        Subnets = [ec2.create_subnet(VpcId=VPC, CidrBlock='10.0.{}.0/24' .format(240 + I), AvailabilityZone=Region + AZ)['Subnet']['SubnetId']
+                   for I, AZ in enumerate("ab")]
+        SG = ec2.create_security_group(GroupName='dvbench', Description='dvbench', VpcId=VPC)['GroupId']
+        ec2.authorize_security_group_ingress(GroupId=SG, IpPermissions=[{'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443, 'IpRanges': [{'CidrIp': '10.1.0.0/16'}]}])
+
+        # Benchmark topology hosts first, each with data volume on /dev/xvdba
+        Count = args.topo_hosts // len(REGIONS)
+        Res = ec2.run_instances(ImageId='ami-12c6146b', MinCount=Count, MaxCount=Count, InstanceType='m4.large', SubnetId=Subnets[0],
+                                BlockDeviceMappings=[{'DeviceName': '/dev/xvdba', 'Ebs': {'VolumeSize': 10}}])
+        Topo = [(TOPO, I) for I in Res['Instances']]
+        # Rest of fleet, 1000 per call, 3 hosts per topology. New /20 subnet every 4000 hosts, 10.0.0.0 - 10.0.239.255 usable
+        Rest = Hosts // len(REGIONS) - Count
+        K = 0
+        while Rest > 0:
+            if K % 4 == 0:
+                Fleet = ec2.create_subnet(VpcId=VPC, CidrBlock='10.0.{}.0/20' .format(K // 4 * 16), AvailabilityZone=Region + "b")['Subnet']['SubnetId']
+            Batch = min(Rest, 1000)
+            Res = ec2.run_instances(ImageId='ami-12c6146b', MinCount=Batch, MaxCount=Batch, InstanceType='m5.large', SubnetId=Fleet)
+            Topo.extend(("dvfleet{}" .format((N + K) // 3), I) for K, I in enumerate(Res['Instances']))
+            N += Batch
+            Rest -= Batch
+            K += 1
+        for K, (Name, I) in enumerate(Topo):
+            Role = ROLES[K % 3]
+            Host = "{}-{}{}{}" .format(Name, Role.lower(), K, Region.replace("-", ""))
+            Rows.append(" ".join([Name, "34.0.{}.{}" .format(K // 250, K % 250 + 1), I['PrivateIpAddress'], Host, Region, VPC, I['InstanceId'],
+                                  Role, I['InstanceType'], I['Placement']['AvailabilityZone'], "{:x}" .format(K), "AWS"]))
+            if Name == TOPO:
+                Names.setdefault('hosts', []).append(Host)
+                Names.setdefault('instances', []).append(I['InstanceId'])
+
+        # Load balancers of benchmark topology
+        InstIDs = [I['InstanceId'] for Name, I in Topo if Name == TOPO]
+        elbv2 = boto3.client('elbv2', region_name=Region, endpoint_url=Endpoint)
+        for A in range(args.albs):
+            ARN = elbv2.create_load_balancer(Name="{}-alb{}" .format(TOPO, A), Subnets=Subnets, SecurityGroups=[SG])['LoadBalancers'][0]['LoadBalancerArn']
+            for T in range(2):
+                TG = elbv2.create_target_group(Name="{}-{}-tg{}-{}" .format(TOPO, Region[3:7], A, T), Protocol='HTTP', Port=80 + T, VpcId=VPC)['TargetGroups'][0]['TargetGroupArn']
+                elbv2.create_listener(LoadBalancerArn=ARN, Protocol='HTTP', Port=80 + T, DefaultActions=[{'Type': 'forward', 'TargetGroupArn': TG}])
+                elbv2.register_targets(TargetGroupArn=TG, Targets=[{'Id': X} for X in InstIDs])
+            Names['alb'] = "{}-alb{}" .format(TOPO, A)
+        elb = boto3.client('elb', region_name=Region, endpoint_url=Endpoint)
+        for E in range(args.elbs):
+            elb.create_load_balancer(LoadBalancerName="{}-elb{}" .format(TOPO, E), Subnets=Subnets[:1], SecurityGroups=[SG],
+                                     Listeners=[{'Protocol': 'HTTP', 'LoadBalancerPort': 80, 'InstancePort': 80}])
+            elb.register_instances_with_load_balancer(LoadBalancerName="{}-elb{}" .format(TOPO, E), Instances=[{'InstanceId': X} for X in InstIDs])
+
+        # Snapshots of first benchmark host data volume
+        if Region == REGIONS[0]:
+            Vol = [V for V in ec2.describe_volumes(Filters=[{'Name': 'attachment.instance-id', 'Values': InstIDs[:1]}])['Volumes']
+                   if V['Attachments'][0]['Device'] == '/dev/xvdba'][0]['VolumeId']
+            for S in range(args.snaps):
+                ec2.create_snapshot(VolumeId=Vol, Description="dvbench {}" .format(S))
+
+    Path = os.path.join(TMP, "mscallenv{}.txt" .format(Hosts))
+    with open(Path, "w") as FILE:
+        FILE.write("\n".join(Rows) + "\n")
+    return Path, Names
+
+
+def PostURL(URL):
+    import urllib.request
+    urllib.request.urlopen(urllib.request.Request(URL, data=b"", method="POST")).read()
+
+
+def Commands(Names):
+    # --async cases only when aiobotocore is installed, without it they fail before any call
+    Async = importlib.util.find_spec("aiobotocore") is not None
+    return [X for X in [
+        ("albctl status", ["albctl.py", "status", "-t", TOPO]),
+        ("albctl status --async", ["albctl.py", "status", "-t", TOPO, "--async"]) if Async else None,
+        ("elbctl status", ["elbctl.py", "status", "-t", TOPO]),
+        ("elbctl status --async", ["elbctl.py", "status", "-t", TOPO, "--async"]) if Async else None,
+        ("ec2ctl topo", ["ec2ctl.py", "topo", "-t", TOPO]),
+        ("dvsnaps list", ["dvsnaps.py", "list", "-s", Names['hosts'][0]]),
+        ("lb-whitelistcheck albcheck", ["lb-whitelistcheck.py", "albcheck", "-l", Names['alb'], "-s", "10.1.2.3", "192.168.1.1"]),
+    ] if X]
+
+
+def Environment(Endpoint, Path, TMP, Counter):
+    Env = dict(os.environ)
+    with open(os.path.join(TMP, "credentials"), "w") as FILE:
+        FILE.write("[default]\naws_access_key_id = dvbench\naws_secret_access_key = dvbench\n")
+    with open(os.path.join(TMP, "config"), "w") as FILE:
+        FILE.write("[default]\nregion = eu-west-1\n")
+    Env.update({'AWS_ENDPOINT_URL': Endpoint, 'AWS_SHARED_CREDENTIALS_FILE': os.path.join(TMP, "credentials"),
+                'AWS_CONFIG_FILE': os.path.join(TMP, "config"), 'DV_CMDB': Path,
+                'AWS_CSM_ENABLED': 'true', 'AWS_CSM_PORT': str(Counter.Port), 'AWS_CSM_CLIENT_ID': 'dvbench',
+                'DV_CACHE': os.path.join(TMP, "cache")})
+    return Env
+
+
+def main():
+    Server = None
+    Endpoint = args.endpoint
+    if Endpoint is None:
+        try:
+            from moto.server import ThreadedMotoServer
+        except Exception as ERR:
+            print(f' ERROR: moto server not available, pip install "moto[server]" or use --endpoint. {ERR}')
+            exit(1)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        Server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+        Server.start()
+        Host, Port = Server.get_host_and_port()
+        Endpoint = "http://{}:{}" .format(Host, Port)
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'dvbench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'dvbench')
+    Counter = CSMCounter()
+    TMP = tempfile.mkdtemp(prefix="dvbench")
+    try:
+        print("\n  INFO : dnsctl skipped, its zone ID defaults (XXXXX) must be set before it can run")
+        if importlib.util.find_spec("aiobotocore") is None:
+            print("  INFO : --async status skipped, aiobotocore not installed")
+        print("\n  {:>7}  {:<28} {:>5} {:>9} {:>9} {:>8}  {}" .format("Hosts", "Command", "Exit", "Wall(s)", "APICalls", "Calls/s", "Top calls / error"))
+        for Hosts in args.hosts:
+            T = time.perf_counter()
+            Path, Names = Seed(Endpoint, Hosts, TMP)
+            print("  {:>7}  {:<28} {:>5} {:>9.1f}" .format(Hosts, "(seed)", "", time.perf_counter() - T))
+            Env = Environment(Endpoint, Path, TMP, Counter)
+            for Name, Cmd in Commands(Names):
+                # Every command starts with empty ALB topology cache
+                shutil.rmtree(Env['DV_CACHE'], ignore_errors=True)
+                Counter.Take()
+                T = time.perf_counter()
+                try:
+                    Proc = subprocess.run([sys.executable, os.path.join(SCR_HOME, Cmd[0])] + Cmd[1:], env=Env, cwd=TMP, stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=args.timeout)
+                    Code = Proc.returncode
+                    Lines = Proc.stdout.decode(errors="replace").strip().splitlines()
+                    Note = Lines[-1].strip() if Code and Lines else ""
+                except subprocess.TimeoutExpired:
+                    Code, Note = "T/O", ""
+                Wall = time.perf_counter() - T
+                Calls = Counter.Take()
+                Top = ", ".join("{}={}" .format(K, V) for K, V in sorted(Calls.items(), key=lambda X: -X[1])[:3])
+                print("  {:>7}  {:<28} {:>5} {:>9.2f} {:>9} {:>8.0f}  {}" .format(Hosts, Name, Code, Wall, sum(Calls.values()), sum(Calls.values()) / Wall, Note or Top))
+                if args.json:
+                    with open(args.json, "a") as FILE:
+                        FILE.write(json.dumps({'Hosts': Hosts, 'Command': Name, 'Exit': Code, 'Wall': Wall, 'Calls': Calls, 'Note': Note}) + "\n")
+        print("")
+    finally:
+        shutil.rmtree(TMP)
+        if Server:
+            Server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,109 +13,1593 @@
 #   0          1    2.        3.     4.    5.   6.      7.      8.  9. 10.     11   
 #  Topology  ExtIP INT_IP Hostname Region VPC InstID Insttype Size AZ TopoID Cloud
 
-import re,os,sys,boto3
+import re,os,sys,boto3,argparse,threading,atexit,time,math
+from functools import partial
+import mmap,struct,hashlib,tempfile,json,fnmatch,sqlite3,datetime
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from array import array
+import asyncio
+from contextlib import AsyncExitStack
+# aiobotocore is optional, only needed for --async
+try:
+    from aiobotocore.session import AioSession
+except ImportError:
+    AioSession = None
+
+
+class CMDBRecord:
+    # One CMDB row, one slot per column so Var.Hostname is a plain attribute read, split once at load.
+    # Repeated column values are interned so every row of a region/topology/size shares one string object.
+    # Index access (Var[3]) kept so code written for split lines continues to work.
+    __slots__ = ('Topology', 'ExtIP', 'INT_IP', 'Hostname', 'Region', 'VPC', 'InstID', 'Insttype', 'Size', 'AZ', 'TopoID', 'Cloud')
+    COLUMNS = __slots__
+    INTERN = (0, 4, 5, 7, 8, 9, 11)
+
+    def __init__(self, Var):
+        # Var is split line or line
+        Var = (Var.split() if isinstance(Var, str) else list(Var))[:12]
+        for N in self.INTERN:
+            Var[N] = sys.intern(Var[N])
+        for Name, Value in zip(self.COLUMNS, Var):
+            setattr(self, Name, Value)
+
+    def __getitem__(self, N):
+        return getattr(self, self.COLUMNS[N])
+
+    def __len__(self):
+        return len(self.COLUMNS)
+
+    def __iter__(self):
+        return (getattr(self, Name) for Name in self.COLUMNS)
+
+    def __repr__(self):
+        return " ".join(self)
+
+
+def CMDBKeyHash(Key):
+    # Stable 64bit hash of namespaced key (bytes) for compiled CMDB. 0 is reserved for empty slot.
+    H = int.from_bytes(hashlib.blake2b(Key, digest_size=8).digest(), 'little')
+    return H or 1
+
+
+class CMDBCache:
+    # Compiled form of text CMDB, memory mapped so only pages touched by a lookup are read.
+    # Rebuilt when mtime/size of text file changes and content hash is different.
+    # Layout : Header | CMDB lines | Row offsets (Q) | Hash slots (Q hash, I start, I count) | Postings (I row) | Values (json)
+    # Namespace K = point lookup (Hostname, InstID, ExtIP, INT_IP), others are secondary indexes on named column.
+    # Values holds distinct values of each secondary index, used to expand glob patterns.
+    MAGIC = b'DVCMDB02'
+    HEADER = struct.Struct('<8sqq20sIIQQQQ')
+    SLOT = struct.Struct('<QII')
+    COLUMNS = {b'K': (3, 6, 1, 2), b'Topology': (0,), b'Region': (4,), b'Insttype': (7,), b'Size': (8,), b'AZ': (9,), b'Cloud': (11,)}
+
+    def __init__(self, Conf, Path=None):
+        self.Conf = Conf
+        self.Path = Path or os.path.splitext(Conf)[0] + ".cdb"
+        self.MM = None
+
+    def ReadHeader(self):
+        try:
+            with open(self.Path, "rb") as FILE:
+                Head = self.HEADER.unpack(FILE.read(self.HEADER.size))
+        except (OSError, struct.error):
+            return None
+        if Head[0] != self.MAGIC:
+            return None
+        return Head
+
+    def Load(self):
+        # Validate compiled file against text CMDB, recompile if required and map it.
+        St = os.stat(self.Conf)
+        Head = self.ReadHeader()
+        if Head is None or Head[1] != St.st_mtime_ns or Head[2] != St.st_size:
+            with open(self.Conf, "rb") as FILE:
+                Data = FILE.read()
+            Sha = hashlib.sha1(Data).digest()
+            if Head is not None and Head[3] == Sha:
+                # Only mtime changed, content same. Refresh stamp and reuse.
+                self.Stamp(St)
+            else:
+                self.Compile(Data, St, Sha)
+        self.Open()
+
+    def Stamp(self, St):
+        try:
+            with open(self.Path, "r+b") as FILE:
+                FILE.seek(len(self.MAGIC))
+                FILE.write(struct.pack('<qq', St.st_mtime_ns, St.st_size))
+        except OSError:
+            pass
+
+    def Compile(self, Data, St, Sha):
+        # Parse text CMDB and write compiled file atomically, readers never see half written file.
+        Rows = []
+        Keys = {}
+        for Line in Data.splitlines():
+            Var = Line.split()
+            if len(Var) < 12 or Var[0].startswith(b'#') or Var[11] != b'AWS':
+                continue
+            N = len(Rows)
+            Rows.append(Line.strip() + b'\n')
+            for Ns, Cols in self.COLUMNS.items():
+                for C in Cols:
+                    LIST = Keys.setdefault(Ns + b'\0' + Var[C], [])
+                    if not LIST or LIST[-1] != N:
+                        LIST.append(N)
+
+        Offsets = array('Q', [0])
+        for Line in Rows:
+            Offsets.append(Offsets[-1] + len(Line))
+
+        NSlots = 8
+        while NSlots < 2 * len(Keys):
+            NSlots *= 2
+        Mask = NSlots - 1
+        Used = bytearray(NSlots)
+        Slots = bytearray(self.SLOT.size * NSlots)
+        Postings = array('I')
+        for Key, LIST in Keys.items():
+            H = CMDBKeyHash(Key)
+            S = H & Mask
+            while Used[S]:
+                S = (S + 1) & Mask
+            Used[S] = 1
+            self.SLOT.pack_into(Slots, S * self.SLOT.size, H, len(Postings), len(LIST))
+            Postings.extend(LIST)
+
+        Values = {}
+        for Key in Keys:
+            Ns, Value = Key.split(b'\0', 1)
+            if Ns != b'K':
+                Values.setdefault(Ns.decode(), []).append(Value.decode())
+        Values = json.dumps(Values).encode()
+
+        RowOff = self.HEADER.size + Offsets[-1]
+        SlotOff = RowOff + Offsets.itemsize * len(Offsets)
+        PostOff = SlotOff + len(Slots)
+        ValOff = PostOff + Postings.itemsize * len(Postings)
+        Head = self.HEADER.pack(self.MAGIC, St.st_mtime_ns, St.st_size, Sha, len(Rows), NSlots, RowOff, SlotOff, PostOff, ValOff)
+
+        Fd, Tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.Path)), prefix=".cdb")
+        try:
+            # mkstemp creates 0600, compiled file is shared by every user who can read the text CMDB
+            os.fchmod(Fd, St.st_mode & 0o777)
+            with os.fdopen(Fd, "wb") as FILE:
+                FILE.write(Head)
+                FILE.write(b''.join(Rows))
+                FILE.write(Offsets.tobytes())
+                FILE.write(Slots)
+                FILE.write(Postings.tobytes())
+                FILE.write(Values)
+            os.replace(Tmp, self.Path)
+        except BaseException:
+            os.unlink(Tmp)
+            raise
+
+    def Open(self):
+        FILE = open(self.Path, "rb")
+        try:
+            self.MM = mmap.mmap(FILE.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            FILE.close()
+        Head = self.HEADER.unpack_from(self.MM, 0)
+        self.NRows, self.NSlots, self.RowOff, self.SlotOff, self.PostOff, self.ValOff = Head[4:]
+        self.ValueMap = None
+
+    def Row(self, N):
+        # Return CMDB row N as CMDBRecord
+        Start, End = struct.unpack_from('<QQ', self.MM, self.RowOff + 8 * N)
+        return CMDBRecord(self.MM[self.HEADER.size + Start:self.HEADER.size + End].decode())
+
+    def Records(self):
+        # Return all rows, this reads whole mapped CMDB.
+        return [CMDBRecord(Line) for Line in self.MM[self.HEADER.size:self.RowOff].decode().splitlines()]
+
+    def Values(self, Column):
+        # Distinct values of indexed column, loaded on first use
+        if self.ValueMap is None:
+            self.ValueMap = json.loads(self.MM[self.ValOff:].decode())
+        return self.ValueMap.get(Column, [])
+
+    def Get(self, Ns, Key):
+        # Return list of row numbers for Key in namespace Ns, empty list if not found.
+        H = CMDBKeyHash(Ns + b'\0' + Key.encode())
+        Mask = self.NSlots - 1
+        S = H & Mask
+        while True:
+            SH, Start, Count = self.SLOT.unpack_from(self.MM, self.SlotOff + S * self.SLOT.size)
+            if SH == 0:
+                return []
+            if SH == H:
+                LIST = struct.unpack_from('<%dI' % Count, self.MM, self.PostOff + 4 * Start)
+                Var = self.Row(LIST[0])
+                # Guard against hash collision
+                if any(Var[C] == Key for C in self.COLUMNS[Ns]):
+                    return list(LIST)
+            S = (S + 1) & Mask
 
 
 
 class AMSCMDB:
-    def __init__(self):
+    # Columns with secondary index, usable in Query() without scanning CMDB
+    INDEXED = ('Topology', 'Region', 'Insttype', 'Size', 'AZ', 'Cloud')
+
+    def __init__(self, Path=None, Cache=True):
         global SCR_HOME
         global Conf
-        # Load the configuration file and store in Variable called CMDB
+        # CMDB is text file next to this script unless DV_CMDB or Path provided.
         SCR_HOME = os.path.dirname(os.path.realpath(__file__))
-        Conf = SCR_HOME + "/mscallenv.txt"
-        try:
-            global CMDB
-            FILE = open(Conf, "r")
-            CMDB = FILE.readlines()
-            FILE.close()
-        except:
-            print (" ERROR : Failed to open CMDB file ", Conf)
-            exit ()
+        Conf = Path or os.environ.get("DV_CMDB") or SCR_HOME + "/mscallenv.txt"
+        # Use compiled CMDB when possible, it is mapped and loaded lazily on lookup.
+        self.Cache = None
+        if Cache:
+            try:
+                self.Cache = CMDBCache(Conf)
+                self.Cache.Load()
+            except Exception:
+                self.Cache = None
+        if self.Cache is None:
+            # Fall back to text CMDB parsed into memory indexes.
+            try:
+                FILE = open(Conf, "r")
+                Lines = FILE.readlines()
+                FILE.close()
+            except:
+                print (" ERROR : Failed to open CMDB file ", Conf)
+                exit ()
+            self.BuildIndex(Lines)
+
+    def BuildIndex(self, Lines):
+        # Only AWS rows are indexed, same as the regex lookups used to do.
+        #   Records : list of CMDBRecord in CMDB order
+        #   Lookup  : Hostname, InstID, ExtIP, INT_IP -> row (first row wins)
+        #   Index   : Column -> Value -> list of row numbers, for INDEXED columns
+        self.Records = []
+        self.Lookup = {}
+        self.Index = dict((Column, {}) for Column in self.INDEXED)
+        for Line in Lines:
+            Var = Line.split()
+            if len(Var) < 12 or Var[0].startswith('#') or Var[11] != 'AWS':
+                continue
+            Var = CMDBRecord(Var)
+            N = len(self.Records)
+            self.Records.append(Var)
+            for Key in (Var.Hostname, Var.InstID, Var.ExtIP, Var.INT_IP):
+                self.Lookup.setdefault(Key, Var)
+            for Column, Index in self.Index.items():
+                Index.setdefault(getattr(Var, Column), []).append(N)
+
+    def FindRow(self, ARG):
+        # Return CMDB row for Hostname, Instance ID or IP. None if not found
+        if self.Cache:
+            LIST = self.Cache.Get(b'K', ARG)
+            return self.Cache.Row(LIST[0]) if LIST else None
+        return self.Lookup.get(ARG)
+
+    def Postings(self, Column, Value):
+        # Row numbers for Value in secondary index of Column
+        if self.Cache:
+            return self.Cache.Get(Column.encode(), Value)
+        return self.Index[Column].get(Value, [])
+
+    def Values(self, Column):
+        # Distinct values of indexed Column
+        if self.Cache:
+            return self.Cache.Values(Column)
+        return list(self.Index[Column])
+
+    def Row(self, N):
+        if self.Cache:
+            return self.Cache.Row(N)
+        return self.Records[N]
+
+    def TopoRows(self, ARG):
+        # Return all CMDB rows for Topology
+        return [self.Row(N) for N in self.Postings('Topology', ARG)]
+
+    def Query(self, **Where):
+        # Multi predicate query, eg Query(Topology='vettomhotfix63', Insttype='Publisher', AZ='eu-west-1a')
+        # Value can be exact, glob pattern ('m4.*') or list of either. Predicates on INDEXED columns are
+        # resolved from secondary indexes and intersected smallest first, other columns filter the result.
+        Sets = []
+        Rest = {}
+        for Column, Value in Where.items():
+            if Value is None:
+                continue
+            if Column not in self.INDEXED:
+                Rest[Column] = Value
+                continue
+            Rows = set()
+            for Pattern in ([Value] if isinstance(Value, str) else Value):
+                if any(C in Pattern for C in '*?['):
+                    for V in self.Values(Column):
+                        if fnmatch.fnmatchcase(V, Pattern):
+                            Rows.update(self.Postings(Column, V))
+                else:
+                    Rows.update(self.Postings(Column, Pattern))
+            Sets.append(Rows)
+
+        if not Sets:
+            Records = self.Cache.Records() if self.Cache else self.Records
+        else:
+            Sets.sort(key=len)
+            Rows = Sets[0]
+            for S in Sets[1:]:
+                if not Rows:
+                    break
+                Rows = Rows & S
+            Records = [self.Row(N) for N in sorted(Rows)]
+
+        for Column, Value in Rest.items():
+            if Column not in CMDBRecord.COLUMNS:
+                print (" ERROR : Unknown CMDB column {}, valid columns are {}" .format(Column, " ".join(CMDBRecord.COLUMNS)))
+                exit(1)
+            Patterns = [Value] if isinstance(Value, str) else Value
+            Records = [Var for Var in Records if any(fnmatch.fnmatchcase(getattr(Var, Column), P) for P in Patterns)]
+        return Records
+
+    @staticmethod
+    def AddSelectorArgs(Parser, Topology=True):
+        # CMDB selector arguments, accepted by scripts in place of explicit host list.
+        if Topology:
+            Parser.add_argument('--topology', help='CMDB selector: Topology name')
+        Parser.add_argument('--role', help='CMDB selector: Role (Insttype column) eg Dispatcher')
+        Parser.add_argument('--size', help='CMDB selector: Instance size eg m4.large or \'m4.*\'')
+        Parser.add_argument('--az', help='CMDB selector: Availability zone eg eu-west-1a')
+        Parser.add_argument('--region', help='CMDB selector: Region eg eu-central-1')
+        Parser.add_argument('--cloud', help='CMDB selector: Cloud column, AWS')
+
+    @staticmethod
+    def SelectorArgs(args):
+        # Map selector arguments to Query() columns, empty dict if no selector given
+        Where = {'Topology': getattr(args, 'topology', None), 'Insttype': args.role, 'Size': args.size,
+                 'AZ': args.az, 'Region': args.region, 'Cloud': args.cloud}
+        return dict((Column, Value) for Column, Value in Where.items() if Value)
+
+    def ResolveHosts(self, Names):
+        # Resolve list of Hostnames/Instance IDs in one pass, duplicates dropped.
+        # Returns dict {(Region, VPC): [CMDBRecord]} in input order and list of names not found in CMDB
+        Groups = {}
+        Unknown = []
+        Seen = set()
+        for Name in Names:
+            Var = self.FindRow(Name)
+            if Var is None:
+                Unknown.append(Name)
+                continue
+            if Var.InstID in Seen:
+                continue
+            Seen.add(Var.InstID)
+            Groups.setdefault((Var.Region, Var.VPC), []).append(Var)
+        return Groups, Unknown
+
+    def Select(self, **Where):
+        # Filter CMDB on column values. Eg all Dispatchers on m4.large in eu-west-1
+        #   Select(Insttype='Dispatcher', Size='m4.large', Region='eu-west-1')
+        return self.Query(**Where)
 
     def GetHostname(self, ARG):
-        # find and return instance ID from the CMDB
-        try:
-        # Get Instance ID or Hostname as argument and return InstanceID and Hostname
-            for Line in CMDB:   
-                if (re.search('\s%s\s' % ARG, Line)):
-                    if (re.search('\sAWS\s', Line)):
-                        Var = Line.split()
-                        # Region = Var[4]
-                        # instance_id = Var[6]
-                        # AZ = Var[9]
-                        Host = Var[3]
-                        return  Host
-        except Exception as ERR:
-            print(ERR)
-            print (" ERROR : Failed to get instance details, please verify custom environment file is present and upto date")
-            exit(1)
+        # find and return Hostname from the CMDB, accepts Instance ID or Hostname
+        Var = self.FindRow(ARG)
+        if Var:
+            return Var.Hostname
 
     def GetInstID(self, ARG):
-        # find and return instance ID from the CMDB
-        try:
-        # Get Instance ID or Hostname as argument and return InstanceID and Hostname
-            for Line in CMDB:
-                if (re.search('\s%s\s' % ARG, Line)):
-                    if (re.search('\sAWS\s', Line)):
-                        Var = Line.split()
-                        # Region = Var[4]
-                        instance_id = Var[6]
-                        # AZ = Var[9]
-                        Host = Var[3]
-                        return instance_id
-        except Exception as ERR:
-            print(ERR)
-            print (" ERROR : Failed to get instance details, please verify custom environment file is present and upto date")
-            exit(1)
+        # find and return instance ID from the CMDB, accepts Instance ID or Hostname
+        Var = self.FindRow(ARG)
+        if Var:
+            return Var.InstID
 
     def GetInstAWS(self, ARG):
         # Get Instance ID or Hostname as argument, and return Instance_ID, Host,  Region, AZone, VPC
+        Var = self.FindRow(ARG)
+        if Var:
+            return Var.InstID, Var.Hostname, Var.Region, Var.AZ, Var.VPC
+
+    def GetVpcReg(self, ARG):
+        # Accept Topology as argument and return VPC and region as a set of "VPC Region".
+        # Since there can be multiple VPC, result returned as a set.
+        return set("{} {}" .format(Var.VPC, Var.Region) for Var in self.TopoRows(ARG))
+
+    def GetInstanceforTopo(self, ARG):
+        # Accept Topology as argument and return list of Hostnames in CMDB order.
+        return [Var.Hostname for Var in self.TopoRows(ARG)]
+
+
+
+class CMDBBuilder:
+    # Build the 12 column CMDB from live EC2 inventory. Every (profile, region) is fetched in parallel
+    # with paginated describe_instances. Non AWS rows and comment lines of existing CMDB are preserved, as are
+    # existing rows of a (profile, region) that failed, so one bad region does not drop hosts. Output written atomically.
+    # Incremental mode keeps a fingerprint (sorted instance IDs and states from describe_instance_status) and rows
+    # per (profile, region) in OUTPUT.state, and only re-fetches regions whose instance set changed. Tag, IP or type
+    # changes do not move the fingerprint, so rows older than REFRESH are fetched again regardless.
+    TAGS = {'Topology': 'Topology', 'Hostname': 'CMDB_hostname', 'Insttype': 'Role', 'TopoID': 'TopoID'}
+    SKIP_STATES = ('terminated', 'shutting-down')
+    REFRESH = 24 * 3600
+
+    def __init__(self, Profiles, Regions=None, Tags=None, Workers=16, Endpoint=None):
+        self.Profiles = Profiles
+        self.Regions = Regions
+        self.Tags = dict(self.TAGS, **(Tags or {}))
+        self.Workers = Workers
+        self.Endpoint = Endpoint
+
+    def Client(self, Profile, Region):
+        return AWSBoto3().Client('ec2', Profile, Region, self.Endpoint)
+
+    def ListRegions(self, Profile):
+        # Regions enabled for the account unless provided
+        if self.Regions:
+            return self.Regions
+        Result = self.Client(Profile, 'us-east-1').describe_regions()
+        return sorted(X['RegionName'] for X in Result['Regions'])
+
+    def Fingerprint(self, ec2client):
+        # Digest of instance set and states in region, one light paginated call
+        STATUS = []
+        for Page in ec2client.get_paginator('describe_instance_status').paginate(IncludeAllInstances=True):
+            for X in Page['InstanceStatuses']:
+                STATUS.append("{} {}" .format(X['InstanceId'], X['InstanceState']['Name']))
+        return hashlib.sha1("\n".join(sorted(STATUS)).encode()).hexdigest()
+
+    def Row(self, Inst, Region):
+        # Map describe_instances output to CMDB columns. Returns None if instance has no Topology tag
+        Tags = dict((X['Key'], X.get('Value', '')) for X in Inst.get('Tags', []))
+        def Tag(Column, Default="NULL"):
+            return (Tags.get(self.Tags[Column]) or Default).replace(" ", "_")
+        if not Tags.get(self.Tags['Topology']):
+            return None
+        return " ".join([Tag('Topology'), Inst.get('PublicIpAddress', 'NULL'), Inst.get('PrivateIpAddress', 'NULL'),
+                         Tag('Hostname', Inst['InstanceId']), Region, Inst.get('VpcId', 'NULL'), Inst['InstanceId'],
+                         Tag('Insttype'), Inst.get('InstanceType', 'NULL'), Inst['Placement']['AvailabilityZone'],
+                         Tag('TopoID'), "AWS"])
+
+    def Fetch(self, Profile, Region, State=None):
+        # Fetch rows for one profile and region. State is previous {'Fingerprint', 'Time', 'Rows'} when incremental,
+        # returns new state and whether rows were fetched.
+        ec2client = self.Client(Profile, Region)
+        Print = None
+        if State is not None:
+            Print = self.Fingerprint(ec2client)
+            if State.get('Fingerprint') == Print and time.time() - State.get('Time', 0) < self.REFRESH:
+                return State, False
+        Start = time.time()
+        Rows = []
+        for Page in ec2client.get_paginator('describe_instances').paginate():
+            for Res in Page['Reservations']:
+                for Inst in Res['Instances']:
+                    if Inst['State']['Name'] in self.SKIP_STATES:
+                        continue
+                    Line = self.Row(Inst, Region)
+                    if Line:
+                        Rows.append(Line)
+        return {'Fingerprint': Print, 'Time': Start, 'Rows': Rows}, True
+
+    def Build(self, Output, Incremental=False):
+        # Returns list of (Profile, Region) that failed, their rows are kept from existing CMDB
+        StateFile = Output + ".state"
+        State = {}
+        if Incremental:
+            try:
+                with open(StateFile) as FILE:
+                    State = json.load(FILE)
+            except (OSError, ValueError):
+                State = {}
+        Jobs = [(Profile, Region) for Profile in self.Profiles for Region in self.ListRegions(Profile)]
+        Failed = []
+        Rows = {}
+        NewState = {}
+        with ThreadPoolExecutor(max_workers=self.Workers) as Pool:
+            Futures = [(Profile, Region, Pool.submit(self.Fetch, Profile, Region,
+                        State.get("{} {}" .format(Profile, Region), {}) if Incremental else None)) for Profile, Region in Jobs]
+            for Profile, Region, Future in Futures:
+                Key = "{} {}" .format(Profile, Region)
+                try:
+                    Result, Fetched = Future.result()
+                except Exception as ERR:
+                    print (" ERROR : Failed to get instances for Profile={} Region={}, keeping its existing rows \n {}" .format(Profile, Region, ERR))
+                    Failed.append((Profile, Region))
+                    if Key in State:
+                        NewState[Key] = State[Key]
+                    continue
+                LIST = Result['Rows']
+                NewState[Key] = Result
+                print (" INFO : {} {} {} rows{}" .format(Profile, Region, len(LIST), (" (fetched)" if Fetched else " (unchanged)") if Incremental else ""))
+                for Line in LIST:
+                    # Same instance visible from more than one profile is written once
+                    Rows.setdefault(Line.split()[6], Line)
+
+        # Keep comments and non AWS rows from existing CMDB, and AWS rows of failed regions
+        FailedRegions = set(Region for Profile, Region in Failed)
+        Keep = []
         try:
-        # Find the instance from file and ger region and instance ID
-            for Line in CMDB:
-                if (re.search('\s%s\s' % ARG, Line)):
-                    if (re.search('\sAWS\s', Line)):
-                        Var = Line.split()
-                        Region = Var[4]
-                        instance_id = Var[6]
-                        AZ = Var[9]
-                        Host = Var[3]
-                        VPC = Var[5]
-                        return instance_id, Host, Region, AZ, VPC
-        except Exception as ERR:
-            print(ERR)
-            print (" ERROR : Failed to get instance details, please verify custom environment file is present and upto date")
-            exit(1)
+            with open(Output) as FILE:
+                for Line in FILE:
+                    Var = Line.split()
+                    if Var and (Var[0].startswith('#') or len(Var) < 12 or Var[11] != 'AWS'):
+                        Keep.append(Line.rstrip("\n"))
+                    elif Var and Var[4] in FailedRegions:
+                        Rows.setdefault(Var[6], " ".join(Var))
+        except OSError:
+            Keep = ["#  Topology  ExtIP INT_IP Hostname Region VPC InstID Insttype Size AZ TopoID Cloud"]
+        Lines = Keep + sorted(Rows.values(), key=lambda Line: (Line.split()[0], Line.split()[4], Line.split()[3]))
 
+        self.Write(Output, "\n".join(Lines) + "\n")
+        if Incremental:
+            self.Write(StateFile, json.dumps(NewState))
+        print (" INFO : Wrote {} AWS rows to {}" .format(len(Rows), Output))
+        for Profile, Region in Failed:
+            print (" ERROR : Profile={} Region={} not refreshed, rows from previous CMDB kept" .format(Profile, Region))
+        return Failed
 
-    def GetVpcReg(self, ARG):
-        # Accept Topology as argument and return VPC and region as a list.
-        # Since there can be multiple VPC, result returned as a list.
+    @staticmethod
+    def Write(Path, Data):
+        # Atomic replace so running scripts never read half written file. mkstemp creates 0600, file keeps
+        # mode of the file it replaces (0644 if new) so a shared CMDB stays readable by every user.
         try:
-        # Find the instance from file and ger region and instance ID
-            LIST = []
-            for Line in CMDB:
-                # if (re.search('\s%s\s' % ARG, Line)):
-                if (re.search('^%s\s' % ARG, Line)):
-                    if (re.search('\sAWS\s', Line)):
-                        Var = Line.split()
-                        Region = Var[4]
-                        VPC = Var[5]
-                        # print("{} {}" .format(Region, VPC))
-                        LIST.append("{} {}" .format(VPC, Region))
-                # else:
-                #     LIST =  False
-        except Exception as ERR:
-            print(ERR)
-            print (" ERROR : Failed to get Topology details, please verify custom environment file is present and upto date")
+            Mode = os.stat(Path).st_mode & 0o777
+        except OSError:
+            Mode = 0o644
+        Fd, Tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(Path)), prefix=".dvcmdb")
+        try:
+            os.fchmod(Fd, Mode)
+            with os.fdopen(Fd, "w") as FILE:
+                FILE.write(Data)
+            os.replace(Tmp, Path)
+        except BaseException:
+            os.unlink(Tmp)
+            raise
+
+
+
+class CMDBDrift:
+    # Validate CMDB rows against live EC2 in bulk. Instance IDs of each region are checked with
+    # describe_instances in chunks of 1000, all regions/chunks/profiles run concurrently.
+    # Reports hosts missing from EC2, found in another region, terminated, moved AZ, changed type or hostname tag.
+    CHUNK = 1000
+
+    def __init__(self, ams, Profiles, Workers=16, Endpoint=None):
+        self.ams = ams
+        self.Profiles = Profiles
+        self.Workers = Workers
+        self.Endpoint = Endpoint
+
+    def Client(self, Profile, Region):
+        return AWSBoto3().Client('ec2', Profile, Region, self.Endpoint)
+
+    def Describe(self, Profile, Region, IDs):
+        # Return {InstID: Instance} for IDs found. IDs not found are dropped using the IDs in the
+        # NotFound error and the call repeated, so one bad row does not fail the whole chunk.
+        ec2client = self.Client(Profile, Region)
+        Pending = list(IDs)
+        Found = {}
+        while Pending:
+            try:
+                for Page in ec2client.get_paginator('describe_instances').paginate(InstanceIds=Pending):
+                    for Res in Page['Reservations']:
+                        for Inst in Res['Instances']:
+                            Found[Inst['InstanceId']] = Inst
+                break
+            except ClientError as ERR:
+                if ERR.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                    raise
+                Missing = set(re.findall(r'i-[0-9a-f]+', ERR.response['Error'].get('Message', ''))) & set(Pending)
+                if not Missing:
+                    raise
+                Pending = [X for X in Pending if X not in Missing]
+        return Found
+
+    def DescribeAll(self, ByRegion):
+        # ByRegion = {Region: [InstID]}. Returns {Region: {InstID: Instance}}
+        Found = dict((Region, {}) for Region in ByRegion)
+        with ThreadPoolExecutor(max_workers=self.Workers) as Pool:
+            Futures = []
+            for Region, IDs in ByRegion.items():
+                for N in range(0, len(IDs), self.CHUNK):
+                    for Profile in self.Profiles:
+                        Futures.append((Region, Pool.submit(self.Describe, Profile, Region, IDs[N:N + self.CHUNK])))
+            for Region, Future in Futures:
+                Found[Region].update(Future.result())
+        return Found
+
+    def Check(self, Records):
+        # Returns list of (Record, Issue, Detail)
+        Drift = []
+        Valid = []
+        ByRegion = {}
+        for Var in Records:
+            if not re.match(r'^i-[0-9a-f]+$', Var.InstID):
+                Drift.append((Var, "INVALID", "instance id {} is not valid" .format(Var.InstID)))
+                continue
+            Valid.append(Var)
+            ByRegion.setdefault(Var.Region, []).append(Var.InstID)
+        Found = self.DescribeAll(ByRegion)
+
+        # Look for instances not found in CMDB region in every other region of the CMDB
+        Missing = [Var for Var in Valid if Var.InstID not in Found[Var.Region]]
+        Elsewhere = {}
+        if Missing:
+            Other = dict((Region, [Var.InstID for Var in Missing if Var.Region != Region]) for Region in ByRegion)
+            for Region, Insts in self.DescribeAll(dict((R, I) for R, I in Other.items() if I)).items():
+                for InstID, Inst in Insts.items():
+                    Elsewhere[InstID] = (Region, Inst)
+
+        for Var in Valid:
+            Inst = Found[Var.Region].get(Var.InstID)
+            if Inst is None:
+                if Var.InstID in Elsewhere:
+                    Drift.append((Var, "REGION", "CMDB {} found in {}" .format(Var.Region, Elsewhere[Var.InstID][0])))
+                else:
+                    Drift.append((Var, "MISSING", "not found in {}" .format(Var.Region)))
+                continue
+            State = Inst['State']['Name']
+            if State in ('terminated', 'shutting-down'):
+                Drift.append((Var, "TERMINATED", State))
+                continue
+            AZ = Inst['Placement']['AvailabilityZone']
+            if AZ != Var.AZ:
+                Drift.append((Var, "AZ", "CMDB {} live {}" .format(Var.AZ, AZ)))
+            if Inst.get('InstanceType') != Var.Size:
+                Drift.append((Var, "TYPE", "CMDB {} live {}" .format(Var.Size, Inst.get('InstanceType'))))
+            Tags = dict((X['Key'], X.get('Value')) for X in Inst.get('Tags', []))
+            if Tags.get('CMDB_hostname') not in (None, Var.Hostname):
+                Drift.append((Var, "HOSTNAME", "CMDB {} tag {}" .format(Var.Hostname, Tags['CMDB_hostname'])))
+        return Drift
+
+    def Report(self, Records):
+        Drift = self.Check(Records)
+        print ("\n  Checked {} CMDB rows, {} issues\n" .format(len(Records), len(Drift)))
+        for Var, Issue, Detail in Drift:
+            print ("  {:<11} {:<40} {:<20} {}" .format(Issue, Var.Hostname, Var.InstID, Detail))
+        Count = {}
+        for Var, Issue, Detail in Drift:
+            Count[Issue] = Count.get(Issue, 0) + 1
+        if Count:
+            print ("\n  " + "  ".join("{}={}" .format(Issue, N) for Issue, N in sorted(Count.items())))
+        print ("")
+        return Drift
+
+
+
+
+class FanOut:
+    # Run independent AWS calls on a bounded thread pool with at most PerRegion calls in flight per region,
+    # so one region cannot use all workers or hit API rate limits alone. Map yields (Result, ERR) in job
+    # order as soon as a job and every job before it has finished, output order is stable across runs.
+    def __init__(self, Workers=16, PerRegion=8):
+        self.Workers = max(1, Workers)
+        self.PerRegion = max(1, PerRegion)
+        self.Lock = threading.Lock()
+        self.Limits = {}
+
+    def Limit(self, Region):
+        with self.Lock:
+            if Region not in self.Limits:
+                self.Limits[Region] = threading.BoundedSemaphore(self.PerRegion)
+            return self.Limits[Region]
+
+    def Call(self, Region, Func, *ARGS):
+        with self.Limit(Region):
+            try:
+                return Func(*ARGS), None
+            except Exception as ERR:
+                return None, ERR
+
+    def Map(self, Jobs):
+        # Jobs = [(Region, Func, *args)]
+        Jobs = list(Jobs)
+        if not Jobs:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.Workers, len(Jobs))) as Pool:
+            Futures = [Pool.submit(self.Call, *Job) for Job in Jobs]
+            for Future in Futures:
+                yield Future.result()
+
+    @staticmethod
+    def AddArgs(Parser):
+        Parser.add_argument('--workers', type=int, default=16, help='Concurrent AWS calls, default 16')
+        Parser.add_argument('--region-workers', type=int, default=8, help='Concurrent AWS calls per region, default 8')
+
+    @classmethod
+    def FromArgs(cls, args):
+        return cls(getattr(args, 'workers', 16), getattr(args, 'region_workers', 8))
+
+
+
+
+class Converge:
+    # Wait for targets of register/deregister to settle instead of fixed sleep. All target groups / ELBs are
+    # polled from one loop, one round of concurrent health calls then one sleep with exponential backoff
+    # (1s doubling to 16s), so pool slots are only held for the calls. Polled until all targets reach the
+    # wanted state: ALB healthy / unused or gone, ELB InService / gone. Wait is bounded per load balancer by
+    # health check interval x healthy threshold on attach and deregistration delay (connection draining) on
+    # detach, plus GRACE, unless Timeout given. Time to reach state is recorded for each target.
+    GRACE = 30
+    START = 1
+    MAX = 16
+
+    def __init__(self, Profile, Pool=None, Timeout=None):
+        self.Profile = Profile
+        self.Pool = Pool or FanOut()
+        self.Timeout = Timeout
+        self.Groups = []
+
+    def AddTG(self, ALB, TG, TGARN, Region, Ids, Attach=True):
+        self.Groups.append({'Kind': 'alb', 'LB': ALB, 'TG': TG, 'Arn': TGARN, 'Region': Region, 'Ids': list(Ids),
+                            'Attach': Attach, 'Start': time.perf_counter()})
+
+    def AddELB(self, ELB, Region, Ids, Attach=True):
+        self.Groups.append({'Kind': 'elb', 'LB': ELB, 'TG': None, 'Region': Region, 'Ids': list(Ids),
+                            'Attach': Attach, 'Start': time.perf_counter()})
+
+    def Limit(self, Group):
+        # Seconds to wait for group
+        if self.Timeout is not None:
+            return self.Timeout
+        if Group['Kind'] == 'alb':
+            ec2client = AWSBoto3().SetALBClient(self.Profile, Group['Region'])
+            if Group['Attach']:
+                TG = ec2client.describe_target_groups(TargetGroupArns=[Group['Arn']])['TargetGroups'][0]
+                return TG.get('HealthCheckIntervalSeconds', 30) * TG.get('HealthyThresholdCount', 5) + self.GRACE
+            Attr = ec2client.describe_target_group_attributes(TargetGroupArn=Group['Arn'])['Attributes']
+            return int(dict((X['Key'], X['Value']) for X in Attr).get('deregistration_delay.timeout_seconds', 300)) + self.GRACE
+        ec2client = AWSBoto3().SetELBClient(self.Profile, Group['Region'])
+        if Group['Attach']:
+            HC = ec2client.describe_load_balancers(LoadBalancerNames=[Group['LB']])['LoadBalancerDescriptions'][0].get('HealthCheck', {})
+            return HC.get('Interval', 30) * HC.get('HealthyThreshold', 10) + self.GRACE
+        Attr = ec2client.describe_load_balancer_attributes(LoadBalancerName=Group['LB'])['LoadBalancerAttributes']
+        Drain = Attr.get('ConnectionDraining', {})
+        return (Drain.get('Timeout', 300) if Drain.get('Enabled') else 0) + self.GRACE
+
+    def States(self, Group):
+        # {Id: State} of targets still registered
+        if Group['Kind'] == 'alb':
+            ec2client = AWSBoto3().SetALBClient(self.Profile, Group['Region'])
+            Result = ec2client.describe_target_health(TargetGroupArn=Group['Arn'], Targets=[{'Id': X} for X in Group['Ids']])
+            return dict((X['Target']['Id'], X['TargetHealth']['State']) for X in Result['TargetHealthDescriptions'])
+        ec2client = AWSBoto3().SetELBClient(self.Profile, Group['Region'])
+        Result = ec2client.describe_instance_health(LoadBalancerName=Group['LB'])
+        return dict((X['InstanceId'], X['State']) for X in Result['InstanceStates'])
+
+    @staticmethod
+    def Settled(Group, State):
+        if Group['Attach']:
+            return State in ('healthy', 'InService')
+        return State in (None, 'unused')
+
+    def Poll(self, Group, Limit, Done):
+        # One health call for Group, settled targets added to Done {Id: Seconds}. Returns {Id: State} and True when finished
+        States = self.States(Group)
+        Now = time.perf_counter() - Group['Start']
+        for Id in Group['Ids']:
+            if Id not in Done and self.Settled(Group, States.get(Id)):
+                Done[Id] = Now
+        return States, len(Done) == len(Group['Ids']) or Now >= Limit
+
+    def Wait(self):
+        # [(Group, Result, ERR)] in order groups were added. Result {Id: (State, Seconds)}, Seconds is None
+        # for targets not settled before limit of their group.
+        N = len(self.Groups)
+        Result = [None] * N
+        Errors = [None] * N
+        Limits = [None] * N
+        Done = [{} for X in range(N)]
+        for I, (Limit, ERR) in enumerate(self.Pool.Map((Group['Region'], self.Limit, Group) for Group in self.Groups)):
+            Limits[I], Errors[I] = Limit, ERR
+        Active = [I for I in range(N) if Errors[I] is None]
+        Delay = self.START
+        while Active:
+            Jobs = ((self.Groups[I]['Region'], self.Poll, self.Groups[I], Limits[I], Done[I]) for I in Active)
+            Next = []
+            for I, (R, ERR) in zip(Active, self.Pool.Map(Jobs)):
+                if ERR:
+                    Errors[I] = ERR
+                    continue
+                States, Finished = R
+                if Finished:
+                    Result[I] = dict((Id, (States.get(Id, 'deregistered'), Done[I].get(Id))) for Id in self.Groups[I]['Ids'])
+                else:
+                    Next.append(I)
+            Active = Next
+            if Active:
+                Left = min(Limits[I] - (time.perf_counter() - self.Groups[I]['Start']) for I in Active)
+                time.sleep(max(0, min(Delay, Left)))
+                Delay = min(Delay * 2, self.MAX)
+        return [(Group, Result[I], Errors[I]) for I, Group in enumerate(self.Groups)]
+
+    def Report(self, ams):
+        # Wait and print time to wanted state per target. Returns False if any target did not settle.
+        # Timeout 0 (--wait 0) skips the wait, nothing is polled and it counts as success.
+        if not self.Groups:
+            return True
+        if self.Timeout == 0:
+            print ("\n INFO : --wait 0, not waiting for {} targets to settle" .format(sum(len(G['Ids']) for G in self.Groups)))
+            return True
+        print ("\n INFO : Waiting for {} targets on {} load balancer target sets to settle..." .format(sum(len(G['Ids']) for G in self.Groups), len(self.Groups)))
+        OK = True
+        for Group, Result, ERR in self.Wait():
+            print ("\n      {} = {} Region = {}{}\n" .format(Group['Kind'].upper(), Group['LB'], Group['Region'], " TGroup = " + Group['TG'] if Group['TG'] else ""))
+            if ERR:
+                print (" ERROR : Failed to get target health. {}" .format(ERR))
+                OK = False
+                continue
+            for Id, (State, Seconds) in Result.items():
+                if Seconds is None:
+                    OK = False
+                    print ("\t  {}\t{}\t  NOT SETTLED after {:.0f}s" .format(ams.GetHostname(Id) or Id, State, time.perf_counter() - Group['Start']))
+                else:
+                    print ("\t  {}\t{}\t  {:.1f}s" .format(ams.GetHostname(Id) or Id, State, Seconds))
+        return OK
+
+    @staticmethod
+    def AddArgs(Parser):
+        Parser.add_argument('--wait', type=int, metavar='SECONDS', help='Max seconds to wait for targets to settle, default from health check / deregistration delay. 0 skips wait')
+
+    @classmethod
+    def FromArgs(cls, Profile, args, Pool=None):
+        return cls(Profile, Pool, getattr(args, 'wait', None))
+
+
+
+
+class LBInventory:
+    # Load balancers of a region fetched once per run with all pages, shared by every VPC of that region
+    # and indexed by VPC, name and ARN. Kind alb = elbv2 (ALB/NLB), elb = classic ELB (no ARN).
+    Lock = threading.Lock()
+    Regions = {}
+
+    def __init__(self, Profile, Kind='alb'):
+        self.Profile = Profile
+        self.Kind = Kind
+
+    def Fetch(self, Region):
+        if self.Kind == 'alb':
+            ec2client = AWSBoto3().SetALBClient(self.Profile, Region)
+            Key, VPCKey = 'LoadBalancers', 'VpcId'
+        else:
+            ec2client = AWSBoto3().SetELBClient(self.Profile, Region)
+            Key, VPCKey = 'LoadBalancerDescriptions', 'VPCId'
+        Index = {'VPC': {}, 'Name': {}, 'Arn': {}}
+        for Page in ec2client.get_paginator('describe_load_balancers').paginate():
+            for LB in Page[Key]:
+                Index['VPC'].setdefault(LB.get(VPCKey, 'NULL'), []).append(LB)
+                Index['Name'][LB['LoadBalancerName']] = LB
+                if 'LoadBalancerArn' in LB:
+                    Index['Arn'][LB['LoadBalancerArn']] = LB
+        return Index
+
+    def Load(self, Region):
+        Key = (self.Profile, self.Kind, Region)
+        with self.Lock:
+            Index = self.Regions.get(Key)
+        if Index is None:
+            Index = self.Fetch(Region)
+            with self.Lock:
+                Index = self.Regions.setdefault(Key, Index)
+        return Index
+
+    def Prefetch(self, Regions, Pool=None):
+        # Load several regions concurrently, errors raised again by the Load that needs the region
+        Pool = Pool or FanOut()
+        for Result, ERR in Pool.Map((Region, self.Load, Region) for Region in set(Regions)):
+            pass
+
+    def ByVPC(self, VPC, Region):
+        return self.Load(Region)['VPC'].get(VPC, [])
+
+    def ByName(self, Name, Region):
+        return self.Load(Region)['Name'].get(Name)
+
+    def ByArn(self, ARN, Region):
+        return self.Load(Region)['Arn'].get(ARN)
+
+    @classmethod
+    def Invalidate(cls, Region=None, Profile=None, Kind=None):
+        # Drop loaded regions, limited to Region / Profile / Kind when given
+        with cls.Lock:
+            for Key in [K for K in cls.Regions if Profile in (None, K[0]) and Kind in (None, K[1]) and Region in (None, K[2])]:
+                del cls.Regions[Key]
+
+
+
+
+class ALBTopology:
+    # On disk cache of ALB -> target groups -> listeners per profile and region, kept in DV_CACHE
+    # (default ~/.dvcache) as JSON. Region ALB list and target groups are rebuilt with one paginated
+    # describe_load_balancers and describe_target_groups once TTL expires or with Refresh.
+    # Each ALB has its own timestamp, Invalidate(Region, ALB) makes only that ALB reload target groups
+    # (describe_target_groups by ALB ARN). Listeners are fetched on first use and cached the same way.
+    # Resolve/ResolveTargetGroups serve named lookups from cache and batch the rest without building region.
+    TTL = 3600
+
+    def __init__(self, Profile, TTL=None, Refresh=False):
+        self.Profile = Profile
+        self.TTL = self.TTL if TTL is None else TTL
+        self.Refresh = Refresh
+        self.Dir = os.environ.get("DV_CACHE") or os.path.join(os.path.expanduser("~"), ".dvcache")
+        self.Regions = {}
+        self.Extra = {}
+        self.Built = set()
+        self.Lock = threading.Lock()
+        self.Locks = {}
+
+    def RegionLock(self, Region):
+        # Regions load concurrently, calls for same region wait for the first one
+        with self.Lock:
+            return self.Locks.setdefault(Region, threading.RLock())
+
+    def Path(self, Region):
+        return os.path.join(self.Dir, "albtopo-{}-{}.json" .format(re.sub(r'[^\w.-]', '_', self.Profile), Region))
+
+    def Fresh(self, Time):
+        return time.time() - Time < self.TTL
+
+    def Save(self, Region):
+        # TTL 0 disables the cache, nothing written
+        if self.TTL <= 0:
+            return
+        os.makedirs(self.Dir, exist_ok=True)
+        CMDBBuilder.Write(self.Path(Region), json.dumps(self.Regions[Region]))
+
+    def Build(self, Region):
+        # Whole region from ALB inventory and all target groups of region
+        ec2client = AWSBoto3().SetALBClient(self.Profile, Region)
+        LBInventory.Invalidate(Region, self.Profile, 'alb')
+        Now = time.time()
+        Data = {'Time': Now, 'ALB': {}}
+        ByArn = {}
+        for LB in LBInventory(self.Profile).Load(Region)['Name'].values():
+            Entry = {'Arn': LB['LoadBalancerArn'], 'VpcId': LB.get('VpcId', 'NULL'), 'DNSName': LB.get('DNSName', 'NULL'),
+                     'TG': [], 'Time': Now}
+            Data['ALB'][LB['LoadBalancerName']] = ByArn[Entry['Arn']] = Entry
+        for Page in ec2client.get_paginator('describe_target_groups').paginate():
+            for TG in Page['TargetGroups']:
+                for ARN in TG.get('LoadBalancerArns', []):
+                    if ARN in ByArn:
+                        ByArn[ARN]['TG'].append([TG['TargetGroupName'], TG['TargetGroupArn']])
+        return Data
+
+    def Cached(self, Region):
+        # Region data from memory or fresh disk cache, None if region has to be built
+        with self.RegionLock(Region):
+            if Region in self.Regions:
+                return self.Regions[Region]
+            if self.Refresh:
+                return None
+            try:
+                with open(self.Path(Region)) as FILE:
+                    Data = json.load(FILE)
+            except (OSError, ValueError):
+                return None
+            if not self.Fresh(Data.get('Time', 0)):
+                return None
+            self.Regions[Region] = Data
+            return Data
+
+    def Load(self, Region):
+        # Region data from memory, disk or AWS, in that order
+        with self.RegionLock(Region):
+            Data = self.Cached(Region)
+            if Data is None:
+                Data = self.Regions[Region] = self.Build(Region)
+                self.Built.add(Region)
+                self.Save(Region)
+            return Data
+
+    def FetchTG(self, ec2client, ARN):
+        return [[X['TargetGroupName'], X['TargetGroupArn']] for Page in
+                ec2client.get_paginator('describe_target_groups').paginate(LoadBalancerArn=ARN) for X in Page['TargetGroups']]
+
+    def ALB(self, Name, Region):
+        # ALB entry with current target groups, or None if ALB not in region.
+        # ALB missing from cache rebuilds region once, ALB may have been created after cache was written.
+        with self.RegionLock(Region):
+            if Name in self.Extra.get(Region, {}):
+                return self.Extra[Region][Name]
+            Entry = self.Load(Region)['ALB'].get(Name)
+            if Entry is None and Region not in self.Built:
+                self.Regions[Region] = self.Build(Region)
+                self.Built.add(Region)
+                self.Save(Region)
+                Entry = self.Regions[Region]['ALB'].get(Name)
+            if Entry is None or (Entry['Time'] and (Region in self.Built or self.Fresh(Entry['Time']))):
+                return Entry
+            Entry['TG'] = self.FetchTG(AWSBoto3().SetALBClient(self.Profile, Region), Entry['Arn'])
+            Entry['Time'] = time.time()
+            Entry.pop('Listeners', None)
+            self.Save(Region)
+            return Entry
+
+    @staticmethod
+    def DescribeNames(Func, Key, Names, Failed, Chunk=20):
+        # Multi valued describe by Names in chunks of Chunk (service limit 20). One unknown name fails the
+        # whole call, so a failed chunk is split in halves until the bad names are isolated in Failed.
+        Result = []
+        for N in range(0, len(Names), Chunk):
+            Batch = Names[N:N + Chunk]
+            try:
+                Result.extend(Func(Names=Batch)[Key])
+            except ClientError as ERR:
+                if len(Batch) == 1:
+                    Failed[Batch[0]] = ERR.response['Error'].get('Message') or ERR.response['Error'].get('Code')
+                    continue
+                Half = len(Batch) // 2
+                Result.extend(ALBTopology.DescribeNames(Func, Key, Batch[:Half], Failed, Chunk))
+                Result.extend(ALBTopology.DescribeNames(Func, Key, Batch[Half:], Failed, Chunk))
+        return Result
+
+    def Resolve(self, Names, Region):
+        # ALB names to entries. Names in cache are served from it, others resolved with batched
+        # describe_load_balancers without building the region. Returns Found {Name: Entry}, Failed {Name: Error}
+        Found, Failed = {}, {}
+        Data = self.Cached(Region)
+        Missing = []
+        for Name in dict.fromkeys(Names):
+            if Name in self.Extra.get(Region, {}) or (Data is not None and Name in Data['ALB']):
+                Found[Name] = self.ALB(Name, Region)
+            else:
+                Missing.append(Name)
+        if Missing:
+            ec2client = AWSBoto3().SetALBClient(self.Profile, Region)
+            for LB in self.DescribeNames(ec2client.describe_load_balancers, 'LoadBalancers', Missing, Failed):
+                Entry = {'Arn': LB['LoadBalancerArn'], 'VpcId': LB.get('VpcId', 'NULL'), 'DNSName': LB.get('DNSName', 'NULL'),
+                         'TG': self.FetchTG(ec2client, LB['LoadBalancerArn']), 'Time': time.time()}
+                Found[LB['LoadBalancerName']] = Entry
+                with self.RegionLock(Region):
+                    if Data is not None:
+                        Data['ALB'][LB['LoadBalancerName']] = Entry
+                        self.Save(Region)
+                    else:
+                        self.Extra.setdefault(Region, {})[LB['LoadBalancerName']] = Entry
+            for Name in Missing:
+                if Name not in Found and Name not in Failed:
+                    Failed[Name] = "Load balancer not found"
+        return Found, Failed
+
+    def ResolveTargetGroups(self, Names, Region):
+        # Target group names to {Name: {'Arn': TGARN, 'ALBs': [ALB ARN]}}. Cached ALB target groups first,
+        # rest with batched describe_target_groups. Returns Found, Failed {Name: Error}
+        Found, Failed = {}, {}
+        Data = self.Cached(Region)
+        Known = {}
+        for Entry in list((Data or {}).get('ALB', {}).values()) + list(self.Extra.get(Region, {}).values()):
+            for TG, TGARN in Entry['TG']:
+                Known.setdefault(TG, {'Arn': TGARN, 'ALBs': []})['ALBs'].append(Entry['Arn'])
+        Missing = []
+        for Name in dict.fromkeys(Names):
+            if Name in Known:
+                Found[Name] = Known[Name]
+            else:
+                Missing.append(Name)
+        if Missing:
+            ec2client = AWSBoto3().SetALBClient(self.Profile, Region)
+            for TG in self.DescribeNames(ec2client.describe_target_groups, 'TargetGroups', Missing, Failed):
+                Found[TG['TargetGroupName']] = {'Arn': TG['TargetGroupArn'], 'ALBs': TG.get('LoadBalancerArns', [])}
+            for Name in Missing:
+                if Name not in Found and Name not in Failed:
+                    Failed[Name] = "Target group not found"
+        return Found, Failed
+
+    def Prefetch(self, Regions, Pool=None):
+        Pool = Pool or FanOut()
+        for Result, ERR in Pool.Map((Region, self.Load, Region) for Region in set(Regions)):
+            pass
+
+    def ByVPC(self, VPC, Region):
+        # [(Name, Entry)] of ALB in VPC sorted by name
+        return [(Name, Entry) for Name, Entry in sorted(self.Load(Region)['ALB'].items()) if Entry['VpcId'] == VPC]
+
+    def ByArn(self, ARN, Region):
+        for Name, Entry in self.Extra.get(Region, {}).items():
+            if Entry['Arn'] == ARN:
+                return Name
+        for Name, Entry in self.Load(Region)['ALB'].items():
+            if Entry['Arn'] == ARN:
+                return Name
+        return None
+
+    def TargetGroups(self, ARN, Region):
+        Name = self.ByArn(ARN, Region)
+        return self.ALB(Name, Region)['TG'] if Name else []
+
+    def Listeners(self, Name, Region):
+        # Listeners of ALB as returned by describe_listeners, fetched once per TTL
+        with self.RegionLock(Region):
+            Entry = self.ALB(Name, Region)
+            if Entry is None:
+                return []
+            if 'Listeners' not in Entry:
+                ec2client = AWSBoto3().SetALBClient(self.Profile, Region)
+                Entry['Listeners'] = [X for Page in ec2client.get_paginator('describe_listeners').paginate(LoadBalancerArn=Entry['Arn'])
+                                      for X in Page['Listeners']]
+                self.Save(Region)
+            return Entry['Listeners']
+
+    def Invalidate(self, Region, Name=None):
+        # Expire one ALB, or whole region when Name is None
+        with self.RegionLock(Region):
+            if Name is None:
+                self.Regions.pop(Region, None)
+                self.Extra.pop(Region, None)
+                try:
+                    os.unlink(self.Path(Region))
+                except OSError:
+                    pass
+                return
+            if Name in self.Extra.get(Region, {}):
+                self.Extra[Region][Name]['Time'] = 0
+                return
+            Entry = self.Load(Region)['ALB'].get(Name)
+            if Entry is not None:
+                Entry['Time'] = 0
+                self.Save(Region)
+
+    @staticmethod
+    def AddArgs(Parser):
+        Parser.add_argument('--refresh', action='store_true', help='Rebuild cached ALB/target group topology')
+        Parser.add_argument('--cache-ttl', type=int, default=ALBTopology.TTL, help='Seconds cached ALB topology is used, default 3600. 0 disables cache')
+
+    @classmethod
+    def FromArgs(cls, Profile, args):
+        return cls(Profile, getattr(args, 'cache_ttl', None), getattr(args, 'refresh', False))
+
+
+
+
+class LBMembership:
+    # Reverse index of instance -> every ALB target group (with port) and classic ELB it is registered with.
+    # Target groups, ALB and ELB inventory of all regions are loaded in one concurrent pass, then target health
+    # of every target group and instance health of every ELB with members in a second. Memberships removed with
+    # Change(Attach=False) can be kept per instance in DV_CACHE with Save (added to anything saved before), Saved
+    # returns them for re-attach and Clear drops them once re-attached.
+
+    def __init__(self, Profile, Pool=None):
+        self.Profile = Profile
+        self.Pool = Pool or FanOut()
+        self.Dir = os.environ.get("DV_CACHE") or os.path.join(os.path.expanduser("~"), ".dvcache")
+
+    def TargetGroups(self, Region):
+        # Instance type target groups of region, IP/lambda targets are not hosts
+        ec2client = AWSBoto3().SetALBClient(self.Profile, Region)
+        return [TG for Page in ec2client.get_paginator('describe_target_groups').paginate() for TG in Page['TargetGroups']
+                if TG.get('TargetType', 'instance') == 'instance']
+
+    def TargetHealth(self, Region, TGARN):
+        ec2client = AWSBoto3().SetALBClient(self.Profile, Region)
+        return ec2client.describe_target_health(TargetGroupArn=TGARN)['TargetHealthDescriptions']
+
+    def InstanceHealth(self, Region, ELB):
+        ec2client = AWSBoto3().SetELBClient(self.Profile, Region)
+        return ec2client.describe_instance_health(LoadBalancerName=ELB)['InstanceStates']
+
+    def Build(self, Regions):
+        # {InstID: [Member]}, Member = {'Kind': 'alb'|'elb', 'Region', 'LB', 'TG', 'Arn', 'Port', 'State'}
+        # TG, Arn and Port are None for classic ELB. Errors of any region are raised.
+        Regions = sorted(set(Regions))
+        ALB, ELB = LBInventory(self.Profile), LBInventory(self.Profile, 'elb')
+        Jobs = [(Region, Func) for Region in Regions for Func in (self.TargetGroups, ALB.Load, ELB.Load)]
+        TGs = {}
+        for (Region, Func), (Result, ERR) in zip(Jobs, self.Pool.Map((Region, Func, Region) for Region, Func in Jobs)):
+            if ERR:
+                raise ERR
+            if Func == self.TargetGroups:
+                TGs[Region] = Result
+
+        Jobs = [(Region, 'alb', TG) for Region in Regions for TG in TGs[Region]]
+        Jobs += [(Region, 'elb', LB) for Region in Regions for Name, LB in sorted(ELB.Load(Region)['Name'].items()) if LB.get('Instances')]
+        Result = self.Pool.Map((Region, self.TargetHealth, Region, X['TargetGroupArn']) if Kind == 'alb' else
+                               (Region, self.InstanceHealth, Region, X['LoadBalancerName']) for Region, Kind, X in Jobs)
+        Index = {}
+        for (Region, Kind, X), (Health, ERR) in zip(Jobs, Result):
+            if ERR:
+                raise ERR
+            if Kind == 'elb':
+                for Y in Health:
+                    Index.setdefault(Y['InstanceId'], []).append({'Kind': 'elb', 'Region': Region, 'LB': X['LoadBalancerName'],
+                                                                  'TG': None, 'Arn': None, 'Port': None, 'State': Y.get('State')})
+                continue
+            LB = ",".join(sorted(ALB.ByArn(ARN, Region)['LoadBalancerName'] for ARN in X.get('LoadBalancerArns', []) if ALB.ByArn(ARN, Region)))
+            for Y in Health:
+                Index.setdefault(Y['Target']['Id'], []).append({'Kind': 'alb', 'Region': Region, 'LB': LB or "NULL", 'TG': X['TargetGroupName'],
+                                                                'Arn': X['TargetGroupArn'], 'Port': Y['Target'].get('Port', X.get('Port')),
+                                                                'State': Y['TargetHealth'].get('State')})
+        return Index
+
+    def Path(self, InstID):
+        return os.path.join(self.Dir, "lbmembers-{}-{}.json" .format(re.sub(r'[^\w.-]', '_', self.Profile), InstID))
+
+    @staticmethod
+    def Key(Member):
+        return (Member['Kind'], Member['Region'], Member['Arn'] or Member['LB'], Member['Port'])
+
+    def Save(self, InstID, Members):
+        # Members are added to whatever is already saved for instance, so evacuate that stopped part way and
+        # is run again keeps the memberships removed the first time.
+        Merged = dict((self.Key(Member), Member) for Member in (self.Saved(InstID) or {}).get('Members', []))
+        Merged.update((self.Key(Member), Member) for Member in Members)
+        os.makedirs(self.Dir, exist_ok=True)
+        CMDBBuilder.Write(self.Path(InstID), json.dumps({'Time': time.time(), 'Members': list(Merged.values())}))
+
+    def Saved(self, InstID):
+        # {'Time', 'Members'} saved for instance, None if nothing saved
+        try:
+            with open(self.Path(InstID)) as FILE:
+                return json.load(FILE)
+        except (OSError, ValueError):
+            return None
+
+    def Clear(self, InstID):
+        try:
+            os.remove(self.Path(InstID))
+        except FileNotFoundError:
+            pass
+
+    def Call(self, Member, Targets, Attach):
+        # One register/deregister call for all Targets [(InstID, Port)] of one target group or ELB
+        if Member['Kind'] == 'alb':
+            ec2client = AWSBoto3().SetALBClient(self.Profile, Member['Region'])
+            Func = ec2client.register_targets if Attach else ec2client.deregister_targets
+            return Func(TargetGroupArn=Member['Arn'], Targets=[dict(Id=Id, Port=Port) if Port else dict(Id=Id) for Id, Port in Targets])
+        ec2client = AWSBoto3().SetELBClient(self.Profile, Member['Region'])
+        Func = ec2client.register_instances_with_load_balancer if Attach else ec2client.deregister_instances_from_load_balancer
+        return Func(LoadBalancerName=Member['LB'], Instances=[{'InstanceId': Id} for Id, Port in Targets])
+
+    def Change(self, Members, Attach):
+        # Members = [(InstID, Member)] of any number of hosts and regions, grouped so each target group / ELB gets
+        # one call, all calls concurrent. Returns [(Member, [InstID], ERR)] in order groups first appear.
+        Groups = {}
+        for InstID, Member in Members:
+            Key = self.Key(Member)[:3]
+            Groups.setdefault(Key, (Member, []))[1].append((InstID, Member['Port']))
+        Jobs = list(Groups.values())
+        Result = list(self.Pool.Map((Member['Region'], self.Call, Member, Targets, Attach) for Member, Targets in Jobs))
+        for Region in set(Member['Region'] for Member, Targets in Jobs if Member['Kind'] == 'elb'):
+            LBInventory.Invalidate(Region, self.Profile, 'elb')
+        return [(Member, [Id for Id, Port in Targets], ERR) for (Member, Targets), (R, ERR) in zip(Jobs, Result)]
+
+
+
+
+class AsyncLB:
+    # asyncio counterpart of FanOut for load balancer calls of albctl/elbctl, built on aiobotocore (optional).
+    # All jobs of a Map run as coroutines on one event loop sharing one client per region and service, so
+    # hundreds of describe calls are in flight without a thread each. At most Workers calls in flight, and
+    # half of that per region. Map(Jobs) takes the same [(Region, Func, *args)] as FanOut.Map with Func one
+    # of the async methods below and returns [(Result, ERR)] in job order.
+    WORKERS = 100
+
+    def __init__(self, Profile, Workers=None):
+        if AioSession is None:
+            raise ImportError("aiobotocore not installed")
+        self.Profile = Profile
+        self.Workers = max(1, Workers or self.WORKERS)
+        self.PerRegion = max(1, self.Workers // 2)
+
+    @staticmethod
+    def Available():
+        return AioSession is not None
+
+    async def Client(self, Service, Region):
+        # Client of (Service, Region) for current Map, created on first use
+        Key = (Service, Region)
+        async with self.Lock:
+            if Key not in self.Clients:
+                client = await self.Stack.enter_async_context(self.Session.create_client(Service, region_name=Region))
+                APITrace.Hook(client)
+                self.Clients[Key] = client
+            return self.Clients[Key]
+
+    async def Pages(self, Service, Region, Op, Key, **KW):
+        client = await self.Client(Service, Region)
+        return [X async for Page in client.get_paginator(Op).paginate(**KW) for X in Page[Key]]
+
+    async def LoadBalancers(self, Region, Kind='alb'):
+        if Kind == 'alb':
+            return await self.Pages('elbv2', Region, 'describe_load_balancers', 'LoadBalancers')
+        return await self.Pages('elb', Region, 'describe_load_balancers', 'LoadBalancerDescriptions')
+
+    async def TargetGroups(self, Region, ARN):
+        return await self.Pages('elbv2', Region, 'describe_target_groups', 'TargetGroups', LoadBalancerArn=ARN)
+
+    async def TargetHealth(self, Region, TGARN):
+        client = await self.Client('elbv2', Region)
+        return (await client.describe_target_health(TargetGroupArn=TGARN))['TargetHealthDescriptions']
+
+    async def InstanceHealth(self, Region, ELB):
+        client = await self.Client('elb', Region)
+        return (await client.describe_instance_health(LoadBalancerName=ELB))['InstanceStates']
+
+    async def RegisterTargets(self, Region, TGARN, Targets, Attach=True):
+        client = await self.Client('elbv2', Region)
+        Func = client.register_targets if Attach else client.deregister_targets
+        return await Func(TargetGroupArn=TGARN, Targets=Targets)
+
+    async def RegisterInstances(self, Region, ELB, Instances, Attach=True):
+        client = await self.Client('elb', Region)
+        Func = client.register_instances_with_load_balancer if Attach else client.deregister_instances_from_load_balancer
+        return await Func(LoadBalancerName=ELB, Instances=Instances)
+
+    async def Call(self, Region, Func, *ARGS):
+        if Region not in self.Limits:
+            self.Limits[Region] = asyncio.Semaphore(self.PerRegion)
+        async with self.Limit, self.Limits[Region]:
+            try:
+                return await Func(*ARGS), None
+            except Exception as ERR:
+                return None, ERR
+
+    async def Gather(self, Jobs):
+        self.Session = AioSession(profile=self.Profile)
+        self.Clients = {}
+        self.Lock = asyncio.Lock()
+        self.Limit = asyncio.Semaphore(self.Workers)
+        self.Limits = {}
+        async with AsyncExitStack() as self.Stack:
+            return await asyncio.gather(*(self.Call(*Job) for Job in Jobs))
+
+    def Map(self, Jobs):
+        # Jobs = [(Region, Func, *args)], runs all on a new event loop
+        Jobs = list(Jobs)
+        if not Jobs:
+            return []
+        return asyncio.run(self.Gather(Jobs))
+
+    @staticmethod
+    def AddArgs(Parser):
+        Parser.add_argument('--async', dest='Async', action='store_true', help='Run load balancer calls on asyncio (needs aiobotocore) instead of threads')
+        Parser.add_argument('--async-workers', type=int, default=AsyncLB.WORKERS, help='Concurrent calls with --async, half of it per region. Default 100')
+
+    @classmethod
+    def FromArgs(cls, Profile, args):
+        # None unless --async given
+        if not cls.Check(args):
+            return None
+        return cls(Profile, getattr(args, 'async_workers', None))
+
+    @classmethod
+    def Check(cls, args):
+        # True if --async given. Exits when aiobotocore is missing, call before any AWS work is done.
+        if not getattr(args, 'Async', False):
+            return False
+        if not cls.Available():
+            print (" ERROR : --async needs aiobotocore, pip install aiobotocore")
             exit(1)
-        return (set(LIST))
+        return True
+
+
+
+
+class SnapIndex:
+    # Local SQLite index of own EBS snapshots per profile in DV_CACHE (snapindex-PROFILE.db). Snapshots are
+    # keyed by volume and carry instance, CMDB hostname and device of the volume when first seen, so later
+    # lookups by host/device need no AWS call. Sync of a region fetches volumes, only snapshots started on or
+    # after the last StartTime seen less OVERLAP (server side start-time filter per day) and re-polls pending ones.
+    # Full sync fetches everything and drops snapshots deleted since, it is done on request and whenever last
+    # full sync of region is older than RECONCILE, so snapshots missed by the start-time window are picked up.
+    # One connection shared by sync threads, every use of it is under Lock.
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS snapshots (SnapshotId TEXT PRIMARY KEY, VolumeId TEXT, InstID TEXT, Hostname TEXT, Device TEXT,
+        Region TEXT, StartTime REAL, State TEXT, Progress TEXT, Size INTEGER, Tags TEXT);
+    CREATE INDEX IF NOT EXISTS snap_host ON snapshots (Hostname, Device, StartTime);
+    CREATE INDEX IF NOT EXISTS snap_volume ON snapshots (VolumeId, StartTime);
+    CREATE INDEX IF NOT EXISTS snap_state ON snapshots (Region, State);
+    CREATE TABLE IF NOT EXISTS volumes (VolumeId TEXT PRIMARY KEY, InstID TEXT, Hostname TEXT, Device TEXT, Region TEXT);
+    CREATE TABLE IF NOT EXISTS sync (Region TEXT PRIMARY KEY, LastStart REAL, Time REAL);
+    CREATE TABLE IF NOT EXISTS reconcile (Region TEXT PRIMARY KEY, Time REAL);
+    """
+    CHUNK = 200
+    DAYS = 200
+    OVERLAP = 3600
+    RECONCILE = 24 * 3600
+
+    def __init__(self, Profile, ams=None, Path=None):
+        self.Profile = Profile
+        self.ams = ams
+        Dir = os.environ.get("DV_CACHE") or os.path.join(os.path.expanduser("~"), ".dvcache")
+        self.Path = Path or os.path.join(Dir, "snapindex-{}.db" .format(re.sub(r'[^\w.-]', '_', Profile)))
+        os.makedirs(os.path.dirname(self.Path) or ".", exist_ok=True)
+        self.Lock = threading.Lock()
+        self.DB = sqlite3.connect(self.Path, check_same_thread=False)
+        self.DB.row_factory = sqlite3.Row
+        self.DB.executescript(self.SCHEMA)
+
+    def Rows(self, SQL, ARGS=()):
+        # All rows of query, read under Lock
+        with self.Lock:
+            return self.DB.execute(SQL, ARGS).fetchall()
+
+    def Hostname(self, InstID):
+        return (self.ams.GetHostname(InstID) if self.ams and InstID else None) or None
+
+    def Volumes(self, ec2client, Region):
+        # Map every attached volume of region to instance, host and device
+        Rows = []
+        for Page in ec2client.get_paginator('describe_volumes').paginate():
+            for V in Page['Volumes']:
+                for A in V.get('Attachments', [])[:1]:
+                    Rows.append((V['VolumeId'], A.get('InstanceId'), self.Hostname(A.get('InstanceId')), A.get('Device'), Region))
+        with self.Lock, self.DB:
+            self.DB.executemany("INSERT OR REPLACE INTO volumes VALUES (?,?,?,?,?)", Rows)
+        return len(Rows)
+
+    def Store(self, Region, Snapshots):
+        # Upsert snapshots, host/device taken from volumes table and kept once known
+        Rows = [(X['SnapshotId'], X.get('VolumeId'), Region, X['StartTime'].timestamp(), X.get('State'), X.get('Progress'),
+                 X.get('VolumeSize'), json.dumps(dict((T['Key'], T['Value']) for T in X.get('Tags', [])))) for X in Snapshots]
+        with self.Lock, self.DB:
+            self.DB.executemany("""INSERT INTO snapshots (SnapshotId, VolumeId, InstID, Hostname, Device, Region, StartTime, State, Progress, Size, Tags)
+                SELECT ?1, ?2, v.InstID, v.Hostname, v.Device, ?3, ?4, ?5, ?6, ?7, ?8 FROM (SELECT 1) LEFT JOIN volumes v ON v.VolumeId = ?2 WHERE 1
+                ON CONFLICT(SnapshotId) DO UPDATE SET State=excluded.State, Progress=excluded.Progress, Tags=excluded.Tags,
+                InstID=COALESCE(snapshots.InstID, excluded.InstID), Hostname=COALESCE(snapshots.Hostname, excluded.Hostname),
+                Device=COALESCE(snapshots.Device, excluded.Device)""", Rows)
+        return len(Rows)
+
+    def Sync(self, Region, Full=False):
+        # Returns (Volumes, New or updated snapshots, Pending re-polled, Deleted)
+        ec2client = AWSBoto3().SetEC2Client(self.Profile, Region)
+        Volumes = self.Volumes(ec2client, Region)
+        Started = time.time()
+        Row = (self.Rows("SELECT LastStart FROM sync WHERE Region=?", (Region,)) or [None])[0]
+        Done = (self.Rows("SELECT Time FROM reconcile WHERE Region=?", (Region,)) or [None])[0]
+        Full = Full or Row is None or Done is None or Started - Done['Time'] >= self.RECONCILE
+        Since = None if Full else Row['LastStart'] - self.OVERLAP
+        Filters = []
+        if Since is not None:
+            First = datetime.datetime.fromtimestamp(Since, datetime.timezone.utc).date()
+            Days = (datetime.datetime.now(datetime.timezone.utc).date() - First).days + 1
+            if Days <= self.DAYS:
+                Filters = [{'Name': 'start-time', 'Values': ["{}*" .format(First + datetime.timedelta(days=N)) for N in range(Days)]}]
+        Seen = set()
+        Last = Row['LastStart'] if Row and not Full else 0
+        Count = 0
+        for Page in ec2client.get_paginator('describe_snapshots').paginate(OwnerIds=['self'], Filters=Filters):
+            Snapshots = [X for X in Page['Snapshots'] if Since is None or X['StartTime'].timestamp() >= Since]
+            Count += self.Store(Region, Snapshots)
+            Seen.update(X['SnapshotId'] for X in Snapshots)
+            Last = max([Last] + [X['StartTime'].timestamp() for X in Snapshots])
+
+        # Pending snapshots started before this fetch re-polled, ones gone are dropped
+        Pending = [R['SnapshotId'] for R in self.Rows("SELECT SnapshotId FROM snapshots WHERE Region=? AND State='pending'", (Region,)) if R['SnapshotId'] not in Seen]
+        Deleted = []
+        for N in range(0, len(Pending), self.CHUNK):
+            Chunk = Pending[N:N + self.CHUNK]
+            Found = ec2client.describe_snapshots(OwnerIds=['self'], Filters=[{'Name': 'snapshot-id', 'Values': Chunk}])['Snapshots']
+            self.Store(Region, Found)
+            Deleted += sorted(set(Chunk) - set(X['SnapshotId'] for X in Found))
+        if Full:
+            Deleted += [R['SnapshotId'] for R in self.Rows("SELECT SnapshotId FROM snapshots WHERE Region=?", (Region,)) if R['SnapshotId'] not in Seen and R['SnapshotId'] not in Deleted]
+        with self.Lock, self.DB:
+            self.DB.executemany("DELETE FROM snapshots WHERE SnapshotId=?", [(X,) for X in Deleted])
+            self.DB.execute("INSERT OR REPLACE INTO sync VALUES (?,?,?)", (Region, Last, time.time()))
+            if Full:
+                self.DB.execute("INSERT OR REPLACE INTO reconcile VALUES (?,?)", (Region, Started))
+        return Volumes, Count, len(Pending), len(Deleted)
+
+    @staticmethod
+    def Snapshot(Row):
+        # Row as describe_snapshots style dict, StartTime as UTC datetime
+        return {'SnapshotId': Row['SnapshotId'], 'VolumeId': Row['VolumeId'], 'InstanceId': Row['InstID'], 'Hostname': Row['Hostname'],
+                'Device': Row['Device'], 'Region': Row['Region'], 'StartTime': datetime.datetime.fromtimestamp(Row['StartTime'], datetime.timezone.utc),
+                'State': Row['State'], 'Progress': Row['Progress'], 'VolumeSize': Row['Size'], 'Tags': json.loads(Row['Tags'] or '{}')}
+
+    @staticmethod
+    def Epoch(Day):
+        # Start of date Day in UTC as epoch
+        return datetime.datetime.combine(Day, datetime.time(), datetime.timezone.utc).timestamp()
+
+    def Snapshots(self, Hostname, Device, First=None, Last=None):
+        # Snapshots of host device started between dates First and Last (inclusive), newest first
+        Before = self.Epoch(Last + datetime.timedelta(days=1)) if Last else float('inf')
+        After = self.Epoch(First) if First else 0
+        return [self.Snapshot(R) for R in self.Rows("""SELECT * FROM snapshots WHERE Hostname=? AND Device=? AND StartTime>=? AND StartTime<?
+                ORDER BY StartTime DESC""", (Hostname, Device, After, Before))]
+
+    def Latest(self, Hostname, Device, Before=None, After=None):
+        # Newest completed snapshot of host device started before date Before (exclusive) and on or after date After
+        Rows = self.Rows("""SELECT * FROM snapshots WHERE Hostname=? AND Device=? AND State='completed' AND StartTime>=? AND StartTime<?
+                ORDER BY StartTime DESC LIMIT 1""", (Hostname, Device, self.Epoch(After) if After else 0, self.Epoch(Before) if Before else float('inf')))
+        return self.Snapshot(Rows[0]) if Rows else None
+
+    def SyncAll(self, Regions, Pool=None, Full=False):
+        # Regions concurrently, [(Region, Result, ERR)]
+        Regions = sorted(set(Regions))
+        Pool = Pool or FanOut()
+        return [(Region, Result, ERR) for Region, (Result, ERR) in zip(Regions, Pool.Map((Region, self.Sync, Region, Full) for Region in Regions))]
+
+
+
 
+class APITrace:
+    # Per API call instrumentation. Hooks are registered on every client AWSBoto3 hands out and record
+    # operation, region, latency, retries and throttles. Scripts enable summary with --trace [FILE].
+    Lock = threading.Lock()
+    Calls = []
+    THROTTLES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+                 'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown', 'ProvisionedThroughputExceededException')
+
+    @classmethod
+    def Hook(cls, client):
+        Region = client.meta.region_name
+        client.meta.events.register('before-call', cls.BeforeCall)
+        client.meta.events.register('needs-retry', cls.NeedsRetry)
+        client.meta.events.register('after-call', partial(cls.AfterCall, Region))
+
+    @staticmethod
+    def BeforeCall(context=None, **kwargs):
+        if context is not None:
+            context['dv_start'] = time.perf_counter()
+            context['dv_throttles'] = 0
+
+    @classmethod
+    def NeedsRetry(cls, response=None, request_dict=None, **kwargs):
+        # Count throttled attempts, retry decision left to botocore
+        if response and request_dict:
+            Code = (response[1] or {}).get('Error', {}).get('Code')
+            if Code in cls.THROTTLES:
+                Context = request_dict.get('context', {})
+                Context['dv_throttles'] = Context.get('dv_throttles', 0) + 1
+
+    @classmethod
+    def AfterCall(cls, Region, model=None, parsed=None, context=None, **kwargs):
+        if context is None or 'dv_start' not in context:
+            return
+        parsed = parsed or {}
+        Call = {'Operation': "{}.{}" .format(model.service_model.service_name, model.name), 'Region': Region,
+                'Latency': time.perf_counter() - context.pop('dv_start'),
+                'Retries': parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                'Throttles': context.pop('dv_throttles', 0), 'Error': parsed.get('Error', {}).get('Code'),
+                'Time': time.time()}
+        with cls.Lock:
+            cls.Calls.append(Call)
+
+    @staticmethod
+    def AddArgs(Parser):
+        Parser.add_argument('--trace', nargs='?', const='-', metavar='FILE', help='Print AWS API call summary at exit, optionally write calls as JSON lines to FILE')
+
+    @classmethod
+    def FromArgs(cls, args):
+        # Enable report at exit if --trace given
+        if getattr(args, 'trace', None):
+            atexit.register(cls.Report, None if args.trace == '-' else args.trace)
+
+    @staticmethod
+    def Percentile(LIST, P):
+        # Nearest rank percentile of sorted LIST
+        return LIST[max(0, int(math.ceil(P * len(LIST))) - 1)]
+
+    @classmethod
+    def Report(cls, File=None):
+        with cls.Lock:
+            Calls = list(cls.Calls)
+        if File:
+            with open(File, "a") as FILE:
+                for Call in Calls:
+                    FILE.write(json.dumps(Call) + "\n")
+        Ops = {}
+        for Call in Calls:
+            Ops.setdefault(Call['Operation'], []).append(Call)
+        print ("\n  {:<45} {:>6} {:>9} {:>9} {:>10} {:>7} {:>9} {:>6}" .format("Operation", "Count", "p50(ms)", "p95(ms)", "Total(ms)", "Retries", "Throttles", "Errors"), file=sys.stderr)
+        for Op, LIST in sorted(Ops.items(), key=lambda X: -sum(C['Latency'] for C in X[1])):
+            Lat = sorted(C['Latency'] * 1000 for C in LIST)
+            print ("  {:<45} {:>6} {:>9.1f} {:>9.1f} {:>10.1f} {:>7} {:>9} {:>6}" .format(Op, len(LIST), cls.Percentile(Lat, 0.5), cls.Percentile(Lat, 0.95), sum(Lat),
+                   sum(C['Retries'] for C in LIST), sum(C['Throttles'] for C in LIST), sum(1 for C in LIST if C['Error'])), file=sys.stderr)
+        print ("  {} calls, {:.1f}ms total API time, boto3 {}\n" .format(len(Calls), sum(C['Latency'] for C in Calls) * 1000, AWSBoto3.Stats()), file=sys.stderr)
 
 
 
 class AWSBoto3:
+    # Sessions and clients are pooled per process and shared by every AWSBoto3 instance, so calling
+    # Set*Client inside loops costs a dictionary lookup. Clients are thread safe and shared by worker
+    # threads, they are created under a lock as boto3 sessions are not thread safe.
+    # Resources are not thread safe and are pooled per thread.
+    Lock = threading.RLock()
+    Sessions = {}
+    Clients = {}
+    Local = threading.local()
+    Counters = {'sessions': 0, 'clients': 0, 'resources': 0}
+
     def __init__(self):
         global ec2client
         global ec2resource
@@ -123,29 +1607,67 @@ class AWSBoto3:
     def test(ARG):
         print ("Test class executed received ", ARG)
 
+    def Session(self, Profile):
+        # Return pooled boto3 session for Profile
+        with self.Lock:
+            session = self.Sessions.get(Profile)
+            if session is None:
+                session = boto3.Session(profile_name=Profile)
+                self.Sessions[Profile] = session
+                self.Counters['sessions'] += 1
+            return session
+
+    def Client(self, Service, Profile, Region, Endpoint=None):
+        # Return pooled client for (Profile, Region, Service)
+        Key = (Profile, Region, Service, Endpoint)
+        client = self.Clients.get(Key)
+        if client is None:
+            with self.Lock:
+                client = self.Clients.get(Key)
+                if client is None:
+                    client = self.Session(Profile).client(Service, region_name=Region, endpoint_url=Endpoint)
+                    APITrace.Hook(client)
+                    self.Clients[Key] = client
+                    self.Counters['clients'] += 1
+        return client
+
+    def Resource(self, Service, Profile, Region, Endpoint=None):
+        # Return resource for (Profile, Region, Service) pooled for calling thread
+        Pool = getattr(self.Local, 'Resources', None)
+        if Pool is None:
+            Pool = self.Local.Resources = {}
+        Key = (Profile, Region, Service, Endpoint)
+        resource = Pool.get(Key)
+        if resource is None:
+            with self.Lock:
+                resource = self.Session(Profile).resource(Service, region_name=Region, endpoint_url=Endpoint)
+                APITrace.Hook(resource.meta.client)
+                self.Counters['resources'] += 1
+            Pool[Key] = resource
+        return resource
+
+    @classmethod
+    def Stats(cls):
+        return "sessions={sessions} clients={clients} resources={resources}" .format(**cls.Counters)
+
     def SetEC2Client(self, Profile, Region):
         global ec2client
-        # Sets ec2 client with profile and Region.
-        print ("Client in class")
-        session = boto3.Session(profile_name=Profile)
-        ec2client = session.client('ec2', region_name=Region)
-        # return ec2client
+        # Sets ec2 client with profile and Region, global kept for older scripts.
+        ec2client = self.Client('ec2', Profile, Region)
+        return ec2client
 
 
     def SetEC2Resource(self, Profile, Region):
         # Sets ec2 client with profile and Region.
         global ec2resource
-        session = boto3.Session(profile_name=Profile)
-        ec2resource = session.resource('ec2', region_name=Region)
+        ec2resource = self.Resource('ec2', Profile, Region)
         return ec2resource
 
     def SetELBClient(self, Prof, Reg):
         try:
             # Sets elb client with profile and Region. Depending on the Boto3 funciton use client or resource.
-            session = boto3.Session(profile_name=Prof)
             # Set client for Classic Loadbalancer.
-            ec2client = session.client('elb', region_name=Reg)
-            return ec2client
+            return self.Client('elb', Prof, Reg)
         except Exception as ERR:
             print (" ERROR : Failed to set ec2client, please ensure arguments are passed. \n {}" .format(ERR))
             print(ERR)
@@ -154,12 +1676,68 @@ class AWSBoto3:
     def SetALBClient(self, Prof, Reg):
         try:
             # Sets elb client with profile and Region. Depending on the Boto3 funciton use client or resource.
-            session = boto3.Session(profile_name=Prof)
-            # Set client for Classic Loadbalancer.
-            ec2client = session.client('elbv2', region_name=Reg)
-            return ec2client
+            # Set client for Application Loadbalancer.
+            return self.Client('elbv2', Prof, Reg)
         except Exception as ERR:
             print (" ERROR : Failed to set ec2client, please ensure arguments are passed. \n {}" .format(ERR))
             sys.exit(1)
 
 
+# Print session/client counters at exit when DV_BOTO3_STATS is set
+if os.environ.get("DV_BOTO3_STATS"):
+    atexit.register(lambda: print (" INFO : boto3 {}" .format(AWSBoto3.Stats()), file=sys.stderr))
+
+
+
+# ----- dvclass can be run as script for CMDB tasks -----
+
+def main():
+    SCR_HOME = os.path.dirname(os.path.realpath(__file__))
+    P = argparse.ArgumentParser(description='CMDB tasks for dvclass')
+    Sub = P.add_subparsers(title="Required arguments", dest="Task")
+
+    Build = Sub.add_parser("build", help="Build CMDB from live EC2 inventory of all profiles and regions")
+    Build.add_argument('-p', '--profile', nargs='+', default=["default"], help='Profiles to query, default is default')
+    Build.add_argument('-r', '--region', nargs='+', help='Regions to query, default all enabled regions')
+    Build.add_argument('-o', '--output', default=os.environ.get("DV_CMDB") or SCR_HOME + "/mscallenv.txt", help='CMDB file to write, default is dvclass CMDB')
+    Build.add_argument('-i', '--incremental', action='store_true', help='Only re-fetch regions whose instance set changed since last run')
+    Build.add_argument('--tag', nargs='+', default=[], help='Column=TagKey mapping, eg Hostname=Name. Columns Topology Hostname Insttype TopoID')
+    Build.add_argument('--workers', type=int, default=16, help='Parallel (profile, region) fetches, default 16')
+    Build.add_argument('--endpoint-url', help='EC2 endpoint, eg local moto server')
+
+    Drift = Sub.add_parser("drift", help="Compare CMDB rows against live EC2 and report drift")
+    Drift.add_argument('-p', '--profile', nargs='+', default=["default"], help='Profiles to query, default is default')
+    Drift.add_argument('-c', '--cmdb', help='CMDB file, default is dvclass CMDB')
+    Drift.add_argument('--workers', type=int, default=16, help='Parallel describe calls, default 16')
+    Drift.add_argument('--endpoint-url', help='EC2 endpoint, eg local moto server')
+    AMSCMDB.AddSelectorArgs(Drift)
+
+    for X in (Build, Drift):
+        APITrace.AddArgs(X)
+
+    args = P.parse_args()
+    if args.Task is None:
+        P.print_help()
+        exit()
+    APITrace.FromArgs(args)
+
+    if args.Task == "build":
+        Tags = {}
+        for X in args.tag:
+            Column, _, Key = X.partition("=")
+            if Column not in CMDBBuilder.TAGS or not Key:
+                print (" ERROR : Invalid --tag {}, expecting Column=TagKey with Column one of {}" .format(X, " ".join(CMDBBuilder.TAGS)))
+                exit(1)
+            Tags[Column] = Key
+        if CMDBBuilder(args.profile, args.region, Tags, args.workers, args.endpoint_url).Build(args.output, args.incremental):
+            exit(1)
+
+    elif args.Task == "drift":
+        ams = AMSCMDB(Path=args.cmdb)
+        Records = ams.Query(**AMSCMDB.SelectorArgs(args))
+        if CMDBDrift(ams, args.profile, args.workers, args.endpoint_url).Report(Records):
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 # ----------------------------------------------------------------------------
 # Purpose : Attch snapshot to another instance, list snapshots, mount as another device.
 # Author:       Denny Vettom
-# Dependencies: Custom MSCCMDB, Aws cli with profile, boto3 and dvmodule.py
+# Dependencies: Custom MSCCMDB, Aws cli with profile, boto3 and dvclass.py
 # Improved version with sub menu and its own argument 
 # ----------------------------------------------------------------------------
 # Name          Date            Comment                         Version
@@ -13,7 +13,6 @@
 import boto3, time, re, sys, argparse
 import datetime, dateutil
 from dateutil import parser
-import dvmodule as dv #Custom module
 import dvclass 
 
 """
@@ -24,11 +23,13 @@ Copy : attach snapshot to dest with custom device name specified or xvdg. No dis
 List  : List snapshots taken in past 10days. Option to specify date as well as device name.
 Litvol : List volume information for host
 Rmvol : Detach and delete volume.
+Audit : Last snapshot age of every volume of topology hosts, volumes without recent snapshot flagged.
+Snap  : Snapshot one volume (-v), all volumes of host crash consistent (--all-volumes) or of every host of CMDB selectors,
+        tagged at creation. Created concurrently per region, --wait tracks all snapshots in one progress view.
+Sync  : Update local snapshot index (SQLite in DV_CACHE) with snapshots since last sync. list/clone/copy --index answer from it.
 
-Mostly use dvmodule, dvclass also used.
+Hosts are resolved from CMDB and AWS sessions pooled through dvclass.
 """
-# Below is CMDB file, if does not exist, skip the task
-LIST = "/Users/vettom/Scripts/Conf/mscallenv.txt"
 global ec2resource, ec2client
 
 Today = str(datetime.date.today())
@@ -56,12 +57,16 @@ Vol.add_argument('-s','--src_host', help='Source Hostname must be specified', re
 Vol.add_argument('-p','--profile', default="default", help='Default profile=default')
 
 # Create a snapshot
-Snapshot = Sub.add_parser("snap", help="Create snapshot of volume provided as argument")
-Snapshot.add_argument('-s','--src_host', help='Source Hostname must be specified', required=True)
-Snapshot.add_argument('-v','--volume', help='Volume ID', required=True)
+Snapshot = Sub.add_parser("snap", help="Create snapshot of volume, all volumes of host or all volumes of topology hosts")
+Snapshot.add_argument('-s','--src_host', help='Source Hostname, or use CMDB selectors for all volumes of many hosts')
+Snapshot.add_argument('-v','--volume', help='Volume ID')
+Snapshot.add_argument('--all-volumes', action='store_true', help='All volumes of src_host in one crash consistent set')
+Snapshot.add_argument('--exclude-boot', action='store_true', help='With --all-volumes or selectors, skip root volume')
 Snapshot.add_argument('-o','--owner', default="Vettom", help='Set to Vettom by defauly')
 Snapshot.add_argument('-p','--profile', default="default", help='Default profile=default')
 Snapshot.add_argument('-w','--wait', default=True, help='To skip waiting say no.')
+dvclass.AMSCMDB.AddSelectorArgs(Snapshot)
+dvclass.FanOut.AddArgs(Snapshot)
 
 # Used for replacing disk on destination host using snapshot from Source. Device can be specified but expect it to be valid at both ends
 Clone = Sub.add_parser("clone", help="Attach snap of Source disk to Dest by replacing dest_device")
@@ -93,6 +98,30 @@ Rmvol.add_argument('-s','--src_host', help='Source Hostname must be specified',
 Rmvol.add_argument('-p','--profile', default="default", help='Default profile=default')
 Rmvol.add_argument('--src_device', default="/dev/sdg", help='Disk Device name on Source host. Defaults to /dev/sdg')
 
+# Update local snapshot index, only snapshots since last sync are fetched
+Sync = Sub.add_parser("sync", help="Update local snapshot index of regions incrementally")
+Sync.add_argument('-p','--profile', default="default", help='Default profile=default')
+Sync.add_argument('-r','--region', nargs='+', help='Regions to sync, default all regions of AWS hosts in CMDB')
+Sync.add_argument('--full', action='store_true', help='Fetch all snapshots again and drop deleted ones from index')
+dvclass.FanOut.AddArgs(Sync)
+
+# Snapshot audit of all volumes of hosts picked by CMDB selectors, regions concurrently
+Audit = Sub.add_parser("audit", help="Last snapshot age of all volumes of topology hosts, flag volumes without recent snapshot")
+Audit.add_argument('-p','--profile', default="default", help='Default profile=default')
+Audit.add_argument('--max-age', type=float, default=24, help='Hours, volumes with older or no completed snapshot are flagged. Default 24')
+Audit.add_argument('--device', nargs='+', help='Only these devices eg /dev/xvdba, default all')
+dvclass.AMSCMDB.AddSelectorArgs(Audit)
+dvclass.FanOut.AddArgs(Audit)
+
+# --index answers snapshot lookups from local index, synced for host region first unless --no-sync
+for X in (List, Clone, Copy):
+    X.add_argument('--index', action='store_true', help='Use local snapshot index, synced incrementally for host region first')
+    X.add_argument('--no-sync', action='store_true', help='With --index, do not sync index before lookup')
+
+# --trace on every task, prints AWS API call summary at exit
+for X in (List, Vol, Snapshot, Clone, Copy, Rmvol, Sync, Audit):
+    dvclass.APITrace.AddArgs(X)
+
 args = P.parse_args()
 
 #  ---------------- End of Argument Parsing.  ---------------- 
@@ -100,7 +129,7 @@ args = P.parse_args()
 def GetVolume(instance_id, Region, Profile, Device, Hostname):
     # Get volume ID for the device specified
     try:
-        ec2resource = dv.SetEC2Resource(Profile, Region)
+        ec2resource = boto3.SetEC2Resource(Profile, Region)
         instance = ec2resource.Instance(instance_id)
         # Count number of devices if more than 2, expecting sda1 and xvdba
         if len(instance.block_device_mappings) > 2:
@@ -119,59 +148,158 @@ def GetVolume(instance_id, Region, Profile, Device, Hostname):
         exit(1)
 
 
-def PrintSnaps(Snapshot):
-    # Simply print snapshot details including the start time and state.
+def SnapWindow():
+    # First and last day of snapshots to consider, --start_date and 10 days before
+    Last = parser.parse(args.start_date).date()
+    return Last - datetime.timedelta(days=10), Last
+
+
+def PrintSnaps(Snapshots):
+    # Simply print snapshot details including the start time and state, snapshots already in window.
     try:
-        DateLimit= parser.parse(args.start_date).date() - datetime.timedelta(days=10)
-        # Process Snapshot list
+        Found = 0
         print("\n  Snapshots 10 days from ", args.start_date)
-        for X in Snapshot['Snapshots']:
-            if X.get('State') == "completed":
-                Snapdate = str(X.get('StartTime'))
-                # Show snapshots in between specified/today -10 days
-                if parser.parse(Snapdate).date() >= DateLimit and parser.parse(Snapdate).date() <=  parser.parse(args.start_date).date():
-                    SNAP = X.get('SnapshotId')
-                    print (SNAP, X.get('StartTime'), X.get('State'))
-            elif X.get('State') == "pending":
-                Snapdate = str(X.get('StartTime'))
-                SNAP = X.get('SnapshotId')
-                print (SNAP, X.get('StartTime'), X.get('State'), X.get('Progress'))
+        for X in Snapshots:
+            Found += 1
+            if X.get('State') == "pending":
+                print (X.get('SnapshotId'), X.get('StartTime'), X.get('State'), X.get('Progress'))
             else:
-                print (" ERROR: No Snapshots found!")
+                print (X.get('SnapshotId'), X.get('StartTime'), X.get('State'))
+        if not Found:
+            print (" ERROR: No Snapshots found!")
     except Exception as ERR:
         print (ERR)
         print (" ERROR : Failed to list Snapshots")
 
 
 def listsnapshots(VolumeID, Region, Profile):
-    # This gets list of snapshots are return to function for processing.
+    # Generator of own snapshots of volume started in window, streamed page by page.
+    # Window applied server side with a start-time wildcard per day, StartTime is returned as datetime
+    # so nothing is parsed. Checked again here in case filter is not applied (eg API stand-ins).
+    First, Last = SnapWindow()
+    Days = ["{}*" .format(First + datetime.timedelta(days=N)) for N in range((Last - First).days + 1)]
     try:
-        ec2client = dv.SetEC2Client(Profile, Region)
-        Result = ec2client.describe_snapshots(Filters=[{'Name': 'volume-id', 'Values': [VolumeID, ]}, ], )
-        return Result
-    except exception as ERR:
+        ec2client = boto3.SetEC2Client(Profile, Region)
+        Pages = ec2client.get_paginator('describe_snapshots').paginate(OwnerIds=['self'], Filters=[{'Name': 'volume-id', 'Values': [VolumeID]},
+                                                                                                 {'Name': 'start-time', 'Values': Days}])
+        for Page in Pages:
+            for X in Page['Snapshots']:
+                if First <= X['StartTime'].date() <= Last:
+                    yield X
+    except Exception as ERR:
         print (ERR)
         print (" ERROR : Failed to list Snapshot, please verify arguments like profile, host, disk etc")
         exit(1)
 
 
-def GetLatestSnap(Snapshot):
+def GetLatestSnap(Snapshots):
+    # Newest completed snapshot in window in one pass
     try:
-        DateLimit= parser.parse(args.start_date).date() - datetime.timedelta(days=10)
-        # Process Snapshot list and select latest based on date
-        for X in Snapshot['Snapshots']:
-            if X.get('State') == "completed":
-                Snapdate = str(X.get('StartTime'))
-                if parser.parse(Snapdate).date() >= DateLimit and parser.parse(Snapdate).date() <=  parser.parse(args.start_date).date():
-                    SNAP = X.get('SnapshotId')
-                    print (" INFO : Selected Snapshot ", SNAP, X.get('StartTime'))
-                    return SNAP
-            else:
-                print (" ERROR: No Snapshots found ")
+        Latest = max((X for X in Snapshots if X.get('State') == "completed"), key=lambda X: X['StartTime'], default=None)
     except Exception as ERR:
         print (ERR)
         print (" ERROR : Failed to get latest Snapshot information.")
         exit(1)
+    if Latest is None:
+        print (" ERROR: No completed Snapshots found between {} and {}" .format(*SnapWindow()))
+        exit(1)
+    print (" INFO : Selected Snapshot ", Latest['SnapshotId'], Latest['StartTime'])
+    return Latest['SnapshotId']
+
+
+def OpenIndex(Region):
+    # Local snapshot index, synced for Region unless --no-sync
+    Index = dvclass.SnapIndex(Profile, ams)
+    if not args.no_sync:
+        try:
+            Volumes, New, Pending, Deleted = Index.Sync(Region)
+        except Exception as ERR:
+            print (" ERROR : Failed to sync snapshot index for {}. {}" .format(Region, ERR))
+            exit(1)
+        print (" INFO : Snapshot index {} synced, {} new/updated, {} pending re-polled, {} removed" .format(Region, New, Pending, Deleted))
+    return Index
+
+
+def IndexLatestSnap(Region):
+    # Newest completed snapshot of src_host src_device in window from local index
+    First, Last = SnapWindow()
+    X = OpenIndex(Region).Latest(ams.GetHostname(args.src_host) or args.src_host, args.src_device, Last + datetime.timedelta(days=1), First)
+    if X is None:
+        print (" ERROR: No completed Snapshots of {} {} found in index between {} and {}" .format(args.src_host, args.src_device, First, Last))
+        exit(1)
+    print (" INFO : Selected Snapshot ", X['SnapshotId'], X['StartTime'])
+    return X['SnapshotId']
+
+
+# Instance / volume IDs per describe filter
+CHUNK = 200
+
+def RegionVolumes(Region, Records):
+    # Volumes attached to instances of Records (on --device only), one describe_volumes per CHUNK instances
+    ec2client = boto3.SetEC2Client(Profile, Region)
+    IDs = [Var.InstID for Var in Records]
+    Devices = [{'Name': 'attachment.device', 'Values': args.device}] if args.device else []
+    Volumes = []
+    for N in range(0, len(IDs), CHUNK):
+        for Page in ec2client.get_paginator('describe_volumes').paginate(Filters=[{'Name': 'attachment.instance-id', 'Values': IDs[N:N+CHUNK]}] + Devices):
+            Volumes.extend(Page['Volumes'])
+    return Volumes
+
+
+def RegionLastSnaps(Region, VolumeIDs):
+    # {VolumeId: newest completed snapshot}, one describe_snapshots per CHUNK volumes, one pass over results
+    ec2client = boto3.SetEC2Client(Profile, Region)
+    Latest = {}
+    for N in range(0, len(VolumeIDs), CHUNK):
+        for Page in ec2client.get_paginator('describe_snapshots').paginate(OwnerIds=['self'], Filters=[{'Name': 'volume-id', 'Values': VolumeIDs[N:N+CHUNK]}]):
+            for X in Page['Snapshots']:
+                if X.get('State') == "completed" and (X['VolumeId'] not in Latest or X['StartTime'] > Latest[X['VolumeId']]['StartTime']):
+                    Latest[X['VolumeId']] = X
+    return Latest
+
+
+def RegionAudit(Region, Records):
+    # [(Record, Device, Volume, Newest snapshot or None)] of one region
+    Volumes = RegionVolumes(Region, Records)
+    Latest = RegionLastSnaps(Region, [V['VolumeId'] for V in Volumes])
+    ByInstance = {}
+    for V in Volumes:
+        for A in V.get('Attachments', []):
+            ByInstance.setdefault(A.get('InstanceId'), []).append((A.get('Device'), V))
+    Result = []
+    for Var in Records:
+        for Device, V in sorted(ByInstance.get(Var.InstID, []), key=lambda X: X[0] or ""):
+            if args.device is None or Device in args.device:
+                Result.append((Var, Device, V, Latest.get(V['VolumeId'])))
+    return Result
+
+
+def AuditSnapshots(Records):
+    # Print last snapshot age per host and device, regions concurrently. Returns number of volumes flagged.
+    ByRegion = {}
+    for Var in Records:
+        ByRegion.setdefault(Var.Region, []).append(Var)
+    Regions = sorted(ByRegion)
+    Now = datetime.datetime.now(datetime.timezone.utc)
+    Flagged = 0
+    print ("\n  {:<30} {:<12} {:<22} {:>6}  {:<22} {:>8}  {}" .format("Host", "Device", "Volume", "GB", "Last snapshot", "Age(h)", ""))
+    for Region, (Result, ERR) in zip(Regions, dvclass.FanOut.FromArgs(args).Map((Region, RegionAudit, Region, ByRegion[Region]) for Region in Regions)):
+        if ERR:
+            print (" ERROR : Failed to audit snapshots in {} with Profile={}. {}" .format(Region, Profile, ERR))
+            Flagged += 1
+            continue
+        for Var, Device, V, X in Result:
+            Age = (Now - X['StartTime']).total_seconds() / 3600 if X else None
+            Flag = "NO SNAPSHOT" if X is None else "STALE" if Age > args.max_age else ""
+            Flagged += bool(Flag)
+            print ("  {:<30} {:<12} {:<22} {:>6}  {:<22} {:>8}  {}" .format(Var.Hostname, Device, V['VolumeId'], V.get('Size', ''), X['SnapshotId'] if X else "-",
+                   "{:.1f}" .format(Age) if X else "-", Flag))
+        Missing = set(Var.InstID for Var in ByRegion[Region]) - set(Var.InstID for Var, Device, V, X in Result)
+        for Var in ByRegion[Region]:
+            if Var.InstID in Missing:
+                print ("  {:<30} no volumes{}" .format(Var.Hostname, " matching " + " ".join(args.device) if args.device else ""))
+    print ("\n INFO : {} volumes without completed snapshot in last {} hours\n" .format(Flagged, args.max_age))
+    return Flagged
 
 
 def TestVar(Var):
@@ -190,7 +318,7 @@ def TestVar(Var):
 def StartInstance(Instance, Profile, Region):
     try:
         print (" INFO : Starting Instance " , Instance)
-        ec2client = dv.SetEC2Client(Profile, Region)
+        ec2client = boto3.SetEC2Client(Profile, Region)
         ec2client.start_instances(InstanceIds=[Instance])
         waiter = ec2client.get_waiter('system_status_ok')
         waiter.wait(InstanceIds=[Instance])
@@ -203,7 +331,7 @@ def StartInstance(Instance, Profile, Region):
 def StopInstance(Instance, Profile, Region):
     try:
         print (" INFO : Stoppign instance " , Instance)
-        ec2client = dv.SetEC2Client(Profile, Region)
+        ec2client = boto3.SetEC2Client(Profile, Region)
         ec2client.stop_instances(InstanceIds=[Instance])
         waiter = ec2client.get_waiter('instance_stopped')
         waiter.wait(InstanceIds=[Instance])
@@ -216,7 +344,7 @@ def StopInstance(Instance, Profile, Region):
 def CheckDeviceExist(instance_id, Region, Profile, Device, Hostname):
     # Function to check if the device already exist on the instance or not.
     try:
-        ec2resource = dv.SetEC2Resource(Profile, Region)
+        ec2resource = boto3.SetEC2Resource(Profile, Region)
         instance = ec2resource.Instance(instance_id)
         # Check all block devices and if matching return True
         for device in instance.block_device_mappings:
@@ -235,7 +363,7 @@ def ListVolume(instance_id, Region, Profile):
     try:
         try:
             # Generate list of volumes attached to the instance
-            ec2resource = dv.SetEC2Resource(Profile, Region)
+            ec2resource = boto3.SetEC2Resource(Profile, Region)
             instance = ec2resource.Instance(instance_id)
         except Exception as ERR:
             print(" ERROR : Failed to find instance using Profile={}, Region={}. Please check Profile/Region/Hostname" .format(Profile, Region))
@@ -250,7 +378,7 @@ def ListVolume(instance_id, Region, Profile):
 
         # List of Volumes are available as list in Volumes.Volume
         # Set Client for describing volume
-        ec2client = dv.SetEC2Client(Profile, Region)
+        ec2client = boto3.SetEC2Client(Profile, Region)
         # Loop through Volumes and print information
         for X in Volumes:
             Y = ec2client.describe_volumes(VolumeIds=[X])
@@ -267,53 +395,122 @@ def ListVolume(instance_id, Region, Profile):
         exit(1)
 
 
-def CreateSnapshot(Region,Vol):
-    # Setting some Default variables, this will be added to snapshot Tags by default
-    backup_type = "On Demand"
-    Comments = "Snapshot created in AWS, not visible in MSC"
-    StartTime = time.strftime('%Y-%m-%dT%H:%M:%S %Z')
-
+def SnapTags(Name, InstanceID):
+    # Default tags, set on snapshot at creation so no untagged snapshot is ever visible
+    return [{'ResourceType': 'snapshot', 'Tags': [{'Key': 'Name', 'Value': Name},
+                                                  {'Key': 'InstanceID', 'Value': InstanceID},
+                                                  {'Key': 'Type', 'Value': "On Demand"},
+                                                  {'Key': 'Comments', 'Value': "Snapshot created in AWS, not visible in MSC"},
+                                                  {'Key': 'Owner', 'Value': args.owner}]}]
 
 
+def CreateSnapshot(Region,Vol):
+    # Snapshot of one volume, tagged in same call. Returns snapshot
+    StartTime = time.strftime('%Y-%m-%dT%H:%M:%S %Z')
     try:
-        # Set EC2 variable with region, defaults to eu-west-1
-        ec2client = boto3.SetEC2Resource(Profile, Region)
-    except Exception as ERR:
-        print (" ERROR : Failed to set EC2Resourece with arguments Profile={}, Region={}, Volume={}. \n Error is {} " .format(Profile,Region,Vol,ERR))
-        exit()
-   
-    try:
-        # Create snapshot of the volume
-        snapshot = ec2client.create_snapshot(VolumeId=Vol, Description=args.src_host)
-        # Add tags to snapshot created.
-        snapshot.create_tags(Resources=[snapshot.id], Tags=[{'Key': 'Name', 'Value': args.src_host},
-                                                            {'Key': 'InstanceID', 'Value': args.src_host},
-                                                            {'Key': 'Type', 'Value': backup_type},
-                                                            {'Key': 'Comments', 'Value': Comments},
-                                                            {'Key': 'Owner', 'Value': args.owner}
-                                                            ])
-
-        # Print snapshot start message
-        print (" INFO : Starting backup of volume {} at " .format(Vol, StartTime))
-        print (" INFO : Snapshot ID is {} " .format(snapshot.id))
+        ec2client = boto3.SetEC2Client(Profile, Region)
+        snapshot = ec2client.create_snapshot(VolumeId=Vol, Description=args.src_host, TagSpecifications=SnapTags(args.src_host, args.src_host))
+        print (" INFO : Starting backup of volume {} at {}" .format(Vol, StartTime))
+        print (" INFO : Snapshot ID is {} " .format(snapshot['SnapshotId']))
     except Exception as ERR:
         print (" ERROR: Failed to trigger backup with arguments Profile={}, Region={}, Volume={}. \n Error is {} " .format(Profile,Region,Vol,ERR))
-        exit()
-    
-    # Check if need to wait for snapshot to complete
-    if args.wait is not True:
-        print (" INFO : Backup triggered for Volume {},  SnapID={}, please check progress separately. " .format(Vol,snapshot.id))
-    else:
-        # Wait for Snapshot status to be complete
-        snapshot.load()
-        while snapshot.state != 'completed':
-            print (" INFO : Snapshot Progress {} {}" .format(snapshot.state, snapshot.progress))
-            time.sleep(60)
-            snapshot.load()
-        else:
-            Endtime = time.strftime('%Y-%m-%dT%H:%M:%S %Z')
-            print (" INFO : Finished backup of volume {} at {}" .format(args.src_host, Endtime ))
-            print (" INFO : SnapshotID is {}" .format(snapshot.id))
+        exit(1)
+    return snapshot
+
+
+def CreateInstanceSnapshots(Var):
+    # All volumes of instance in one crash consistent set (same point in time across volumes), tagged at creation
+    ec2client = boto3.SetEC2Client(Profile, Var.Region)
+    Result = ec2client.create_snapshots(InstanceSpecification={'InstanceId': Var.InstID, 'ExcludeBootVolume': args.exclude_boot},
+                                        Description=Var.Hostname, TagSpecifications=SnapTags(Var.Hostname, Var.InstID))
+    return Result['Snapshots']
+
+
+def SnapshotHosts(Records):
+    # Snapshot sets of all Records, requests issued concurrently per region. Returns [(Region, Snapshot)] and failed hosts
+    Snaps = []
+    Failed = 0
+    Jobs = ((Var.Region, CreateInstanceSnapshots, Var) for Var in Records)
+    for Var, (Result, ERR) in zip(Records, dvclass.FanOut.FromArgs(args).Map(Jobs)):
+        if ERR:
+            print (" ERROR : Failed to snapshot {} {} in {}. {}" .format(Var.Hostname, Var.InstID, Var.Region, ERR))
+            Failed += 1
+            continue
+        for X in Result:
+            print (" INFO : {:<30} {:<22} {:>6}GB  {}" .format(Var.Hostname, X['VolumeId'], X.get('VolumeSize', ''), X['SnapshotId']))
+            Snaps.append((Var.Region, X))
+    return Snaps, Failed
+
+
+# Snapshot progress poll interval, doubled from START to MAX seconds
+SNAP_START = 5
+SNAP_MAX = 60
+
+def RegionSnapStates(Region, IDs):
+    # {SnapshotId: snapshot} of IDs, one describe_snapshots per CHUNK snapshots
+    ec2client = boto3.SetEC2Client(Profile, Region)
+    Result = {}
+    for N in range(0, len(IDs), CHUNK):
+        for Page in ec2client.get_paginator('describe_snapshots').paginate(OwnerIds=['self'], Filters=[{'Name': 'snapshot-id', 'Values': IDs[N:N+CHUNK]}]):
+            for X in Page['Snapshots']:
+                Result[X['SnapshotId']] = X
+    return Result
+
+
+def Progress(X):
+    # Snapshot progress as number, completed is 100 whatever Progress says
+    if X.get('State') == "completed":
+        return 100.0
+    try:
+        return float(str(X.get('Progress') or "0").rstrip('%'))
+    except ValueError:
+        return 0.0
+
+
+def WatchSnapshots(Snaps):
+    # Poll all snapshots until completed or error, regions concurrently with backoff, one progress line per poll:
+    # completed/total, average progress, GB of volumes covered, throughput and ETA. Returns number not completed.
+    State = dict((X['SnapshotId'], X) for Region, X in Snaps)
+    Region = dict((X['SnapshotId'], Region) for Region, X in Snaps)
+    Size = dict((X['SnapshotId'], X.get('VolumeSize') or 0) for Region, X in Snaps)
+    TotalGB = sum(Size.values())
+    Pool = dvclass.FanOut.FromArgs(args)
+    Start = time.perf_counter()
+    Delay = SNAP_START
+    Fails = {}
+    print ("\n INFO : Waiting for {} snapshots, {} GB of volumes in {} regions\n" .format(len(State), TotalGB, len(set(Region.values()))))
+    while True:
+        Pending = {}
+        for Id, X in State.items():
+            if X.get('State') not in ("completed", "error") and Fails.get(Region[Id], 0) < 3:
+                Pending.setdefault(Region[Id], []).append(Id)
+        Elapsed = time.perf_counter() - Start
+        Done = sum(X.get('State') == "completed" for X in State.values())
+        Errors = sum(X.get('State') == "error" for X in State.values())
+        DoneGB = sum(Size[Id] * Progress(X) / 100 for Id, X in State.items())
+        Rate = DoneGB / (Elapsed / 60) if Elapsed >= 1 else 0
+        ETA = str(datetime.timedelta(seconds=int((TotalGB - DoneGB) / Rate * 60))) if Rate and Pending else "-"
+        print ("  {:>8}  {}/{} completed  {} error  {:5.1f}%  {:.1f}/{} GB  {:.2f} GB/min  ETA {}" .format(str(datetime.timedelta(seconds=int(Elapsed))),
+               Done, len(State), Errors, sum(Progress(X) for X in State.values()) / max(len(State), 1), DoneGB, TotalGB, Rate, ETA))
+        if not Pending:
+            break
+        time.sleep(Delay)
+        Delay = min(Delay * 2, SNAP_MAX)
+        Regions = sorted(Pending)
+        for R, (Result, ERR) in zip(Regions, Pool.Map((R, RegionSnapStates, R, Pending[R]) for R in Regions)):
+            if ERR:
+                Fails[R] = Fails.get(R, 0) + 1
+                print (" ERROR : Failed to get snapshot progress in {} ({} of 3). {}" .format(R, Fails[R], ERR))
+                continue
+            Fails[R] = 0
+            State.update(Result)
+
+    Left = [Id for Id, X in State.items() if X.get('State') != "completed"]
+    for Id in Left:
+        print (" ERROR : Snapshot {} of {} in {} is {} {}" .format(Id, State[Id].get('VolumeId'), Region[Id], State[Id].get('State'), State[Id].get('StateMessage', '')))
+    print ("\n INFO : {} of {} snapshots completed in {}, finished at {}\n" .format(len(State) - len(Left), len(State),
+           str(datetime.timedelta(seconds=int(time.perf_counter() - Start))), time.strftime('%Y-%m-%dT%H:%M:%S %Z')))
+    return len(Left)
 
 
 #  ---------------- End of Functions  ---------------- 
@@ -331,31 +528,89 @@ def main():
     global ams
     boto3 = dvclass.AWSBoto3()
     ams = dvclass.AMSCMDB()
-# ----- First section ensuring CMDB file and able to find Instance details.
-    # Try to open CMDB file, if faild stop execution.
-    try:
-        FILE = open(LIST, "r")
-        Lines = FILE.readlines()
-        FILE.close()
-    except Exception as ERR:
-        print(ERR)
-        print ("ERROR : Failed to open File List ", LIST)
-        exit(1)
+    dvclass.APITrace.FromArgs(args)
+
+    if args.Task == "sync":
+        # No source host, regions from argument or CMDB
+        Regions = args.region or sorted(set(Var.Region for Var in ams.Query(Cloud='AWS')))
+        Index = dvclass.SnapIndex(Profile, ams)
+        Start = time.perf_counter()
+        for Region, Result, ERR in Index.SyncAll(Regions, dvclass.FanOut.FromArgs(args), args.full):
+            if ERR:
+                print (" ERROR : Failed to sync {}. {}" .format(Region, ERR))
+                continue
+            print (" INFO : {} volumes={} new/updated={} pending re-polled={} removed={}" .format(Region, *Result))
+        print (" INFO : Index {} synced in {:.1f}s" .format(Index.Path, time.perf_counter() - Start))
+        exit()
+
+    if args.Task == "audit":
+        # Hosts from CMDB selectors, no source host
+        Where = ams.SelectorArgs(args)
+        if not Where:
+            print ("\n ERROR : Please provide CMDB selector like \'--topology X\' or \'--topology X --role Dispatcher\'\n")
+            exit(1)
+        Records = ams.Query(**Where)
+        if not Records:
+            print ("\n ERROR : No hosts in CMDB match {}\n" .format(Where))
+            exit(1)
+        exit(1 if AuditSnapshots(Records) else 0)
+
+    if args.Task == "snap":
+        # Single volume, all volumes of src_host or all volumes of every host matching CMDB selectors
+        Where = ams.SelectorArgs(args)
+        if args.src_host and Where:
+            print ("\n ERROR : Please provide either -s HOST or CMDB selectors, not both\n")
+            exit(1)
+        if args.volume and (args.all_volumes or Where):
+            print ("\n ERROR : -v VOLUME is a single volume of -s HOST, not used with --all-volumes or selectors\n")
+            exit(1)
+        if args.src_host and not (args.volume or args.all_volumes):
+            print ("\n ERROR : Please provide -v VOLUME or --all-volumes with -s HOST\n")
+            exit(1)
+        if args.src_host:
+            Var = ams.FindRow(args.src_host)
+            if Var is None:
+                print ("\n ERROR : {} not found in CMDB\n" .format(args.src_host))
+                exit(1)
+            Records = [Var]
+        elif Where:
+            Records = ams.Query(**Where)
+            if not Records:
+                print ("\n ERROR : No hosts in CMDB match {}\n" .format(Where))
+                exit(1)
+        else:
+            print ("\n ERROR : Please provide -s HOST with -v VOLUME or --all-volumes, or CMDB selector like \'--topology X\'\n")
+            exit(1)
 
-    # Below command gets instance detals for the host from local file.
+        if args.volume:
+            Snaps, Failed = [(Var.Region, CreateSnapshot(Var.Region, args.volume))], 0
+        else:
+            print (" INFO : Snapshot all volumes of {} hosts in {} regions" .format(len(Records), len(set(Var.Region for Var in Records))))
+            Snaps, Failed = SnapshotHosts(Records)
+        # Check if need to wait for snapshots to complete
+        if args.wait is not True:
+            print (" INFO : Backup triggered for {} volumes, please check progress separately." .format(len(Snaps)))
+            exit(1 if Failed else 0)
+        exit(1 if WatchSnapshots(Snaps) or Failed else 0)
+
+# ----- First section ensuring able to find Instance details in CMDB.
     # If Source instance not found stop execution
-    try:
-        result = dv.GetInstanceDetails(args.src_host, Lines)
-        Region = result[0]
-        instance_id = result[1]
-    except Exception as ERR:
-        print (ERR)
-        print (" ERROR : Instance details not found in local file ",  LIST)
+    result = ams.GetInstAWS(args.src_host)
+    if result is None:
+        print (" ERROR : Instance details for {} not found in CMDB" .format(args.src_host))
         exit(1)
+    instance_id = result[0]
+    Region = result[2]
 
 
 # ------ Task for list option.
-    if args.Task == "list":
+    if args.Task == "list" and args.index:
+        First, Last = SnapWindow()
+        Index = OpenIndex(Region)
+        PrintSnaps(Index.Snapshots(ams.GetHostname(args.src_host) or args.src_host, args.src_device, First, Last))
+        exit()
+
+    elif args.Task == "list":
         try:
             print (" INFO : Using Profile : ", args.profile)
             Result = GetVolume(instance_id, Region, Profile, args.src_device, args.src_host)
@@ -384,17 +639,19 @@ def main():
 #-----Start of Clone. Source instance details already available
         try:
             # Get Destination host id and region.
-            result = dv.GetInstanceDetails(args.dest_host, Lines)
-            DestRegion = result[0]
-            Destinstance_id = result[1]
-            DestAZone = result[2]
+            result = ams.GetInstAWS(args.dest_host)
+            Destinstance_id = result[0]
+            DestRegion = result[2]
+            DestAZone = result[3]
         except Exception as ERR:
             print(ERR)
             print (" ERROR : ", args.dest_host, " Not found in CMDB")
             exit(1)
 
         # If snap_id not provided, use the default latest or prompt
-        if args.snap_id is None:
+        if args.snap_id is None and args.index:
+            SNAP_ID = IndexLatestSnap(Region)
+        elif args.snap_id is None:
             # Identify Disk information for Source Host
             Result = GetVolume(instance_id, Region, Profile, args.src_device, args.src_host)
             # result returns Volume and Device Name
@@ -433,8 +690,8 @@ def main():
             StopInstance(Destinstance_id, Profile, Region)
             print ( " INFO :", args.dest_host , " Stopped, detaching volume")
             # Set Boto3 resource for handling device.
-            ec2resource = dv.SetEC2Resource(Profile, Region)
-            ec2client = dv.SetEC2Client(Profile, Region)
+            ec2resource = boto3.SetEC2Resource(Profile, Region)
+            ec2client = boto3.SetEC2Client(Profile, Region)
             # Detach the volume and delete disk
             volume = ec2resource.Volume(DestVolumeID)
             try:
@@ -489,17 +746,19 @@ def main():
 #-----
         try:
             # Get Destination host id and region.
-            result = dv.GetInstanceDetails(args.dest_host, Lines)
-            DestRegion = result[0]
-            Destinstance_id = result[1]
-            DestAZone = result[2]
+            result = ams.GetInstAWS(args.dest_host)
+            Destinstance_id = result[0]
+            DestRegion = result[2]
+            DestAZone = result[3]
         except Exception as ERR:
             print(ERR)
             print (" ERROR : ", args.dest_host, " Not found in CMDB")
             exit(1)
 
         # If snap_id not provided, use latest snapshot of device src_device
-        if args.snap_id is None:
+        if args.snap_id is None and args.index:
+            SNAP_ID = IndexLatestSnap(Region)
+        elif args.snap_id is None:
             # If Snapshot ID not provided, use src_device to get latest snapshot and use it.
             try:
                 # Identify Disk information for Source Host. This can be used to find latest snapshot.
@@ -541,7 +800,7 @@ def main():
 
             try:
                 # Set Boto3 resource for handling device.
-                ec2resource = dv.SetEC2Resource(Profile, Region)
+                ec2resource = boto3.SetEC2Resource(Profile, Region)
                 print (" INFO : Creating Volume from Snapshot " , SNAP_ID, DestAZone, args.voltype)
                 if args.volsize is None:
                     # Create volume same size as snapshot
@@ -551,7 +810,7 @@ def main():
                     print (" INFO : Creating new volume with size {}GB" .format(args.volsize))
                     NewVol = ec2resource.create_volume(SnapshotId=SNAP_ID, AvailabilityZone=DestAZone, VolumeType=args.voltype, Size=int(args.volsize))
 
-                ec2client = dv.SetEC2Client(Profile, Region)
+                ec2client = boto3.SetEC2Client(Profile, Region)
                 waiter = ec2client.get_waiter('volume_available')
                 waiter.wait(VolumeIds=[NewVol.id])
                 print (" INFO : New Volume " , NewVol.id , "Created from " , SNAP_ID , " and is Available")
@@ -596,8 +855,8 @@ def main():
             
             if Respose == "y":
                  # Set Boto3 resource for handling device.
-                ec2resource = dv.SetEC2Resource(Profile, Region)
-                ec2client = dv.SetEC2Client(Profile, Region)
+                ec2resource = boto3.SetEC2Resource(Profile, Region)
+                ec2client = boto3.SetEC2Client(Profile, Region)
                 # Get Volume ID
 
                 # Detach the volume and delete disk
@@ -618,13 +877,6 @@ def main():
         else:
             print("\n ERROR : Dest Device name ", args.src_device, " not found on " , args.src_host )
 
-    elif args.Task == "snap":
-        # Get  region info and pass to function.
-        Result = ams.GetInstAWS(args.src_host)
-        Region = Result[2]
-        # Now ready to trigger Snapshot
-        CreateSnapshot(Region, args.volume)
-
 
     else:
         print("\n Sorry I did not get the options.. :(")
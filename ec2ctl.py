@@ -13,6 +13,13 @@
 '''
 Take hostname or instance ID as argument and perform action 
 Accepts Topoogy as argument and show status of all hosts in topology.
+Instead of hostnames, CMDB selectors (-t, --role, --size, --az, --region, --cloud) can pick hosts, eg
+    ec2ctl.py status -t vettomhotfix63 --role Publisher --az eu-west-1a
+    ec2ctl.py status --size 'm4.*' --region eu-central-1
+stop/start/restart/evacuate by selector need -t or --role in it, list matched hosts and ask to proceed unless --yes.
+members shows every ALB target group (and port) and classic ELB of hosts, evacuate removes hosts from all of them
+and saves what they were in, restore puts them back. One call per target group / ELB for all hosts, all concurrent.
+    ec2ctl.py evacuate -i dispatcher1 dispatcher2 ; ec2ctl.py restore -i dispatcher1 dispatcher2
 
 '''
 
@@ -20,35 +27,50 @@ import boto3,argparse,sys,time,re,os
 import dvclass
 
 argparser = argparse.ArgumentParser(description='Perform common instance tasks')
-argparser.add_argument('Task', choices=['start','stop','restart','status', 'topo'], help='Instance action to be performed list/start/stop/restart/status')
+argparser.add_argument('Task', choices=['start','stop','restart','status', 'topo', 'members', 'evacuate', 'restore'], help='Instance action to be performed list/start/stop/restart/status/members/evacuate/restore')
 argparser.add_argument('-i', '--instance', nargs='+', help='Hostnames or Aws instance IDs' )
 argparser.add_argument('-t', '--topology', help='Topology name to get status of all instances' )
 argparser.add_argument('-p', '--profile', default="default", help='If no profile provided, assumes default')
-# argparser.add_argument('--region', default="eu-west-1", help='Default is eu-west-1, or provide as argument')
+argparser.add_argument('-y', '--yes', action='store_true', help='stop/start/restart/evacuate hosts matched by selector without asking')
+# CMDB selectors --role --size --az --region --cloud, with -t can be used in place of -i
+dvclass.AMSCMDB.AddSelectorArgs(argparser, Topology=False)
+dvclass.APITrace.AddArgs(argparser)
+# members/evacuate/restore, --workers bound concurrent LB calls and --wait bounds wait for targets to settle
+dvclass.FanOut.AddArgs(argparser)
+dvclass.Converge.AddArgs(argparser)
 
 args = argparser.parse_args()
+# Instance IDs per describe_instances call
+CHUNK = 1000
 
-def InstanceStatus(Instance, Host, Region):
-    # Set ec2 client 
+def RegionStatus(Region, IDs):
+    # State of all IDs of one region, one paginated describe_instances call per CHUNK ids
     ec2client =DVboto3.SetEC2Client(Profile, Region)
-    try:
-        # Get instance details
-        Data = ec2client.describe_instances(InstanceIds=[Instance])
-        # Process the json to print the status. Using Tag CMDB_hostname to get hostname, update if required.
-    except Exception as ERR:
-        print(f'  ERROR: Failed to gent instance details, please ensure right profile and is AWS topology \n   Exception is {ERR}')
-        exit()
+    Status = {}
+    for N in range(0, len(IDs), CHUNK):
+        for Page in ec2client.get_paginator('describe_instances').paginate(InstanceIds=IDs[N:N + CHUNK]):
+            for X in Page['Reservations']:
+                for Y in X["Instances"]:
+                    Status[Y.get("InstanceId")] = Y.get('State').get('Name')
+    return Status
 
-    for X in Data['Reservations']:
-            for Y in X["Instances"]:
-                InstID = Y.get("InstanceId", "NULL")
-                InstanceType = Y.get("InstanceType", "NULL")
-                Status = Y.get('State').get('Name')
-                    
-            try:
-                print (f'  {Host} \t {Status}' )
-            except:
-                print ("  ERROR: Failed to get status for Host ", Host )
+def InstanceStatus(Records):
+    # Print status of all Records, hosts grouped by region and regions fetched concurrently
+    Regions = {}
+    for Var in Records:
+        Regions.setdefault(Var.Region, []).append(Var.InstID)
+    Status = {}
+    Pool = dvclass.FanOut.FromArgs(args)
+    for Region, (Result, ERR) in zip(Regions, Pool.Map((Region, RegionStatus, Region, IDs) for Region, IDs in Regions.items())):
+        if ERR:
+            print(f'  ERROR: Failed to gent instance details in {Region}, please ensure right profile and is AWS topology \n   Exception is {ERR}')
+            exit()
+        Status.update(Result)
+    for Var in Records:
+        if Var.InstID in Status:
+            print (f'  {Var.Hostname} \t {Status[Var.InstID]}' )
+        else:
+            print ("  ERROR: Failed to get status for Host ", Var.Hostname )
 
 
 def StopInstance(Instance, Host, Region):
@@ -81,11 +103,78 @@ def StartInstance(Instance, Host, Region):
         print (" ERROR : Failed to Start instance ", Host)
 
 
-def VerifyInstArgument(Arg):
-    if Arg is None:
-        print("  ERROR: Instance name must be provided as argument. -h for help ")
+def TargetInstances(Action=None):
+    # Hosts from -i, or all hosts matching CMDB selectors -t/--role/--size/--az/--region/--cloud
+    # Action (stop/start/restart/evacuate) by selector must name topology or role and is confirmed before use.
+    if args.instance:
+        return ResolveInstances(args.instance)
+    Where = ams.SelectorArgs(args)
+    if not Where:
+        print("  ERROR: Instance name or CMDB selector must be provided as argument. -h for help ")
         argparser.print_help()
         exit()
+    if Action and not ('Topology' in Where or 'Insttype' in Where):
+        print(f'  ERROR: Selector {Where} too broad to {Action}, add -t topology or --role, or name hosts with -i')
+        exit(1)
+    Records = ams.Query(**Where)
+    if not Records:
+        print(f'  ERROR: No instances in CMDB match {Where}')
+        exit()
+    if Action:
+        print("\n")
+        for Var in Records:
+            print(f'  {Var.Hostname} \t {Var.InstID} \t {Var.Region}')
+        print(f'\n  INFO: {len(Records)} instances match {Where}, will {Action} all of them')
+        if not args.yes:
+            try:
+                Respose = input("\n Proceed ? y/n :")
+            except EOFError:
+                Respose = ""
+            if Respose != "y":
+                print("  INFO: Nothing done, use --yes to skip this prompt")
+                exit(1)
+    return Records
+
+def ResolveInstances(Instances):
+    # Resolve all hosts in one CMDB pass, report all unknown hosts together and exit.
+    Groups, Unknown = ams.ResolveHosts(Instances)
+    if Unknown:
+        print(f'  ERROR: Hosts not found in CMDB or not AWS hosts : {" ".join(Unknown)}')
+        exit()
+    Records = []
+    for LIST in Groups.values():
+        Records.extend(LIST)
+    return Records
+
+def MemberName(Member):
+    if Member['Kind'] == 'alb':
+        return f"ALB {Member['LB']} TG {Member['TG']} port {Member['Port']}"
+    return f"ELB {Member['LB']}"
+
+def MembershipIndex(Pool, Records):
+    # Instance -> load balancer membership of every region of Records
+    try:
+        return dvclass.LBMembership(Profile, Pool).Build(Var.Region for Var in Records)
+    except Exception as ERR:
+        print(f'  ERROR: Failed to get load balancer membership, please ensure right profile \n   Exception is {ERR}')
+        exit()
+
+def ChangeMembers(Pool, Members, Attach):
+    # Register/deregister all [(InstID, Member)] in one pass, then wait for targets to settle
+    Watch = dvclass.Converge.FromArgs(Profile, args, Pool)
+    OK = True
+    for Member, Ids, ERR in dvclass.LBMembership(Profile, Pool).Change(Members, Attach):
+        Hosts = " ".join(ams.GetHostname(X) or X for X in Ids)
+        if ERR:
+            print(f'  ERROR: Failed to {"register" if Attach else "deregister"} {Hosts} on {MemberName(Member)} in {Member["Region"]} \n   Exception is {ERR}')
+            OK = False
+            continue
+        print(f'  SUCCESS: {Hosts} {"registered with" if Attach else "deregistered from"} {MemberName(Member)} in {Member["Region"]}')
+        if Member['Kind'] == 'alb':
+            Watch.AddTG(Member['LB'], Member['TG'], Member['Arn'], Member['Region'], Ids, Attach)
+        else:
+            Watch.AddELB(Member['LB'], Member['Region'], Ids, Attach)
+    return Watch.Report(ams) and OK
 
 def main():
     global Profile
@@ -94,62 +183,37 @@ def main():
     Profile = args.profile
     DVboto3 = dvclass.AWSBoto3()
     ams = dvclass.AMSCMDB()
+    dvclass.APITrace.FromArgs(args)
     
     # Ready to take action based on input
     if args.Task == "status":
-        VerifyInstArgument(args.instance)
         print("\n")
-        # Loop through instance and take action
-        for X in args.instance:
-            Result = ams.GetInstAWS(X)
-            # instance_id, Host, Region, AZ, VPC
-            InstID = Result[0]
-            HostName = Result[1]
-            Region = Result[2]
-            InstanceStatus(InstID,HostName,Region)
+        InstanceStatus(TargetInstances())
         print("\n")
 
     elif args.Task == "stop":
-        VerifyInstArgument(args.instance)
         print("\n")
         # Loop through instance and take action
-        for X in args.instance:
-            Result = ams.GetInstAWS(X)
-            # instance_id, Host, Region, AZ, VPC
-            InstID = Result[0]
-            HostName = Result[1]
-            Region = Result[2]
-            StopInstance(InstID,HostName,Region)
+        for Var in TargetInstances("stop"):
+            StopInstance(Var.InstID,Var.Hostname,Var.Region)
 
         print("\n")
 
     elif args.Task == "start":
-        VerifyInstArgument(args.instance)
         print("\n")
         # Loop through instance and take action
-        for X in args.instance:
-            Result = ams.GetInstAWS(X)
-            # instance_id, Host, Region, AZ, VPC
-            InstID = Result[0]
-            HostName = Result[1]
-            Region = Result[2]
-            StartInstance(InstID,HostName,Region)
+        for Var in TargetInstances("start"):
+            StartInstance(Var.InstID,Var.Hostname,Var.Region)
 
         print("\n")
 
     elif args.Task == "restart":
-        VerifyInstArgument(args.instance)
         print("\n")
 
-        for X in args.instance:
-            Result = ams.GetInstAWS(X)
-            # instance_id, Host, Region, AZ, VPC
-            InstID = Result[0]
-            HostName = Result[1]
-            Region = Result[2]
-            StopInstance(InstID,HostName,Region) 
+        for Var in TargetInstances("restart"):
+            StopInstance(Var.InstID,Var.Hostname,Var.Region) 
             time.sleep(3)
-            StartInstance(InstID,HostName,Region)    
+            StartInstance(Var.InstID,Var.Hostname,Var.Region)    
 
     elif args.Task == "topo":
         # Print status of all instances in topology
@@ -158,21 +222,69 @@ def main():
             print( "  ERROR: Topology argument must be provided. -h for help")
             exit()
 
-        # Get instance information for topology and get status.
-        Result = ams.GetInstanceforTopo(args.topology)
-        if len(Result) is 0:
+        # Get instance information for topology, narrowed by any other selector, and get status.
+        Result = ams.Query(**ams.SelectorArgs(args))
+        if len(Result) == 0:
             print(f'  ERROR: No instances found for {args.topology}, verify topology name and is it AWS topology? \n')
             exit()
         
         print("\n")
-        # Loop through instance and take action
-        for X in Result:
-            Result = ams.GetInstAWS(X)
-            # instance_id, Host, Region, AZ, VPC
-            InstID = Result[0]
-            HostName = Result[1]
-            Region = Result[2]
-            InstanceStatus(InstID,HostName,Region)
+        InstanceStatus(Result)
+        print("\n")
+
+    elif args.Task == "members":
+        # Every target group and ELB each host is registered with, from one index of all its regions
+        Records = TargetInstances()
+        Index = MembershipIndex(dvclass.FanOut.FromArgs(args), Records)
+        print("\n")
+        for Var in Records:
+            print(f'  {Var.Hostname} \t {Var.InstID} \t {Var.Region}')
+            for Member in Index.get(Var.InstID, []):
+                print(f'\t  {MemberName(Member)} \t {Member["State"]}')
+            if Var.InstID not in Index:
+                print('\t  Not registered with any load balancer')
+        print("\n")
+
+    elif args.Task == "evacuate":
+        # Save memberships of each host, then deregister all hosts from everything in one batched pass.
+        # Memberships are added to what was saved before, so evacuate run again after a partial failure loses nothing.
+        Records = TargetInstances("evacuate")
+        Pool = dvclass.FanOut.FromArgs(args)
+        Index = MembershipIndex(Pool, Records)
+        LB = dvclass.LBMembership(Profile, Pool)
+        Members = []
+        print("\n")
+        for Var in Records:
+            if Var.InstID not in Index:
+                print(f'  INFO: {Var.Hostname} not registered with any load balancer, skipped')
+                continue
+            LB.Save(Var.InstID, Index[Var.InstID])
+            Members += [(Var.InstID, Member) for Member in Index[Var.InstID]]
+        if Members and not ChangeMembers(Pool, Members, False):
+            exit(1)
+        print("\n")
+
+    elif args.Task == "restore":
+        # Register hosts back with everything evacuate removed them from, in one batched pass.
+        # Saved state is cleared only when every membership is back and settled, else kept for another restore.
+        Records = TargetInstances()
+        Pool = dvclass.FanOut.FromArgs(args)
+        LB = dvclass.LBMembership(Profile, Pool)
+        Members = []
+        Restored = []
+        print("\n")
+        for Var in Records:
+            State = LB.Saved(Var.InstID)
+            if State is None:
+                print(f'  ERROR: No saved load balancer membership for {Var.Hostname}, skipped')
+                continue
+            print(f'  INFO: {Var.Hostname} back to {len(State["Members"])} load balancers saved {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(State["Time"]))}')
+            Members += [(Var.InstID, Member) for Member in State['Members']]
+            Restored.append(Var.InstID)
+        if Members and not ChangeMembers(Pool, Members, True):
+            exit(1)
+        for InstID in Restored:
+            LB.Clear(InstID)
         print("\n")
 
 
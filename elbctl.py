@@ -15,11 +15,12 @@ Script for list/status/attach/detach tasks. Default variables Profile=default, R
 list  : can take Topology as argument and display all ELB for the topology
 Status : Accepts Topology or one or more ELB as argument and shows status
 At/Detach : Accepts 1 or more ELB and Hostsor instance ID as argument. For each elb same set of actions performed with hosts
-            All ELB must be in same region.
+            One register/deregister call per ELB and region, ELB processed concurrently.
 """
 
 import boto3,argparse,sys,time,re,os
 import dvclass
+from botocore.exceptions import ClientError
 
 SCR_HOME = os.path.dirname(os.path.realpath(__file__))
 
@@ -57,6 +58,17 @@ Detach.add_argument('-i', '--instances', nargs='+', help='Dispatcher Hostnames o
 Detach.add_argument('-p', '--profile', default="default", help='If no profile provided, assumes default')
 Detach.add_argument('-r', '--region', default="eu-west-1", help='Default is eu-west-1, or provide as argument')
 
+# --trace on every task, prints AWS API call summary at exit
+for X in (List, Status, Attach, Detach):
+    dvclass.APITrace.AddArgs(X)
+# --wait bounds wait for instances to settle after attach/detach, --workers/--region-workers concurrent ELB calls
+for X in (Attach, Detach):
+    dvclass.Converge.AddArgs(X)
+for X in (Status, Attach, Detach):
+    dvclass.FanOut.AddArgs(X)
+# --async runs status health calls on asyncio (aiobotocore)
+dvclass.AsyncLB.AddArgs(Status)
+
 # Parse Arguments
 args = P.parse_args()
 # Eit programme if no arguments provided. Print help
@@ -71,115 +83,111 @@ Region = args.region
 # Start of Functions. -----********------
 
 def ListallELB(VPC, Region):
-    # List and display all ELB in provided region. If VPC argument provided, will only show ELB attached to those VPC
-    ec2client = boto3.SetELBClient(Profile, Region)
-    try: Result = ec2client.describe_load_balancers()
-    except exception as ERR: print (" ERROR : Failed to get ELB list ", ERR)
-    # Process the output and print the list
+    # List and display all ELB of VPC in provided region from region inventory
     try:
-        print ("\n  ELB's in {} in {} region using profile {}. " .format(VPC,Region,Profile))
-        for X in Result['LoadBalancerDescriptions']:
-            ELB = X.get('LoadBalancerName', 'NULL')
-            VPCID = X.get('VPCId', 'NULL')
-            if VPC == VPCID:
-                print ("  {} " .format(ELB))
-                
-
-        print ("\n")
-    except: print("Failed to process Result to list ELB. ")
-
-def Elbstatus(Var,Region):
-    # Var = ELB name
+        Result = dvclass.LBInventory(Profile, 'elb').ByVPC(VPC, Region)
+    except Exception as ERR:
+        print (" ERROR : Failed to get ELB list ", ERR)
+        return
+    print ("\n  ELB's in {} in {} region using profile {}. " .format(VPC,Region,Profile))
+    for X in Result:
+        print ("  {} " .format(X.get('LoadBalancerName', 'NULL')))
+    print ("\n")
+
+def InstanceHealth(ELB, Region):
     ec2client = boto3.SetELBClient(Profile, Region)
-    try:
-        print("\n  ELB {} in {}  " .format(Var, Region))
-        Result = ec2client.describe_instance_health(LoadBalancerName=Var)
-        # Process Result and display
-        for X in Result['InstanceStates']:
+    return ec2client.describe_instance_health(LoadBalancerName=ELB)['InstanceStates']
+
+def ElbStatusAll(ELBList):
+    # ELBList = [(ELB, Region)]. Instance health of all ELB fetched concurrently on threads, or asyncio with --async.
+    # Output follows ELBList order.
+    Engine = dvclass.AsyncLB.FromArgs(Profile, args)
+    if Engine:
+        Health = Engine.Map((REGION, Engine.InstanceHealth, REGION, ELB) for ELB, REGION in ELBList)
+    else:
+        Health = dvclass.FanOut.FromArgs(args).Map((REGION, InstanceHealth, ELB, REGION) for ELB, REGION in ELBList)
+    for (ELB, REGION), (Result, ERR) in zip(ELBList, Health):
+        print("\n  ELB {} in {}  " .format(ELB, REGION))
+        if ERR:
+            print(" ERROR : Failed to get ELB status using ELB={}, Region={}, Profile={}. \n ERROR : {}" .format(ELB,REGION,Profile,ERR))
+            continue
+        for X in Result:
             InstID = X.get('InstanceId')
             InstName = ams.GetHostname(InstID)
             print (InstName, '\t', InstID, '\t', X.get('State'))
 
-    except Exception as ERR:
-        print(" ERROR : Failed to get ELB status using ELB={}, Region={}, Profile={}. \n ERROR : {}" .format(Var,Region,Profile,ERR))
-    # 
-    # Now process Result and Get hostname to print.
+def Elbstatus(Var,Region):
+    # Var = ELB name
+    ElbStatusAll([(Var, Region)])
+
 def GetElbList(VPC, Region):
-    # Return list of ELB 
-    ec2client = boto3.SetELBClient(Profile, Region)
-    try: Result = ec2client.describe_load_balancers()
-    except exception as ERR: print (" ERROR : Failed to get ELB list ", ERR)
-    # Process the output and print the list
-    LIST = []
+    # Return list of ELB of VPC from region inventory
     try:
-        for X in Result['LoadBalancerDescriptions']:
-            ELB = X.get('LoadBalancerName', 'NULL')
-            VPCID = X.get('VPCId', 'NULL')
-            if VPC == VPCID:
-                LIST.append(ELB)
-        return LIST
-    except: print("Failed to process Result to list ELB. ")   
-
-def AtachinstancetoELB(ELB, Instances):
-    # Loop through Instances and issue attach command
-    for I in Instances:
-        try: 
-            # Call function that gets instance information like ID,host, Region, AZ, VPC
-            global Region
-            AWSinfo = ams.GetInstAWS(I)
-            InstID = AWSinfo[0]
-            Host = AWSinfo[1]
-            Region = AWSinfo[2]
-            if InstID is None:
-                print (" \nERROR : Failed to get Instance ID for {}. Please chek Instance ID/Hostname provided. " .format(I))
-                exit()
-        except Exception as ERR:
-            print (" ERROR : Failed to get Instance ID for {} \n {} " .format(I,ERR))
-
-        try:
-            ec2client = boto3.SetELBClient(Profile, Region)
-            Result = ec2client.register_instances_with_load_balancer(\
-                LoadBalancerName=ELB, \
-                Instances=[{'InstanceId': InstID},])
-            
-            print (" INFO : Attached {} to ELB {}.  " .format(Host,ELB))
-        except Exception as ERR:
-            print (" \nERROR: Failed to attach Host {} {} to {} \n {}" .format(Host,InstID,ELB,ERR))
-
-
-def DetachfromELB(ELB, Instances):
-    # Loop through Instances and issue attach command
-    for I in Instances:
-        try: 
-            # Call function that gets instance information like ID,host, Region, AZ, VPC
-            global Region
-            AWSinfo = ams.GetInstAWS(I)
-            InstID = AWSinfo[0]
-            Host = AWSinfo[1]
-            Region = AWSinfo[2]
-            if InstID is None:
-                print (" \nERROR : Failed to get Instance ID for {}. Please chek Instance ID/Hostname provided. " .format(I))
-                exit()
-        except Exception as ERR:
-            print (" ERROR : Failed to get Instance ID for {} \n {} " .format(I,ERR))
-
+        Result = dvclass.LBInventory(Profile, 'elb').ByVPC(VPC, Region)
+    except Exception as ERR:
+        print (" ERROR : Failed to get ELB list ", ERR)
+        return []
+    return [X.get('LoadBalancerName', 'NULL') for X in Result]
+
+def ResolveInstances(Instances):
+    # Resolve all hosts in one CMDB pass, report all unknown hosts together and exit.
+    # Returns {Region: [Records]}
+    Groups, Unknown = ams.ResolveHosts(Instances)
+    if Unknown:
+        print (" \nERROR : Failed to get Instance ID for {}. Please chek Instance ID/Hostname provided. " .format(" ".join(Unknown)))
+        exit()
+    ByRegion = {}
+    for (REGION, VPC), LIST in Groups.items():
+        ByRegion.setdefault(REGION, []).extend(LIST)
+    return ByRegion
+
+def ELBCall(Func, ELB, Records):
+    # Call register/deregister with all instances. An invalid instance fails whole call, so instances named
+    # in InvalidInstance error are set aside and call repeated for the rest. Returns response, records set aside
+    Pending = list(Records)
+    Failed = []
+    while Pending:
         try:
-            ec2client = boto3.SetELBClient(Profile, Region)
-            Result = ec2client.deregister_instances_from_load_balancer(\
-                LoadBalancerName=ELB, \
-                Instances=[{'InstanceId': InstID},])
-            
-            print (" INFO : Detached {} from ELB {}. " .format(Host,ELB))
-        except Exception as ERR:
-            print (" \nERROR: Failed to detach Host {} {} to {} \n {}" .format(Host,InstID,ELB,ERR))
+            return Func(LoadBalancerName=ELB, Instances=[{'InstanceId': Var.InstID} for Var in Pending]), Failed
+        except ClientError as ERR:
+            Bad = set(re.findall(r'i-[0-9a-f]+', ERR.response['Error'].get('Message', '')))
+            if ERR.response['Error']['Code'] != 'InvalidInstance' or not Bad & set(Var.InstID for Var in Pending):
+                raise
+            Failed.extend(Var for Var in Pending if Var.InstID in Bad)
+            Pending = [Var for Var in Pending if Var.InstID not in Bad]
+    return {}, Failed
+
+def AtachinstancetoELB(ELB, REGION, Records):
+    # One register call for all instances of region. Response lists every instance now on ELB,
+    # instances missing from it were not registered. Returns records attached, records failed
+    ec2client = boto3.SetELBClient(Profile, REGION)
+    Result, Failed = ELBCall(ec2client.register_instances_with_load_balancer, ELB, Records)
+    Listed = set(X['InstanceId'] for X in Result.get('Instances', []))
+    if not Listed:
+        # Response without instance list, nothing to check against
+        Listed = set(Var.InstID for Var in Records)
+    Records = [Var for Var in Records if Var not in Failed]
+    return [Var for Var in Records if Var.InstID in Listed], Failed + [Var for Var in Records if Var.InstID not in Listed]
+
+
+def DetachfromELB(ELB, REGION, Records):
+    # One deregister call for all instances of region. Response lists instances still on ELB,
+    # requested instances still listed were not deregistered. Returns records detached, records failed
+    ec2client = boto3.SetELBClient(Profile, REGION)
+    Result, Failed = ELBCall(ec2client.deregister_instances_from_load_balancer, ELB, Records)
+    Listed = set(X['InstanceId'] for X in Result.get('Instances', []))
+    Records = [Var for Var in Records if Var not in Failed]
+    return [Var for Var in Records if Var.InstID not in Listed], Failed + [Var for Var in Records if Var.InstID in Listed]
 
 # Start of Main Section. -----********------
 
 def main():
     global boto3
     global ams
+    dvclass.AsyncLB.Check(args)
     boto3 = dvclass.AWSBoto3()
     ams = dvclass.AMSCMDB()
+    dvclass.APITrace.FromArgs(args)
     # Set ec2 client from Class
     ec2client = boto3.SetELBClient(Profile, Region)
     
@@ -197,8 +205,9 @@ def main():
                 exit()
 
             # At this stage we have Result with values, so continue
-            # Result can have multiple entries for multiple regions
-            for X in Result:
+            # Result can have multiple entries for multiple regions, load each region once concurrently
+            dvclass.LBInventory(Profile, 'elb').Prefetch(X.split()[1] for X in Result)
+            for X in sorted(Result):
                 Y = X.split()
                 VPC = Y[0]
                 REGION = Y[1]
@@ -228,54 +237,49 @@ def main():
                 print ("\n ERROR : Topology not found in CMDB or it is not AWS Topology \n")
                 exit()
 
-            for X in Result:
+            dvclass.LBInventory(Profile, 'elb').Prefetch(X.split()[1] for X in Result)
+            ELBList = []
+            for X in sorted(Result):
                 Y = X.split()
                 VPC = Y[0]
                 REGION = Y[1]
-                # Now for each VPC get list of ELB and status
+                # Now for each VPC get list of ELB, status of all ELB in one concurrent pass
                 Result = GetElbList(VPC,REGION)
                 for ELB in Result:
-                    Elbstatus(ELB, REGION)
+                    ELBList.append((ELB, REGION))
+            ElbStatusAll(ELBList)
             exit()
 
         if args.elb:
-            for ELB in args.elb:
-                # Call the elbstatus function
-                Elbstatus(ELB,Region)
+            ElbStatusAll([(ELB, Region) for ELB in args.elb])
             exit()
 
 
-    elif args.Task == "attach":
-        #Loop through the ELB provided and call attach function. At end wait few seconds before issuing status
-        for ELB in args.elb:
-            AtachinstancetoELB(ELB, args.instances)
-
-        # At end sleep for few seconds then status
-        print ("\n INFO : Waiting 20 seconds before checking status...")
-        time.sleep(20)
-        for ELB in args.elb:
-            Elbstatus(ELB,Region)
-
-
-
-    elif args.Task == "detach":
-        #Loop through the ELB provided and call attach function. At end wait few seconds before issuing status
-        for ELB in args.elb:
-            DetachfromELB(ELB, args.instances)
-
-        # At end sleep for few seconds then status
-        print ("\n INFO : Waiting 20 seconds before checking status...")
-        time.sleep(20)
-        for ELB in args.elb:
-            Elbstatus(ELB,Region)
-        
-
-    
-
-
-
-
-
+    elif args.Task in ("attach", "detach"):
+        #Resolve hosts once, one register/deregister call per ELB and region, all ELB concurrently.
+        #Then poll all ELB together until instances are InService (attach) or gone (detach) and print time taken.
+        ByRegion = ResolveInstances(args.instances)
+        Pool = dvclass.FanOut.FromArgs(args)
+        Watch = dvclass.Converge.FromArgs(Profile, args, Pool)
+        Attach = args.Task == "attach"
+        Func = AtachinstancetoELB if Attach else DetachfromELB
+        Jobs = [(ELB, REGION, Records) for ELB in args.elb for REGION, Records in ByRegion.items()]
+        OK = True
+        for (ELB, REGION, Records), (Result, ERR) in zip(Jobs, Pool.Map((REGION, Func, ELB, REGION, Records) for ELB, REGION, Records in Jobs)):
+            if ERR:
+                print (" \nERROR: Failed to {} {} {} ELB {} \n {}" .format(args.Task, " ".join(Var.Hostname for Var in Records), "to" if Attach else "from", ELB, ERR))
+                OK = False
+                continue
+            Done, Failed = Result
+            OK = OK and not Failed
+            for Var in Done:
+                print (" INFO : {} {} {} ELB {}. " .format("Attached" if Attach else "Detached", Var.Hostname, "to" if Attach else "from", ELB))
+            for Var in Failed:
+                print (" \nERROR: Failed to {} Host {} {} {} {}" .format(args.Task, Var.Hostname, Var.InstID, "to" if Attach else "from", ELB))
+            if Done:
+                Watch.AddELB(ELB, REGION, [Var.InstID for Var in Done], Attach)
+        OK = Watch.Report(ams) and OK
+        exit(0 if OK else 1)
 
 
 if __name__ == "__main__":
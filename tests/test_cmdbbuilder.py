@@ -0,0 +1,97 @@
+import os, stat
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import dvclass
+
+REGIONS = ['eu-west-1', 'eu-central-1']
+
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    (tmp_path / 'credentials').write_text("[default]\naws_access_key_id = testing\naws_secret_access_key = testing\n")
+    (tmp_path / 'config').write_text("[default]\nregion = eu-west-1\n")
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'config'))
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'credentials'))
+    with mock_aws():
+        yield
+
+
+def Launch(Region, Host, Topology='topoA'):
+    ec2 = boto3.client('ec2', region_name=Region)
+    Tags = [{'Key': 'Role', 'Value': 'Dispatcher'}]
+    if Topology:
+        Tags += [{'Key': 'Topology', 'Value': Topology}, {'Key': 'CMDB_hostname', 'Value': Host}]
+    Inst = ec2.run_instances(ImageId='ami-12c6146b', MinCount=1, MaxCount=1, InstanceType='m4.large',
+                             TagSpecifications=[{'ResourceType': 'instance', 'Tags': Tags}])['Instances'][0]
+    return Inst['InstanceId']
+
+
+def Rows(Output):
+    with open(Output) as FILE:
+        return dict((Var[3], Var) for Var in (Line.split() for Line in FILE) if len(Var) == 12 and Var[11] == 'AWS')
+
+
+def test_build(aws, tmp_path):
+    ID = Launch('eu-west-1', 'dispatcher1')
+    Launch('eu-central-1', 'dispatcher2')
+    Launch('eu-west-1', 'untagged', Topology=None)
+    Output = str(tmp_path / 'mscallenv.txt')
+    with open(Output, 'w') as FILE:
+        FILE.write("# header\nonprem 1.1.1.1 10.1.1.1 host1 dc1 NULL NULL Web NULL NULL NULL DC\n")
+
+    assert dvclass.CMDBBuilder(['default'], REGIONS).Build(Output) == []
+    Found = Rows(Output)
+    assert sorted(Found) == ['dispatcher1', 'dispatcher2']
+    Var = Found['dispatcher1']
+    assert (Var[0], Var[4], Var[6], Var[7], Var[8]) == ('topoA', 'eu-west-1', ID, 'Dispatcher', 'm4.large')
+    with open(Output) as FILE:
+        assert "host1" in FILE.read()
+    assert stat.S_IMODE(os.stat(Output).st_mode) == 0o644
+
+
+def test_failed_region_keeps_rows(aws, tmp_path, monkeypatch):
+    Launch('eu-west-1', 'dispatcher1')
+    Launch('eu-central-1', 'dispatcher2')
+    Output = str(tmp_path / 'mscallenv.txt')
+    dvclass.CMDBBuilder(['default'], REGIONS).Build(Output)
+
+    Fetch = dvclass.CMDBBuilder.Fetch
+    def Broken(self, Profile, Region, State=None):
+        if Region == 'eu-central-1':
+            raise RuntimeError('region down')
+        return Fetch(self, Profile, Region, State)
+    monkeypatch.setattr(dvclass.CMDBBuilder, 'Fetch', Broken)
+    assert dvclass.CMDBBuilder(['default'], REGIONS).Build(Output) == [('default', 'eu-central-1')]
+    assert sorted(Rows(Output)) == ['dispatcher1', 'dispatcher2']
+
+
+def test_incremental_fetches_changed_regions(aws, tmp_path, capsys):
+    Launch('eu-west-1', 'dispatcher1')
+    Launch('eu-central-1', 'dispatcher2')
+    Output = str(tmp_path / 'mscallenv.txt')
+    dvclass.CMDBBuilder(['default'], REGIONS).Build(Output, Incremental=True)
+    assert os.path.exists(Output + '.state')
+    capsys.readouterr()
+
+    dvclass.CMDBBuilder(['default'], REGIONS).Build(Output, Incremental=True)
+    Out = capsys.readouterr().out
+    assert "eu-west-1 1 rows (unchanged)" in Out and "eu-central-1 1 rows (unchanged)" in Out
+
+    Launch('eu-west-1', 'dispatcher3')
+    dvclass.CMDBBuilder(['default'], REGIONS).Build(Output, Incremental=True)
+    Out = capsys.readouterr().out
+    assert "eu-west-1 2 rows (fetched)" in Out and "eu-central-1 1 rows (unchanged)" in Out
+    assert sorted(Rows(Output)) == ['dispatcher1', 'dispatcher2', 'dispatcher3']
+
+
+def test_incremental_refreshes_old_state(aws, tmp_path, capsys, monkeypatch):
+    Launch('eu-west-1', 'dispatcher1')
+    Output = str(tmp_path / 'mscallenv.txt')
+    dvclass.CMDBBuilder(['default'], ['eu-west-1']).Build(Output, Incremental=True)
+    capsys.readouterr()
+    monkeypatch.setattr(dvclass.CMDBBuilder, 'REFRESH', 0)
+    dvclass.CMDBBuilder(['default'], ['eu-west-1']).Build(Output, Incremental=True)
+    assert "eu-west-1 1 rows (fetched)" in capsys.readouterr().out
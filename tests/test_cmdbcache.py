@@ -0,0 +1,24 @@
+import os, stat
+
+import dvclass
+
+ROW = "topoA 34.1.1.1 10.0.0.1 topoA-dispatcher1 eu-west-1 vpc-1 i-0001 Dispatcher m4.large eu-west-1a t1 AWS\n"
+
+
+def test_compiled_mode_follows_text_cmdb(tmp_path):
+    Conf = tmp_path / "mscallenv.txt"
+    Conf.write_text(ROW)
+    for Mode in (0o644, 0o640):
+        os.chmod(Conf, Mode)
+        Conf.write_text(ROW * 2 if Mode == 0o640 else ROW)
+        Cache = dvclass.CMDBCache(str(Conf))
+        Cache.Load()
+        assert stat.S_IMODE(os.stat(Cache.Path).st_mode) == Mode
+
+
+def test_compiled_lookup(tmp_path):
+    Conf = tmp_path / "mscallenv.txt"
+    Conf.write_text(ROW)
+    ams = dvclass.AMSCMDB(Path=str(Conf))
+    assert ams.GetInstAWS("topoA-dispatcher1")[0] == "i-0001"
+    assert os.path.exists(tmp_path / "mscallenv.cdb")